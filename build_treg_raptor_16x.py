@@ -26,19 +26,33 @@ parent_dir = Path(__file__).parent.parent
 sys.path.insert(0, str(parent_dir))
 
 from true_raptor_builder import TrueRAPTORTree
+from raptor_artifact import artifact_path_for
+from raptor_doc_store import DocumentStore
+from raptor_checkpoint import BuildCheckpoint
+from raptor_stream_writer import StreamingJSONTreeWriter, node_record
+from raptor_sqlite import export_sqlite, sqlite_path_for
 from enhanced_treg_vocab import determine_treg_level, generate_enhanced_treg_label, ENHANCED_LEVEL_COLOR_MAPPING
 
 
 class EnhancedTregRAPTOR16xBuilder:
     """16倍スケール用拡張Treg RAPTOR構築システム（PubMed統合 + 並列処理）"""
     
-    def __init__(self):
+    def __init__(self, resume: bool = False):
         self.base_dir = Path(__file__).parent
         self.results_dir = self.base_dir / 'results'
         self.cache_dir = self.base_dir / 'pubmed_cache'
+        
+        # チェックポイント設定（resume=Trueで完了済みステージをスキップ）
+        self.resume = resume
+        self.checkpoint_dir = self.results_dir / 'checkpoints' / 'treg_80x'
         self.results_dir.mkdir(exist_ok=True)
         self.cache_dir.mkdir(exist_ok=True)
         
+        # 本文ストア（text:<PMID> キー、圧縮・重複排除）: キャッシュとツリーはここを参照する
+        # 追記モードは排他ロックを取るため、構築中のみ開く（build_16x_raptor_tree）
+        self.doc_store_path = self.cache_dir / 'documents.docstore'
+        self.doc_store = None
+        
         # 80倍スケール設定（制約緩和版 - 実際の収集数は制約なし）
         self.scale = "80x"
         self.target_documents = 27 * 80  # 2160文書（参考値、実際は制約なし）
@@ -132,9 +146,20 @@ class EnhancedTregRAPTOR16xBuilder:
         cache_file = self.cache_dir / f"articles_{cache_key}.json"
         
         if cache_file.exists():
-            self.log_info(f"  ✓ Loading {len(pmids)} articles from cache")
             with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                cached = json.load(f)
+            # アブストラクトは本文ストアの文書本文（タイトル. アブストラクト）から取得
+            # （旧形式のキャッシュは本文を直接、またはアブストラクトのみのキーを保持）
+            for article in cached:
+                if 'text_key' in article:
+                    text = self.doc_store.get(article['text_key'])
+                    article['abstract'] = text[article['abstract_start']:] if text is not None else None
+                elif 'abstract' not in article:
+                    article['abstract'] = self.doc_store.get(article.get('abstract_key', ''))
+            if all(article['abstract'] is not None for article in cached):
+                self.log_info(f"  ✓ Loading {len(pmids)} articles from cache")
+                return cached
+            self.log_info(f"  ⚠️ Cache entries missing from document store, refetching")
         
         # APIから取得
         articles = []
@@ -180,9 +205,21 @@ class EnhancedTregRAPTOR16xBuilder:
             except Exception as e:
                 self.log_error(f"  ✗ Fetch error for batch: {e}")
         
-        # キャッシュ保存
+        # キャッシュ保存（文書本文は本文ストアに置き、キャッシュはキーのみ保持）
+        # ツリーのリーフと同じ本文・キー（text:<PMID>）なので本文ストアには1回だけ保存される
+        cache_entries = []
+        for article in articles:
+            text_key = f"text:{article['pmid']}"
+            self.doc_store.put(text_key, f"{article['title']}. {article['abstract']}")
+            cache_entries.append({
+                'pmid': article['pmid'],
+                'title': article['title'],
+                'text_key': text_key,
+                'abstract_start': len(article['title']) + 2  # 本文中のアブストラクト開始位置
+            })
+        self.doc_store.flush()
         with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(articles, f, ensure_ascii=False, indent=2)
+            json.dump(cache_entries, f, ensure_ascii=False, indent=2)
         
         return articles
     
@@ -379,7 +416,7 @@ class EnhancedTregRAPTOR16xBuilder:
         documents = []
         
         for idx, article in enumerate(pubmed_articles):
-            # タイトルとアブストラクトを結合
+            # タイトルとアブストラクトを結合（本文ストアの text:<PMID> と同じ本文）
             text = f"{article['title']}. {article['abstract']}"
             
             # enhanced_treg_vocabでTregレベルを判定
@@ -457,12 +494,23 @@ class EnhancedTregRAPTOR16xBuilder:
         
         total_start = time.time()
         
+        # ステージ別チェックポイント（resumeでなければ前回分を破棄して開始）
+        checkpoint = BuildCheckpoint(self.checkpoint_dir, reset=not self.resume, logger=self.logger)
+        if self.resume:
+            self.log_info(f"♻️ Resume mode: checkpoints in {self.checkpoint_dir}")
+        self.doc_store = DocumentStore(self.doc_store_path, mode='a')
+        
         try:
             # Phase 1: 文書生成
             self.log_info("\n📄 Phase 1: Document Generation")
             doc_start = time.time()
             
-            documents = self.create_treg_documents_16x()
+            documents = checkpoint.load_corpus() if self.resume else None
+            if documents:
+                self.log_info(f"  ♻️ Restored {len(documents)} documents from checkpoint")
+            else:
+                documents = self.create_treg_documents_16x()
+                checkpoint.save_corpus(documents)
             level_dist = self.analyze_document_distribution(documents)
             
             doc_time = time.time() - doc_start
@@ -477,6 +525,7 @@ class EnhancedTregRAPTOR16xBuilder:
             raptor.clustering_strategy = "top_down"  # Top-downクラスタリング
             raptor.initial_clusters = 8  # Tregの8レベルに対応 (0-7: added iTreg as Level 7)
             raptor.max_cluster_size = 50  # 大規模データセット用に調整
+            raptor.checkpoint = checkpoint  # 埋め込み・サブツリーのチェックポイント
             
             init_time = time.time() - init_start
             self.log_info(f"✓ RAPTOR initialized with top-down clustering in {init_time:.2f}s")
@@ -508,8 +557,8 @@ class EnhancedTregRAPTOR16xBuilder:
             
             # ツリー統計
             total_nodes = len(tree)
-            max_depth = max((node.level for node in tree.values()), default=0)
-            leaf_count = sum(1 for node in tree.values() if node.is_leaf)
+            max_depth = tree.max_level()
+            leaf_count = tree.leaf_count()
             
             self.log_info(f"\n📈 Tree Structure Analysis:")
             self.log_info(f"  Total nodes: {total_nodes}")
@@ -526,11 +575,12 @@ class EnhancedTregRAPTOR16xBuilder:
             
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             
-            # ツリー保存
+            # ツリー保存（統計ヘッダー + tree_nodesを逐次書き出し）
             results = {
                 'timestamp': timestamp,
                 'scale': self.scale,
                 'total_documents': len(documents),
+                'doc_ids': [doc['id'] for doc in documents],  # doc_levels と同じ順（doc_{i} の番号順ではない）
                 'doc_levels': [doc['determined_level'] for doc in documents],
                 'doc_labels': [doc['label'] for doc in documents],
                 'level_distribution': level_dist,
@@ -539,31 +589,27 @@ class EnhancedTregRAPTOR16xBuilder:
                 'max_depth': max_depth,
                 'leaf_count': leaf_count,
                 'clustering_stats': clustering_stats,  # 追加: クラスタリング品質統計
-                'tree_nodes': {}
+                'embedding_model': raptor.embedding_model_name,
+                'embedding': raptor.embedding_contract().to_dict()  # 検索時のクエリエンコード仕様
             }
             
-            # ツリーノードを辞書に変換
-            for node_id, node in tree.items():
-                results['tree_nodes'][node_id] = {
-                    'node_id': str(node.node_id),
-                    'parent_id': str(node.parent_id) if node.parent_id else None,
-                    'children': [str(c) for c in node.children],
-                    'level': int(node.level),
-                    'content': node.content[:500],
-                    'summary': node.summary[:500] if node.summary else '',
-                    'is_leaf': bool(node.is_leaf),
-                    'cluster_id': int(node.cluster_id) if node.cluster_id is not None else None,
-                    'cluster_size': int(node.cluster_size),
-                    'source_documents': [str(d) for d in node.source_documents[:30]]
-                }
-            
-            # JSON保存
+            # JSON保存（content/summaryは500文字、source_documentsは30件に制限）
             output_path = self.results_dir / f'enhanced_treg_raptor_80x_{timestamp}.json'
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(results, f, indent=2, ensure_ascii=False)
+            with StreamingJSONTreeWriter(output_path, header=results, nodes_key='tree_nodes') as writer:
+                for node_id, node in tree.items():
+                    writer.write_node(node_id, node_record(node, content_limit=500, sources_limit=30))
             
             self.log_info(f"✓ Results saved: {output_path.name}")
             
+            # バイナリアーティファクト保存（全文テキスト + mmap可能な埋め込み）
+            # リーフ本文は本文ストア（text:<PMID>）を参照し、アーティファクトには埋め込まない
+            doc_keys = {doc['id']: f"text:{doc['pmid']}" for doc in documents}
+            artifact_path = raptor.save_artifact(
+                artifact_path_for(output_path), results,
+                doc_store=self.doc_store, doc_keys=doc_keys
+            )
+            self.log_info(f"✓ Binary artifact saved: {artifact_path.name}")
+            
             # 文書メタデータ保存
             docs_path = self.results_dir / f'treg_documents_80x_{timestamp}.json'
             doc_metadata = []
@@ -574,7 +620,8 @@ class EnhancedTregRAPTOR16xBuilder:
                     'title': doc.get('title', ''),
                     'determined_level': doc['determined_level'],
                     'label': doc['label'],
-                    'text_length': len(doc['text'])
+                    'text_length': len(doc['text']),
+                    'text_key': f"text:{doc.get('pmid', '')}"  # 本文ストアのキー
                 }
                 doc_metadata.append(metadata)
             
@@ -583,6 +630,11 @@ class EnhancedTregRAPTOR16xBuilder:
             
             self.log_info(f"✓ Document metadata saved: {docs_path.name}")
             
+            # 分析用SQLiteデータベース（ノード・親子・文書所属・レベル統計）
+            db_path = export_sqlite(raptor.nodes, sqlite_path_for(output_path), results,
+                                    documents=doc_metadata, tree_index=raptor.tree_index)
+            self.log_info(f"✓ SQLite database saved: {db_path.name}")
+            
             save_time = time.time() - save_start
             total_time = time.time() - total_start
             
@@ -609,6 +661,7 @@ class EnhancedTregRAPTOR16xBuilder:
             
             self.log_info(f"\n📁 Output Files:")
             self.log_info(f"   Tree JSON: {output_path.name}")
+            self.log_info(f"   Tree artifact: {artifact_path.name}")
             self.log_info(f"   Documents: {docs_path.name}")
             self.log_info(f"   Log file: {self.log_file.name}")
             
@@ -628,6 +681,12 @@ class EnhancedTregRAPTOR16xBuilder:
             traceback.print_exc()
             
             return False
+        
+        finally:
+            # 未完了のチェックポイント書き込みを待ってから終了し、本文ストアのロックを解放
+            checkpoint.close()
+            self.doc_store.close()
+            self.doc_store = None
 
 
 def main():
@@ -641,8 +700,9 @@ def main():
     print("🚀 ENHANCED TREG RAPTOR 80X SCALE CONSTRUCTION")
     print("=" * 70)
     
-    # 16倍スケールビルダー初期化
-    builder = EnhancedTregRAPTOR16xBuilder()
+    # 16倍スケールビルダー初期化（--resume で前回のチェックポイントから再開）
+    resume = '--resume' in sys.argv
+    builder = EnhancedTregRAPTOR16xBuilder(resume=resume)
     
     try:
         success = builder.build_16x_raptor_tree()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """クラスタリング統計確認スクリプト"""
-import json
 from pathlib import Path
 
+from raptor_artifact import load_tree_metadata
+
 # 最新の結果ファイルを取得
 results_dir = Path("results")
 json_files = list(results_dir.glob("enhanced_treg_raptor_80x_*.json"))
@@ -13,9 +14,8 @@ if not json_files:
 latest_file = max(json_files, key=lambda p: p.stat().st_mtime)
 print(f"📁 結果ファイル: {latest_file.name}\n")
 
-# JSON読み込み
-with open(latest_file, 'r', encoding='utf-8') as f:
-    data = json.load(f)
+# 統計メタデータ読み込み（.raptorアーティファクトがあればmanifestのみ参照）
+data = load_tree_metadata(latest_file)
 
 # クラスタリング統計
 stats = data.get('clustering_stats', {})
@@ -1,10 +1,11 @@
 """
 Compare three versions with correct data structure handling
 """
-import json
 from pathlib import Path
 from collections import Counter
 
+from raptor_artifact import load_tree_metadata
+
 results_dir = Path('results')
 
 # Load three versions
@@ -25,10 +26,9 @@ versions = [
 all_data = []
 for name, file in versions:
     if file.exists():
-        with open(file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            all_data.append((name, data))
-            print(f"\n✓ {name}データ読み込み成功: {file.name}")
+        data = load_tree_metadata(file)  # doc_levelsのみ使用するためノードは読まない
+        all_data.append((name, data))
+        print(f"\n✓ {name}データ読み込み成功: {file.name}")
     else:
         print(f"\n✗ {name}データなし: {file.name}")
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Arrow / Parquet Export
+ツリー・文書メタデータを列指向ファイル（Arrow IPC / Parquet）に書き出す
+
+出力ディレクトリ（例: results/enhanced_treg_raptor_80x_YYYYMMDD_HHMMSS.arrow/）:
+    nodes.arrow      ノード列（level / depth / cluster / 要約）+ 埋め込み（FixedSizeList<float32>）
+    edges.arrow      親子関係（childrenの順序付き）
+    documents.arrow  文書メタデータ（PMID・判定レベル・ラベル・所属クラスタ）
+
+Arrow IPC は非圧縮で書き出すため、pyarrow.memory_map でコピーなしに開ける:
+    from raptor_arrow_export import read_table
+    nodes = read_table('results/enhanced_treg_raptor_80x_*.arrow/nodes.arrow')
+    df = nodes.select(['node_id', 'level', 'cluster_size']).to_pandas()
+
+pyarrow は任意依存（pip install pyarrow）。
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Union
+
+import numpy as np
+
+from raptor_node_store import RAPTORNodeStore
+from raptor_tree_index import TreeIndex
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # 任意依存: エクスポート時にのみ必要
+    pa = None
+    pq = None
+
+ARROW_SUFFIX = '.arrow'
+FORMATS = ('arrow', 'parquet')
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("Arrow/Parquet export requires pyarrow; install it with: pip install pyarrow")
+
+
+def embedding_column(embeddings: np.ndarray) -> 'pa.FixedSizeListArray':
+    """(n, dim) の埋め込み行列をFixedSizeList<float32>[dim]列に変換（値バッファはコピーなし）"""
+    _require_pyarrow()
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    dim = matrix.shape[1] if matrix.ndim == 2 else 0
+    return pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), dim)
+
+
+def embedding_matrix(column: Union['pa.ChunkedArray', 'pa.FixedSizeListArray']) -> np.ndarray:
+    """FixedSizeList列を (n, dim) のnumpy配列として参照（単一チャンクならコピーなし）"""
+    _require_pyarrow()
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    dim = column.type.list_size
+    return column.flatten().to_numpy(zero_copy_only=False).reshape(-1, dim)
+
+
+def nodes_table(store: RAPTORNodeStore, index: Optional[TreeIndex] = None,
+                include_embeddings: bool = True, include_content: bool = False) -> 'pa.Table':
+    """ノード表（序数順、埋め込みはFixedSizeList列）"""
+    _require_pyarrow()
+    index = index or TreeIndex.from_store(store)
+    node_ids = store.node_ids
+    parents = store.parent_ordinals()
+    cluster_ids = store.cluster_ids
+    n = len(store)
+
+    columns = {
+        'node_id': pa.array(node_ids, type=pa.string()),
+        'parent_id': pa.array([node_ids[p] if p >= 0 else None for p in parents], type=pa.string()),
+        'canonical_parent_id': pa.array([node_ids[p] if p >= 0 else None for p in index.parent],
+                                        type=pa.string()),
+        'level': pa.array(store.levels, type=pa.int32()),
+        'depth': pa.array(index.depth, type=pa.int32()),
+        'is_leaf': pa.array(store.is_leaf_mask, type=pa.bool_()),
+        'cluster_id': pa.array(cluster_ids, mask=cluster_ids < 0, type=pa.int32()),
+        'cluster_size': pa.array(store.cluster_sizes, type=pa.int32()),
+        'document_count': pa.array(index.leaf_end - index.leaf_start, type=pa.int32()),
+        'tin': pa.array(index.tin, type=pa.int64()),
+        'tout': pa.array(index.tout, type=pa.int64()),
+        'summary': pa.array([store.view(i).summary for i in range(n)], type=pa.large_string()),
+    }
+    if include_content:
+        columns['content'] = pa.array([store.view(i).content for i in range(n)], type=pa.large_string())
+    if include_embeddings and store.embedding_dim:
+        columns['embedding'] = embedding_column(store.embedding_matrix())
+        has_embedding = store.has_embedding_mask
+        if not has_embedding.all():
+            columns['embedding'] = pa.FixedSizeListArray.from_arrays(
+                columns['embedding'].values, store.embedding_dim, mask=pa.array(~has_embedding)
+            )
+    return pa.table(columns)
+
+
+def edges_table(store: RAPTORNodeStore) -> 'pa.Table':
+    """親子関係表（children の並び順を position に保持）"""
+    _require_pyarrow()
+    indptr, _ = store.children_csr()
+    counts = np.diff(indptr)
+    parent_ids = np.repeat(np.arange(len(store)), counts)
+    child_ids = [child for i in range(len(store)) for child in store.view(i).children]
+    positions = np.arange(int(indptr[-1])) - np.repeat(indptr[:-1], counts)
+    node_ids = store.node_ids
+    return pa.table({
+        'parent_id': pa.array([node_ids[p] for p in parent_ids], type=pa.string()),
+        'child_id': pa.array(child_ids, type=pa.string()),
+        'position': pa.array(positions, type=pa.int32()),
+    })
+
+
+def documents_table(documents: Sequence[Dict[str, Any]], store: Optional[RAPTORNodeStore] = None,
+                    index: Optional[TreeIndex] = None) -> 'pa.Table':
+    """文書メタデータ表（treg_documents_80x_*.json）。ストアがあれば所属クラスタ（最も深い親）を付与"""
+    _require_pyarrow()
+    columns = {
+        'document_id': pa.array([doc['id'] for doc in documents], type=pa.string()),
+        'pmid': pa.array([str(doc.get('pmid', '')) for doc in documents], type=pa.string()),
+        'title': pa.array([doc.get('title', '') for doc in documents], type=pa.string()),
+        'determined_level': pa.array([doc.get('determined_level') for doc in documents], type=pa.int32()),
+        'label': pa.array([doc.get('label') for doc in documents], type=pa.string()),
+        'text_length': pa.array([doc.get('text_length') for doc in documents], type=pa.int64()),
+    }
+    if store is not None:
+        index = index or TreeIndex.from_store(store)
+        node_ids = store.node_ids
+        clusters = []
+        for doc in documents:
+            ordinal = store.ordinal(doc['id']) if doc['id'] in store else -1
+            parent = index.parent[ordinal] if ordinal >= 0 else -1
+            clusters.append(node_ids[parent] if parent >= 0 else None)
+        columns['cluster_node_id'] = pa.array(clusters, type=pa.string())
+    return pa.table(columns)
+
+
+def write_table(table: 'pa.Table', path: Union[str, Path], fmt: str = 'arrow') -> Path:
+    """表を書き出す（arrow: 非圧縮IPCファイル、parquet: zstd圧縮）"""
+    _require_pyarrow()
+    path = Path(path)
+    if fmt == 'arrow':
+        with pa.OSFile(str(path), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    elif fmt == 'parquet':
+        pq.write_table(table, str(path), compression='zstd')
+    else:
+        raise ValueError(f"Unknown format: {fmt} (expected one of {FORMATS})")
+    return path
+
+
+def read_table(path: Union[str, Path]) -> 'pa.Table':
+    """Arrow IPC はmemory_mapでコピーなし、Parquetは通常読み込み"""
+    _require_pyarrow()
+    path = Path(path)
+    if path.suffix == '.parquet':
+        return pq.read_table(str(path), memory_map=True)
+    with pa.memory_map(str(path), 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def export_tree(store: RAPTORNodeStore, output_dir: Union[str, Path],
+                documents: Optional[Sequence[Dict[str, Any]]] = None,
+                index: Optional[TreeIndex] = None, fmt: str = 'arrow',
+                include_embeddings: bool = True, include_content: bool = False) -> Dict[str, Path]:
+    """ノード・親子関係・文書メタデータをディレクトリに書き出す"""
+    _require_pyarrow()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt} (expected one of {FORMATS})")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    index = index or TreeIndex.from_store(store)
+    suffix = '.arrow' if fmt == 'arrow' else '.parquet'
+
+    written = {
+        'nodes': write_table(nodes_table(store, index, include_embeddings, include_content),
+                             output_dir / f'nodes{suffix}', fmt),
+        'edges': write_table(edges_table(store), output_dir / f'edges{suffix}', fmt),
+    }
+    if documents:
+        written['documents'] = write_table(documents_table(documents, store, index),
+                                           output_dir / f'documents{suffix}', fmt)
+    return written
+
+
+def arrow_path_for(json_path: Union[str, Path]) -> Path:
+    """JSON出力に対応するエクスポート先（同名 + .arrow）"""
+    json_path = Path(json_path)
+    return json_path.with_name(json_path.stem + ARROW_SUFFIX)
+
+
+def main():
+    from raptor_artifact import load_tree_artifact
+
+    parser = argparse.ArgumentParser(description="Export a RAPTOR tree to Arrow IPC / Parquet")
+    parser.add_argument('tree', help='tree output (JSON or .raptor)')
+    parser.add_argument('--documents', help='treg_documents_80x_*.json metadata')
+    parser.add_argument('--format', choices=FORMATS, default='arrow')
+    parser.add_argument('--no-embeddings', action='store_true', help='omit the embedding column')
+    parser.add_argument('--content', action='store_true', help='include full node content')
+    parser.add_argument('-o', '--output', help='output directory')
+    args = parser.parse_args()
+
+    artifact = load_tree_artifact(args.tree)
+    documents = None
+    if args.documents:
+        with open(args.documents, 'r', encoding='utf-8') as f:
+            documents = json.load(f)
+    output_dir = args.output or arrow_path_for(Path(args.tree).with_suffix('.json'))
+    written = export_tree(artifact.store, output_dir, documents, artifact.tree_index, args.format,
+                          include_embeddings=not args.no_embeddings, include_content=args.content)
+    for name, path in written.items():
+        print(f"✓ {name}: {path} ({path.stat().st_size / 1024**2:.2f} MB)")
+
+
+if __name__ == "__main__":
+    main()
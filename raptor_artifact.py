@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Tree Binary Artifact
+RAPTORツリーのバージョン付きバイナリ成果物フォーマット
+
+ディレクトリ構成（例: results/enhanced_treg_raptor_80x_YYYYMMDD_HHMMSS.raptor/）:
+    manifest.json    フォーマット版数・ノード数・各ファイルのSHA-256・ビルドメタデータ
+    embeddings.npy   float32埋め込み行列（np.load(..., mmap_mode='r') で開ける）
+    nodes.npz        ノード列データ（level / parent / cluster / CSR children・source_documents）
+    symbols.bin      ノードID・文書IDのUTF-8ブロブ（オフセットはnodes.npz）
+    texts.bin        content / summary のUTF-8ブロブ（mmapで遅延デコード）
+    tree_index.npz   祖先・子孫クエリ用の木インデックス（raptor_tree_index.py）
+    vectors.faiss    ノード埋め込みのFAISSインデックス + vector_ids.npy（raptor_vector_index.py）
+    bm25.npz         summary + content のBM25転置インデックス（raptor_bm25.py）
+
+doc_store を指定して保存した場合、リーフ本文は texts.bin に含めず
+DocumentStore（raptor_doc_store.py）のキー参照として記録し、アクセス時に取得する。
+
+既存のJSON出力（save_tree形式 / build_16x_raptor_tree形式）からの変換:
+    python raptor_artifact.py convert results/enhanced_treg_raptor_80x_*.json
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+
+from raptor_bm25 import BM25Index
+from raptor_doc_store import DocumentStore
+from raptor_node_store import BlobStrings, NodeDictView, RAPTORNode, RAPTORNodeStore
+from raptor_stream_writer import decode_embedding
+from raptor_tree_index import TreeIndex
+from raptor_vector_index import VectorIndex
+
+ARTIFACT_FORMAT = 'raptor-artifact'
+ARTIFACT_VERSION = 1
+ARTIFACT_SUFFIX = '.raptor'
+
+MANIFEST_FILE = 'manifest.json'
+EMBEDDINGS_FILE = 'embeddings.npy'
+NODES_FILE = 'nodes.npz'
+SYMBOLS_FILE = 'symbols.bin'
+TEXTS_FILE = 'texts.bin'
+TREE_INDEX_FILE = 'tree_index.npz'
+BM25_FILE = 'bm25.npz'
+
+
+class ArtifactError(ValueError):
+    """アーティファクトの形式・整合性エラー"""
+
+
+def _sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _to_jsonable(value: Any) -> Any:
+    """numpy型を含むメタデータをJSON化可能な形に変換"""
+    if isinstance(value, dict):
+        return {str(k): _to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _map_blob(path: Path):
+    """バイナリファイルを読み取り専用でmmap（空ファイルはb''）"""
+    if path.stat().st_size == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _ExternalTexts:
+    """texts.bin と DocumentStore 参照を組み合わせた遅延テキストテーブル"""
+    __slots__ = ('_base', '_key_index', '_keys', '_store_path', '_store')
+
+    def __init__(self, base: BlobStrings, key_index: np.ndarray, keys: BlobStrings, store_path: Path):
+        self._base = base
+        self._key_index = key_index
+        self._keys = keys
+        self._store_path = store_path
+        self._store: Optional[DocumentStore] = None
+
+    def __len__(self) -> int:
+        return len(self._base)
+
+    def __getitem__(self, index: int) -> str:
+        if index < len(self._key_index) and self._key_index[index] >= 0:
+            if self._store is None:
+                self._store = DocumentStore(self._store_path, mode='r')
+            return self._store.get(self._keys[int(self._key_index[index])], '')
+        return self._base[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value: str) -> None:
+        self._base.append(value)
+
+
+def write_artifact(store: RAPTORNodeStore, output_path: Union[str, Path],
+                   metadata: Optional[Dict[str, Any]] = None,
+                   doc_store: Optional[DocumentStore] = None,
+                   doc_keys: Optional[Dict[str, str]] = None,
+                   vector_index: Optional[VectorIndex] = None) -> Path:
+    """ノードストアをバイナリアーティファクトとして保存（一時ディレクトリ→リネーム）
+
+    doc_store と doc_keys（node_id → ストアキー）を指定すると、該当ノードの本文は
+    ドキュメントストアに保存し、アーティファクトにはキー参照のみを記録する。
+    vector_index を指定するとFAISSインデックスも同梱する。
+    """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + f'.tmp-{os.getpid()}')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    columns = store.to_columns()
+    texts = list(store.texts)
+    external = {}
+    if doc_store is not None and doc_keys:
+        # 本文をドキュメントストアへ移し、texts.bin には空文字を残す
+        key_index = np.full(len(texts), -1, dtype=np.int64)
+        key_list: List[str] = []
+        for node_id, key in doc_keys.items():
+            if node_id not in store:
+                continue
+            ref = int(columns['content_ref'][store.ordinal(node_id)])
+            if ref < 0 or key_index[ref] >= 0:
+                continue
+            doc_store.put(key, texts[ref])
+            key_index[ref] = len(key_list)
+            key_list.append(key)
+            texts[ref] = ''
+        doc_store.flush()
+        key_blob, key_offsets = BlobStrings.encode(key_list)
+        columns['text_key_index'] = key_index
+        columns['text_key_blob'] = np.frombuffer(key_blob, dtype=np.uint8)
+        columns['text_key_offsets'] = key_offsets
+        external = {'doc_store': os.path.relpath(doc_store.path.resolve(), output_path.resolve()),
+                    'external_texts': len(key_list)}
+
+    symbol_blob, symbol_offsets = BlobStrings.encode(list(store.symbols))
+    text_blob, text_offsets = BlobStrings.encode(texts)
+    columns['symbol_offsets'] = symbol_offsets
+    columns['text_offsets'] = text_offsets
+
+    embeddings = np.ascontiguousarray(store.embedding_matrix(), dtype=np.float32)
+    np.save(tmp_path / EMBEDDINGS_FILE, embeddings)
+    np.savez(tmp_path / NODES_FILE, **columns)
+    (tmp_path / SYMBOLS_FILE).write_bytes(symbol_blob)
+    (tmp_path / TEXTS_FILE).write_bytes(text_blob)
+    TreeIndex.from_store(store).save(tmp_path / TREE_INDEX_FILE)
+    BM25Index.from_store(store).save(tmp_path / BM25_FILE)
+    vector_files = vector_index.save(tmp_path) if vector_index is not None else []
+
+    files = {}
+    for name in (EMBEDDINGS_FILE, NODES_FILE, SYMBOLS_FILE, TEXTS_FILE, TREE_INDEX_FILE, BM25_FILE,
+                 *vector_files):
+        file_path = tmp_path / name
+        files[name] = {'sha256': _sha256(file_path), 'bytes': file_path.stat().st_size}
+
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'version': ARTIFACT_VERSION,
+        'created': datetime.now().isoformat(),
+        'node_count': len(store),
+        'leaf_count': store.leaf_count(),
+        'max_level': store.max_level(),
+        'embedding_dim': int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        'files': files,
+        'metadata': _to_jsonable(metadata or {}),
+    }
+    manifest.update(external)
+    with open(tmp_path / MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # 既存の成果物がある場合は退避してから置き換え
+    if output_path.exists():
+        backup_path = output_path.with_name(output_path.name + f'.old-{os.getpid()}')
+        os.replace(output_path, backup_path)
+        os.replace(tmp_path, output_path)
+        shutil.rmtree(backup_path, ignore_errors=True)
+    else:
+        os.replace(tmp_path, output_path)
+    return output_path
+
+
+def read_manifest(path: Union[str, Path]) -> Dict[str, Any]:
+    """manifest.jsonのみを読み込む（メタデータ参照用、ノードは読まない）"""
+    manifest_path = Path(path) / MANIFEST_FILE
+    if not manifest_path.exists():
+        raise ArtifactError(f"Not a RAPTOR artifact (missing {MANIFEST_FILE}): {path}")
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        raise ArtifactError(f"Unknown artifact format: {manifest.get('format')}")
+    if manifest.get('version', 0) > ARTIFACT_VERSION:
+        raise ArtifactError(
+            f"Artifact version {manifest['version']} is newer than supported ({ARTIFACT_VERSION})"
+        )
+    return manifest
+
+
+def verify_artifact(path: Union[str, Path]) -> Dict[str, Any]:
+    """全ファイルのSHA-256をmanifestと照合（不一致はArtifactError）"""
+    path = Path(path)
+    manifest = read_manifest(path)
+    for name, info in manifest['files'].items():
+        file_path = path / name
+        if not file_path.exists():
+            raise ArtifactError(f"Missing artifact file: {file_path}")
+        actual = _sha256(file_path)
+        if actual != info['sha256']:
+            raise ArtifactError(f"Checksum mismatch for {name}: {actual} != {info['sha256']}")
+    return manifest
+
+
+class RAPTORArtifact:
+    """開いたアーティファクト（埋め込み・テキストはmmap、構造列は読み込み済み）"""
+
+    def __init__(self, path: Path, manifest: Dict[str, Any], store: RAPTORNodeStore):
+        self.path = path
+        self.manifest = manifest
+        self.store = store
+        self._tree_index: Optional[TreeIndex] = None
+        self._vector_index: Optional[VectorIndex] = None
+        self._bm25_index: Optional[BM25Index] = None
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.manifest.get('metadata', {})
+
+    @property
+    def tree_index(self) -> TreeIndex:
+        """木インデックス（保存済みなら読み込み、旧アーティファクト・JSONは初回アクセス時に構築）"""
+        if self._tree_index is None:
+            index_path = self.path / TREE_INDEX_FILE
+            if self.path.is_dir() and index_path.exists():
+                self._tree_index = TreeIndex.load(index_path, self.store.node_ids)
+            else:
+                self._tree_index = TreeIndex.from_store(self.store)
+        return self._tree_index
+
+    @property
+    def vector_index(self) -> VectorIndex:
+        """ベクトルインデックス（保存済みなら読み込み、なければ埋め込みから構築）"""
+        if self._vector_index is None:
+            if self.path.is_dir() and VectorIndex.exists(self.path):
+                self._vector_index = VectorIndex.load(self.path)
+                if self._vector_index.compressed:  # 圧縮構成の候補はmmapの元の埋め込みで再スコアリング
+                    self._vector_index.attach_vectors(self.store.embedding_matrix())
+            else:
+                self._vector_index = VectorIndex.from_store(self.store)
+        return self._vector_index
+
+    @property
+    def bm25_index(self) -> BM25Index:
+        """BM25キーワードインデックス（保存済みなら読み込み、なければテキストから構築）"""
+        if self._bm25_index is None:
+            index_path = self.path / BM25_FILE
+            if self.path.is_dir() and index_path.exists():
+                self._bm25_index = BM25Index.load(index_path)
+            else:
+                self._bm25_index = BM25Index.from_store(self.store)
+        return self._bm25_index
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self.store.embedding_matrix()
+
+    def __repr__(self) -> str:
+        return (f"RAPTORArtifact({self.path.name}, nodes={self.manifest['node_count']}, "
+                f"dim={self.manifest['embedding_dim']})")
+
+
+def open_artifact(path: Union[str, Path], mmap_embeddings: bool = True,
+                  verify: bool = False) -> RAPTORArtifact:
+    """アーティファクトを開く（verify=Trueで事前にチェックサム検証）"""
+    path = Path(path)
+    manifest = verify_artifact(path) if verify else read_manifest(path)
+
+    with np.load(path / NODES_FILE) as npz:
+        columns = {name: npz[name] for name in npz.files}
+
+    symbol_blob = _map_blob(path / SYMBOLS_FILE)
+    symbols = list(BlobStrings(symbol_blob, columns.pop('symbol_offsets')))
+    texts = BlobStrings(_map_blob(path / TEXTS_FILE), columns.pop('text_offsets'))
+    if 'doc_store' in manifest:
+        keys = BlobStrings(columns.pop('text_key_blob').tobytes(), columns.pop('text_key_offsets'))
+        texts = _ExternalTexts(texts, columns.pop('text_key_index'), keys,
+                               (path / manifest['doc_store']).resolve())
+    embeddings = np.load(path / EMBEDDINGS_FILE, mmap_mode='r' if mmap_embeddings else None)
+
+    store = RAPTORNodeStore.from_columns(columns, symbols, texts, embeddings)
+    return RAPTORArtifact(path, manifest, store)
+
+
+def is_artifact(path: Union[str, Path]) -> bool:
+    return (Path(path) / MANIFEST_FILE).exists()
+
+
+def artifact_path_for(json_path: Union[str, Path]) -> Path:
+    """JSON出力に対応するアーティファクトのパス（同名 + .raptor）"""
+    json_path = Path(json_path)
+    return json_path.with_name(json_path.stem + ARTIFACT_SUFFIX)
+
+
+# ============================================================================
+# 既存JSON出力からの変換
+# ============================================================================
+
+def store_from_json_nodes(nodes: Dict[str, Dict[str, Any]]) -> RAPTORNodeStore:
+    """JSONのノード辞書（save_tree形式 / tree_nodes形式）からストアを構築"""
+    store = RAPTORNodeStore(capacity=max(len(nodes), 1))
+    for node_id, info in nodes.items():
+        store.add(RAPTORNode(
+            node_id=info.get('node_id', node_id),
+            parent_id=info.get('parent_id'),
+            children=info.get('children', []),
+            level=info.get('level', -1),
+            content=info.get('content', ''),
+            summary=info.get('summary', ''),
+            is_leaf=info.get('is_leaf', False),
+            cluster_id=info.get('cluster_id'),
+            embedding=decode_embedding(info.get('embedding')),
+            source_documents=info.get('source_documents', []),
+            cluster_size=info.get('cluster_size', 0)
+        ), node_id=node_id)
+    return store
+
+
+def split_tree_json(data: Dict[str, Any]):
+    """JSON出力をノード辞書とメタデータに分離（両形式に対応）"""
+    if 'tree_nodes' in data:
+        # build_16x_raptor_tree形式: 統計はトップレベル、ノードはtree_nodes（埋め込みなし）
+        metadata = {k: v for k, v in data.items() if k != 'tree_nodes'}
+        metadata['source_format'] = 'build_16x'
+        return data['tree_nodes'], metadata
+    if 'nodes' in data:
+        # save_tree形式: metadata + nodes（埋め込みあり）
+        metadata = dict(data.get('metadata', {}))
+        metadata['source_format'] = 'save_tree'
+        return data['nodes'], metadata
+    raise ArtifactError("Unrecognized tree JSON: expected 'tree_nodes' or 'nodes'")
+
+
+def convert_json_tree(json_path: Union[str, Path],
+                      output_path: Optional[Union[str, Path]] = None) -> Path:
+    """既存のJSONツリー出力をバイナリアーティファクトに変換"""
+    json_path = Path(json_path)
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    nodes, metadata = split_tree_json(data)
+    metadata['converted_from'] = json_path.name
+    store = store_from_json_nodes(nodes)
+    return write_artifact(store, output_path or artifact_path_for(json_path), metadata)
+
+
+# ============================================================================
+# 読み取り専用の読み込み（モデル不要）
+# ============================================================================
+
+def load_tree_artifact(path: Union[str, Path], verify: bool = False) -> RAPTORArtifact:
+    """アーティファクトまたはJSONからツリーを読み込む
+
+    - アーティファクト（.raptorディレクトリ）: 構造列のみ読み込み、テキスト・埋め込みはmmapで遅延参照
+    - JSON: 同名の .raptor があればそちらを優先し、なければJSONを解析してストアを構築
+    """
+    path = Path(path)
+    if path.suffix == '.json' and is_artifact(artifact_path_for(path)):
+        path = artifact_path_for(path)
+    if is_artifact(path):
+        return open_artifact(path, verify=verify)
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    nodes, metadata = split_tree_json(data)
+    store = store_from_json_nodes(nodes)
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'version': ARTIFACT_VERSION,
+        'node_count': len(store),
+        'leaf_count': store.leaf_count(),
+        'max_level': store.max_level(),
+        'embedding_dim': store.embedding_dim or 0,
+        'files': {},
+        'metadata': metadata,
+    }
+    return RAPTORArtifact(path, manifest, store)
+
+
+def load_tree_data(path: Union[str, Path]) -> Dict[str, Any]:
+    """既存スクリプト向け: build JSONと同じ形の辞書（統計 + 遅延tree_nodes）を返す"""
+    artifact = load_tree_artifact(path)
+    tree_data = dict(artifact.metadata)
+    tree_data['tree_nodes'] = NodeDictView(artifact.store)
+    return tree_data
+
+
+def load_tree_metadata(path: Union[str, Path]) -> Dict[str, Any]:
+    """統計メタデータのみを読み込む（アーティファクトがあればmanifestのみ参照）"""
+    path = Path(path)
+    if path.suffix == '.json' and is_artifact(artifact_path_for(path)):
+        path = artifact_path_for(path)
+    if is_artifact(path):
+        return read_manifest(path).get('metadata', {})
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return split_tree_json(data)[1]
+
+
+def main():
+    """コマンドライン: convert / verify / info"""
+    parser = argparse.ArgumentParser(description="RAPTOR tree binary artifact tool")
+    sub = parser.add_subparsers(dest='command', required=True)
+    convert = sub.add_parser('convert', help='convert JSON tree output to an artifact')
+    convert.add_argument('json_files', nargs='+')
+    convert.add_argument('-o', '--output', help='output path (single input only)')
+    verify = sub.add_parser('verify', help='verify artifact checksums')
+    verify.add_argument('artifacts', nargs='+')
+    info = sub.add_parser('info', help='show artifact manifest summary')
+    info.add_argument('artifacts', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        if args.output and len(args.json_files) > 1:
+            parser.error('--output can only be used with a single input file')
+        for json_file in args.json_files:
+            out = convert_json_tree(json_file, args.output)
+            manifest = read_manifest(out)
+            print(f"✓ {Path(json_file).name} → {out.name} "
+                  f"({manifest['node_count']} nodes, dim={manifest['embedding_dim']})")
+    elif args.command == 'verify':
+        failed = False
+        for artifact in args.artifacts:
+            try:
+                verify_artifact(artifact)
+                print(f"✓ {artifact}: OK")
+            except ArtifactError as e:
+                failed = True
+                print(f"✗ {artifact}: {e}")
+        if failed:
+            sys.exit(1)
+    else:
+        for artifact in args.artifacts:
+            manifest = read_manifest(artifact)
+            print(f"📦 {artifact}")
+            print(f"  Version: {manifest['version']}  Created: {manifest['created']}")
+            print(f"  Nodes: {manifest['node_count']} (leaves: {manifest['leaf_count']}), "
+                  f"max level: {manifest['max_level']}, dim: {manifest['embedding_dim']}")
+            total = sum(info['bytes'] for info in manifest['files'].values())
+            print(f"  Size: {total / 1024**2:.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+RAPTOR BM25 Keyword Index
+ツリーノード（summary + content）の転置インデックスとBM25スコアリング
+
+- 語彙 → postings（ノード番号・出現回数）をCSR配列で保持
+- クエリは該当語のpostingsのみを走査（全ノードの文字列走査なし）
+- 上位k件は argpartition で絞り込み、ヒープで整列
+- アーティファクトに bm25.npz として保存（raptor_artifact.write_artifact）
+"""
+
+import heapq
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from raptor_node_store import BlobStrings
+
+# IL-10, TGF-beta, CD4+ のような用語を1語として扱う
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*\+?")
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how in into is it its of on or
+that the their there these this to was were what when which while who why will with
+""".split())
+
+# 一致postings数 × この値がノード数以上なら密なアキュムレータで加算（それ以下は一致ノードのみ）
+DENSE_ACCUMULATE_RATIO = 8
+
+
+def tokenize(text: str) -> List[str]:
+    """小文字化・英数字トークン化・ストップワード除去"""
+    return [t for t in _TOKEN_PATTERN.findall((text or '').lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """BM25転置インデックス（postingsはCSR: term_indptr → doc / tf）"""
+
+    def __init__(self, vocabulary: Dict[str, int], term_indptr: np.ndarray, postings_doc: np.ndarray,
+                 postings_tf: np.ndarray, doc_lengths: np.ndarray, labels: Sequence[str],
+                 k1: float = 1.5, b: float = 0.75):
+        self.vocabulary = vocabulary
+        self.term_indptr = term_indptr
+        self.postings_doc = postings_doc
+        self.postings_tf = postings_tf
+        self.doc_lengths = doc_lengths
+        self.labels = labels
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_lengths)
+        self.avg_doc_length = float(doc_lengths.mean()) if n_docs else 0.0
+        df = np.diff(term_indptr).astype(np.float64)
+        self.idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # 文書長による正規化項（クエリごとに再計算しない）
+        self._length_norm = (k1 * (1.0 - b + b * doc_lengths / max(self.avg_doc_length, 1e-9))).astype(np.float32)
+
+    # ------------------------------------------------------------------
+    # 構築
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def build(cls, texts: Iterable[str], labels: Sequence[str], k1: float = 1.5, b: float = 0.75) -> 'BM25Index':
+        """テキスト列から構築（labels[i] は i 番目のテキストのノードID）"""
+        vocabulary: Dict[str, int] = {}
+        doc_ids: List[int] = []
+        term_ids: List[int] = []
+        tfs: List[int] = []
+        doc_lengths: List[int] = []
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                doc_ids.append(doc)
+                term_ids.append(term_id)
+                tfs.append(tf)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')  # 語ごとにまとめ、語内はノード番号順
+        term_indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)), out=term_indptr[1:])
+        return cls(vocabulary, term_indptr,
+                   np.asarray(doc_ids, dtype=np.int32)[order],
+                   np.asarray(tfs, dtype=np.int32)[order],
+                   np.asarray(doc_lengths, dtype=np.float32), list(labels), k1, b)
+
+    @classmethod
+    def from_store(cls, store, **kwargs) -> 'BM25Index':
+        """ノードストアから構築（文書番号 = ノード序数）"""
+        texts = (f"{store.view(i).summary} {store.view(i).content}" for i in range(len(store)))
+        return cls.build(texts, list(store.node_ids), **kwargs)
+
+    @classmethod
+    def from_tree_nodes(cls, tree_nodes: Mapping[str, Mapping], **kwargs) -> 'BM25Index':
+        """tree_nodes形式の辞書から構築"""
+        labels = list(tree_nodes)
+        texts = (f"{tree_nodes[n].get('summary', '')} {tree_nodes[n].get('content', '')}" for n in labels)
+        return cls.build(texts, labels, **kwargs)
+
+    # ------------------------------------------------------------------
+    # 検索
+    # ------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """語のpostings（ノード番号, 出現回数）。未知語は空"""
+        term_id = self.vocabulary.get(term)
+        if term_id is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        start, end = self.term_indptr[term_id], self.term_indptr[term_id + 1]
+        return self.postings_doc[start:end], self.postings_tf[start:end]
+
+    def score(self, query: str, require_all: bool = False,
+              mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """クエリに一致したノード番号とBM25スコア
+
+        require_all=Trueで全語を含むノードのみ。mask（ノード番号上のブールマスク）指定時は
+        postingsの段階で対象外ノードを除く。
+        """
+        terms = [t for t in dict.fromkeys(tokenize(query)) if t in self.vocabulary]
+        if not terms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        docs_list, weights_list = [], []
+        for term in terms:
+            docs, tf = self.postings(term)
+            if mask is not None:
+                keep = mask[docs]
+                docs, tf = docs[keep], tf[keep]
+            tf = tf.astype(np.float32)
+            idf = self.idf[self.vocabulary[term]]
+            docs_list.append(docs)
+            weights_list.append(idf * tf * (self.k1 + 1.0) / (tf + self._length_norm[docs]))
+
+        docs = np.concatenate(docs_list)
+        weights = np.concatenate(weights_list)
+        if len(terms) == 1:
+            return docs.astype(np.int64), weights.astype(np.float32)  # postingsはノード番号順・重複なし
+        if len(docs) * DENSE_ACCUMULATE_RATIO >= len(self):
+            # postingsがノード数に近い（頻出語）: 密なアキュムレータの方が速い
+            scores = np.bincount(docs, weights=weights, minlength=len(self))
+            counts = np.bincount(docs, minlength=len(self))
+            matched = np.flatnonzero(counts == len(terms) if require_all else counts)
+            return matched.astype(np.int64), scores[matched].astype(np.float32)
+        # 一致したpostingsのみで加算（コストはノード数ではなく一致postings数に比例）
+        matched, slot = np.unique(docs, return_inverse=True)
+        scores = np.bincount(slot, weights=weights, minlength=len(matched))
+        if require_all:
+            keep = np.bincount(slot, minlength=len(matched)) == len(terms)
+            matched, scores = matched[keep], scores[keep]
+        return matched.astype(np.int64), scores.astype(np.float32)
+
+    def top_k(self, query: str, top_k: int = 5, require_all: bool = False,
+              mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """上位k件のノード番号とスコア（スコア降順の配列）"""
+        docs, scores = self.score(query, require_all=require_all, mask=mask)
+        if len(docs) > top_k:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            docs, scores = docs[top], scores[top]
+        best = heapq.nlargest(top_k, zip(scores.tolist(), docs.tolist()))
+        return (np.array([doc for _, doc in best], dtype=np.int64),
+                np.array([score for score, _ in best], dtype=np.float32))
+
+    def search(self, query: str, top_k: int = 5, require_all: bool = False,
+               mask: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """上位k件を (ノードID, スコア) で返す"""
+        docs, scores = self.top_k(query, top_k, require_all=require_all, mask=mask)
+        return [(self.labels[doc], float(score)) for doc, score in zip(docs, scores)]
+
+    # ------------------------------------------------------------------
+    # 保存・読み込み
+    # ------------------------------------------------------------------
+
+    def save(self, path: Union[str, Path]) -> None:
+        terms = [None] * len(self.vocabulary)
+        for term, term_id in self.vocabulary.items():
+            terms[term_id] = term
+        term_blob, term_offsets = BlobStrings.encode(terms)
+        label_blob, label_offsets = BlobStrings.encode(list(self.labels))
+        np.savez(
+            path,
+            term_blob=np.frombuffer(term_blob, dtype=np.uint8), term_offsets=term_offsets,
+            label_blob=np.frombuffer(label_blob, dtype=np.uint8), label_offsets=label_offsets,
+            term_indptr=self.term_indptr, postings_doc=self.postings_doc, postings_tf=self.postings_tf,
+            doc_lengths=self.doc_lengths, params=np.array([self.k1, self.b], dtype=np.float64)
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'BM25Index':
+        with np.load(path) as npz:
+            terms = BlobStrings(npz['term_blob'].tobytes(), npz['term_offsets'])
+            labels = list(BlobStrings(npz['label_blob'].tobytes(), npz['label_offsets']))
+            k1, b = npz['params'].tolist()
+            return cls({term: i for i, term in enumerate(terms)}, npz['term_indptr'], npz['postings_doc'],
+                       npz['postings_tf'], npz['doc_lengths'], labels, k1, b)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Checkpointed RAPTOR Tree Builds
+ツリー構築のステージ別チェックポイント（再開用）
+
+保存対象:
+    corpus      PubMedから収集・レベル判定済みの文書リスト
+    embeddings  全文書の埋め込み行列（文書IDの指紋・埋め込み仕様付き）
+    subtrees    完了したクラスタのサブツリー（要約・埋め込み・クラスタリング統計を含む。
+                キーは文書ID・埋め込み仕様・クラスタリング設定から決まる）
+
+書き込みは単一ワーカースレッドで非同期に行い、ビルドを止めない。
+各ファイルのSHA-256を checkpoint.json に記録し、読み込み時に検証する
+（不一致・欠損のチェックポイントは無視して再計算する）。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from raptor_node_store import RAPTORNode
+from raptor_stream_writer import StreamingJSONTreeWriter, decode_embedding, node_record
+
+CHECKPOINT_MANIFEST = 'checkpoint.json'
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_ids(ids: Sequence[str]) -> str:
+    """ID列の指紋（順序を含む）"""
+    digest = hashlib.sha256()
+    for item in ids:
+        digest.update(str(item).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class BuildCheckpoint:
+    """ステージ単位のチェックポイント管理（非同期書き込み + 整合性検証）"""
+
+    def __init__(self, checkpoint_dir, reset: bool = False, logger: Optional[logging.Logger] = None):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.logger = logger or logging.getLogger(__name__)
+        if reset and self.checkpoint_dir.exists():
+            shutil.rmtree(self.checkpoint_dir)
+        (self.checkpoint_dir / 'subtrees').mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self._pending: List[Future] = []
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        manifest_path = self.checkpoint_dir / CHECKPOINT_MANIFEST
+        if manifest_path.exists():
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f).get('entries', {})
+
+    # ------------------------------------------------------------------
+    # 内部: 非同期書き込みとmanifest更新
+    # ------------------------------------------------------------------
+
+    def _commit(self, name: str, path: Path, meta: Dict[str, Any]) -> None:
+        """書き込み済みファイルをmanifestに登録（ワーカースレッドで実行）"""
+        entry = dict(meta)
+        entry['file'] = str(path.relative_to(self.checkpoint_dir))
+        entry['sha256'] = _sha256(path)
+        with self._lock:
+            self._entries[name] = entry
+            manifest_path = self.checkpoint_dir / CHECKPOINT_MANIFEST
+            tmp_path = manifest_path.with_suffix('.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'entries': self._entries}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, manifest_path)
+
+    def _submit(self, func, *args) -> None:
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._report_error)
+        self._pending.append(future)
+
+    def _report_error(self, future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            self.logger.warning(f"⚠️ Checkpoint write failed: {error}")
+
+    def _valid_entry(self, name: str, **expected) -> Optional[Path]:
+        """manifestの登録・SHA-256・期待メタデータを検証し、有効ならファイルパスを返す"""
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None:
+            return None
+        path = self.checkpoint_dir / entry['file']
+        if not path.exists() or _sha256(path) != entry['sha256']:
+            self.logger.warning(f"⚠️ Checkpoint '{name}' failed integrity check, recomputing")
+            return None
+        for key, value in expected.items():
+            if entry.get(key) != value:
+                self.logger.info(f"  Checkpoint '{name}' does not match current input ({key}), recomputing")
+                return None
+        return path
+
+    def wait(self) -> None:
+        """未完了の書き込みをすべて待つ"""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.exception()
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+    # ------------------------------------------------------------------
+    # ステージ1: コーパス
+    # ------------------------------------------------------------------
+
+    def save_corpus(self, documents: List[Dict[str, Any]]) -> None:
+        payload = json.dumps(documents, ensure_ascii=False, separators=(',', ':'))
+        meta = {'count': len(documents)}
+
+        def write():
+            path = self.checkpoint_dir / 'corpus.json'
+            tmp_path = path.with_suffix('.json.tmp')
+            tmp_path.write_text(payload, encoding='utf-8')
+            os.replace(tmp_path, path)
+            self._commit('corpus', path, meta)
+
+        self._submit(write)
+
+    def load_corpus(self) -> Optional[List[Dict[str, Any]]]:
+        path = self._valid_entry('corpus')
+        if path is None:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # ------------------------------------------------------------------
+    # ステージ2: 埋め込み
+    # ------------------------------------------------------------------
+
+    def save_embeddings(self, embeddings: np.ndarray, document_ids: Sequence[str],
+                        contract: Optional[Dict[str, Any]] = None) -> None:
+        """contract: 埋め込み仕様（EmbeddingContract.to_dict()）。文書IDは位置由来のため仕様も照合する"""
+        meta = {'ids': fingerprint_ids(document_ids), 'shape': list(embeddings.shape), 'contract': contract}
+
+        def write():
+            path = self.checkpoint_dir / 'embeddings.npy'
+            tmp_path = self.checkpoint_dir / 'embeddings.tmp.npy'
+            np.save(tmp_path, embeddings)
+            os.replace(tmp_path, path)
+            self._commit('embeddings', path, meta)
+
+        self._submit(write)
+
+    def load_embeddings(self, document_ids: Sequence[str],
+                        contract: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
+        path = self._valid_entry('embeddings', ids=fingerprint_ids(document_ids), contract=contract)
+        if path is None:
+            return None
+        return np.load(path)
+
+    # ------------------------------------------------------------------
+    # ステージ3: サブツリー
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def subtree_key(level: int, document_ids: Sequence[str], params: Optional[Dict[str, Any]] = None) -> str:
+        """レベル・クラスタ内文書ID・構築設定（埋め込み仕様・クラスタリング設定など）から決まるサブツリーのキー"""
+        settings = json.dumps(params or {}, sort_keys=True, ensure_ascii=False)
+        return f"L{level}_{fingerprint_ids([settings] + sorted(document_ids))[:16]}"
+
+    def save_subtree(self, key: str, nodes: Dict[str, RAPTORNode], stats: Dict[str, List]) -> None:
+        """サブツリーを保存（ノードは呼び出し時点でシリアライズし、書き込みのみ非同期）"""
+        records = [(node_id, node_record(node, embedding_encoding='b64')) for node_id, node in nodes.items()]
+        header = {'key': key, 'clustering_stats': stats}
+        meta = {'node_count': len(records)}
+
+        def write():
+            path = self.checkpoint_dir / 'subtrees' / f'{key}.json'
+            with StreamingJSONTreeWriter(path, header=header, nodes_key='nodes') as writer:
+                for node_id, record in records:
+                    writer.write_node(node_id, record)
+            self._commit(f'subtree:{key}', path, meta)
+
+        self._submit(write)
+
+    def load_subtree(self, key: str) -> Optional[Tuple[Dict[str, RAPTORNode], Dict[str, List]]]:
+        """保存済みサブツリーを復元（ノード辞書, クラスタリング統計）"""
+        path = self._valid_entry(f'subtree:{key}')
+        if path is None:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        nodes = {}
+        for node_id, info in data['nodes'].items():
+            nodes[node_id] = RAPTORNode(
+                node_id=info['node_id'],
+                parent_id=info['parent_id'],
+                children=info['children'],
+                level=info['level'],
+                content=info['content'],
+                summary=info['summary'],
+                is_leaf=info['is_leaf'],
+                cluster_id=info['cluster_id'],
+                embedding=decode_embedding(info.get('embedding')),
+                source_documents=info['source_documents'],
+                cluster_size=info['cluster_size']
+            )
+        return nodes, data.get('clustering_stats', {})
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Concurrent Search
+1プロセスで多数の同時検索（アナリストの並行クエリ）を捌くための読み取り専用インデックスとエンコーダープール
+
+- FrozenSearchIndex: SemanticSearchEngine の遅延状態（正規化行列・BM25・行対応）を構築済みにした不変スナップショット
+  - 配列はエンジンと共有（コピーなし）し、書き込み不可に設定。属性の再代入は AttributeError
+  - 元のエンジンで build_embeddings し直しても、スナップショットは読み込み時の配列を参照し続ける
+- EncoderPool: クエリエンコーダーのインスタンスを貸し出すプール
+  - HFのトークナイザー・モデルは同時呼び出しに安全ではないため、1インスタンスは同時に1スレッドのみ
+  - size=1 でエンコードを直列化（GPUでは既定で1つ）
+- ConcurrentSearchEngine: 両者の組み合わせ。どのスレッドからでも search() を呼べる
+- benchmark_threads / main: スレッド数ごとのスループット（QPS）・p50 / p99 レイテンシ
+
+行列積・FAISS・BM25のnumpy処理はGILを解放するため、スレッド数に応じてスループットが伸びる
+（結果辞書の組み立てなどPython部分は伸びない）。
+
+使用例:
+    search = ConcurrentSearchEngine.from_tree_file('results/enhanced_treg_raptor_80x_20251102_182135.json')
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda q: search.search(q, mode='hybrid', top_k=5), queries))
+
+    python raptor_concurrent_search.py results/enhanced_treg_raptor_80x_20251102_182135.json --threads 1 2 4 8
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+import numpy as np
+
+from raptor_artifact import load_tree_data
+from raptor_embedding import QueryEncoder
+from raptor_filters import NodeFilter
+from raptor_search import (
+    HYBRID_FUSION, SEARCH_MODES, SemanticSearchEngine, SentenceTransformer, load_search_engine
+)
+from raptor_vector_index import normalize_rows
+
+ENCODER_POOL_SIZE = 2  # CPUでのエンコーダー数（インスタンスごとにモデルを1つ読み込む）
+BENCHMARK_THREADS = (1, 2, 4, 8)
+BENCHMARK_REQUESTS = 200
+
+# 書き込み不可にするエンジンの配列属性
+_ENGINE_ARRAYS = ('embeddings', 'normalized_embeddings', 'missing_rows', '_keyword_rows', '_filter_rows')
+_BM25_ARRAYS = ('term_indptr', 'postings_doc', 'postings_tf', 'doc_lengths', 'idf', '_length_norm')
+
+
+def _read_only(array: Any) -> None:
+    if isinstance(array, np.ndarray) and array.flags.writeable:
+        array.setflags(write=False)
+
+
+class _ReadOnlyEngine(SemanticSearchEngine):
+    """属性の再代入を禁止したエンジン（FrozenSearchIndex の内部スナップショット）"""
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"FrozenSearchIndex is read-only (tried to set '{name}')")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"FrozenSearchIndex is read-only (tried to delete '{name}')")
+
+
+class FrozenSearchIndex:
+    """スレッド間でコピーなしに共有できる読み取り専用の検索インデックス
+
+    クエリのエンコードは行わない（semantic / hybrid は query_embeddings を渡す）。
+    """
+    __slots__ = ('_engine', '_tree_data')
+
+    def __init__(self, engine: SemanticSearchEngine, tree_data: Mapping):
+        engine.prepare(tree_data)
+        snapshot = object.__new__(_ReadOnlyEngine)
+        # 浅いコピー: 配列・インデックスは共有し、エンコーダーとタイミング記録は持たない
+        snapshot.__dict__.update(vars(engine))
+        snapshot.__dict__.update(model=None, query_encoder=None, reranker=None,
+                                 last_batch_timings={}, last_stage_timings={})
+        for name in _ENGINE_ARRAYS:
+            _read_only(getattr(snapshot, name))
+        for name in _BM25_ARRAYS:
+            _read_only(getattr(snapshot.keyword_index, name))
+        object.__setattr__(self, '_engine', snapshot)
+        object.__setattr__(self, '_tree_data', MappingProxyType(dict(tree_data)))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"FrozenSearchIndex is read-only (tried to set '{name}')")
+
+    @property
+    def node_ids(self) -> Sequence[str]:
+        return self._engine.node_ids
+
+    @property
+    def model_name(self) -> str:
+        return self._engine.model_name
+
+    @property
+    def contract(self):
+        return self._engine.contract
+
+    @property
+    def tree_data(self) -> Mapping:
+        return self._tree_data
+
+    def __len__(self) -> int:
+        return len(self._engine.node_ids)
+
+    def search_batch(self, queries: List[str], query_embeddings: Optional[np.ndarray] = None,
+                     mode: str = 'hybrid', top_k: int = 5, node_filter: Optional[NodeFilter] = None,
+                     fusion: str = HYBRID_FUSION, **kwargs) -> List[List[Dict]]:
+        """SemanticSearchEngine.search_batch と同じ結果（インデックスへの書き込みなし）"""
+        if mode != 'keyword' and query_embeddings is None:
+            raise ValueError(f"{mode} search on a FrozenSearchIndex needs query_embeddings "
+                             f"(encode them with an EncoderPool)")
+        return self._engine.search_batch(queries, self._tree_data, mode=mode, top_k=top_k,
+                                         query_embeddings=query_embeddings, node_filter=node_filter,
+                                         fusion=fusion, **kwargs)
+
+    def node(self, node_id: str) -> Dict[str, Any]:
+        return self._tree_data['tree_nodes'][node_id]
+
+    def __repr__(self) -> str:
+        return f"FrozenSearchIndex({len(self)} nodes, model={self.model_name})"
+
+
+class EncoderPool:
+    """クエリエンコーダーのプール（借りたインスタンスは返すまで他のスレッドが使わない）"""
+
+    def __init__(self, encoders: Sequence[Any], batch_size: int = 16):
+        if not encoders:
+            raise ValueError("EncoderPool needs at least one encoder")
+        self.size = len(encoders)
+        self.batch_size = batch_size
+        self._idle: 'queue.Queue[Any]' = queue.Queue()
+        for encoder in encoders:
+            self._idle.put(encoder)
+        self._stats_lock = threading.Lock()
+        self.encodes = 0
+        self.wait_seconds = 0.0  # 空きエンコーダー待ちの累計
+
+    @classmethod
+    def for_engine(cls, engine: SemanticSearchEngine, size: Optional[int] = None) -> 'EncoderPool':
+        """エンジンのエンコーダーを1つ目に使い、同じ仕様のインスタンスを size 個まで追加で読み込む
+
+        以後エンジンのエンコーダーはプール経由でのみ使うこと（engine.encode_queries と同時に呼ばない）。
+        """
+        import torch
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if size is None:
+            size = 1 if device == 'cuda' else ENCODER_POOL_SIZE  # GPUでは並列にしても速くならない
+        encoders = [engine.query_encoder if engine.query_encoder is not None else engine.model]
+        for _ in range(size - 1):
+            if engine.contract is not None:
+                encoders.append(QueryEncoder(engine.contract, device=device))
+            else:
+                encoders.append(SentenceTransformer(engine.model_name, device=device))
+        print(f"🔧 Encoder pool: {size} x {engine.model_name} ({device})")
+        return cls(encoders, batch_size=64 if device == 'cuda' else 16)
+
+    def encode(self, queries: List[str]) -> np.ndarray:
+        """空いているエンコーダーでクエリをエンコード（L2正規化済みの行）"""
+        start = time.perf_counter()
+        encoder = self._idle.get()
+        waited = time.perf_counter() - start
+        try:
+            if isinstance(encoder, QueryEncoder):
+                embeddings = encoder.encode(list(queries), batch_size=self.batch_size)
+            else:
+                embeddings = encoder.encode(list(queries), batch_size=self.batch_size, convert_to_numpy=True)
+        finally:
+            self._idle.put(encoder)
+        with self._stats_lock:
+            self.encodes += 1
+            self.wait_seconds += waited
+        return normalize_rows(embeddings)
+
+
+class ConcurrentSearchEngine:
+    """任意のスレッドから呼べる検索（FrozenSearchIndex + EncoderPool）"""
+
+    def __init__(self, index: FrozenSearchIndex, encoders: EncoderPool):
+        self.index = index
+        self.encoders = encoders
+
+    @classmethod
+    def from_engine(cls, engine: SemanticSearchEngine, tree_data: Mapping,
+                    encoder_pool_size: Optional[int] = None) -> 'ConcurrentSearchEngine':
+        return cls(FrozenSearchIndex(engine, tree_data), EncoderPool.for_engine(engine, encoder_pool_size))
+
+    @classmethod
+    def from_tree_file(cls, tree_file: Path, encoder_pool_size: Optional[int] = None) -> 'ConcurrentSearchEngine':
+        tree_file = Path(tree_file)
+        return cls.from_engine(load_search_engine(tree_file), load_tree_data(tree_file), encoder_pool_size)
+
+    def search_batch(self, queries: List[str], mode: str = 'hybrid', top_k: int = 5,
+                     node_filter: Optional[NodeFilter] = None, **kwargs) -> List[List[Dict]]:
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode} (expected one of {SEARCH_MODES})")
+        query_embeddings = None if mode == 'keyword' else self.encoders.encode(queries)
+        return self.index.search_batch(queries, query_embeddings, mode=mode, top_k=top_k,
+                                       node_filter=node_filter, **kwargs)
+
+    def search(self, query: str, mode: str = 'hybrid', top_k: int = 5,
+               node_filter: Optional[NodeFilter] = None, **kwargs) -> List[Dict]:
+        return self.search_batch([query], mode=mode, top_k=top_k, node_filter=node_filter, **kwargs)[0]
+
+
+# ============================================================================
+# 並行性ベンチマーク
+# ============================================================================
+
+def benchmark_threads(search: ConcurrentSearchEngine, queries: Sequence[str],
+                      thread_counts: Sequence[int] = BENCHMARK_THREADS, requests: int = BENCHMARK_REQUESTS,
+                      mode: str = 'hybrid', top_k: int = 5) -> List[Dict[str, float]]:
+    """1クエリずつの検索を threads 本のスレッドから同時に投げたときのスループットとレイテンシ"""
+    workload = [queries[i % len(queries)] for i in range(requests)]
+    search.search(workload[0], mode=mode, top_k=top_k)  # ウォームアップ
+
+    def timed(query: str) -> float:
+        start = time.perf_counter()
+        search.search(query, mode=mode, top_k=top_k)
+        return time.perf_counter() - start
+
+    rows = []
+    for threads in thread_counts:
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='raptor-bench') as pool:
+            start = time.perf_counter()
+            latencies = np.array(list(pool.map(timed, workload))) * 1000.0
+            elapsed = time.perf_counter() - start
+        p50, p99 = np.percentile(latencies, [50, 99])
+        rows.append({
+            'threads': threads,
+            'requests': requests,
+            'seconds': elapsed,
+            'qps': requests / elapsed,
+            'p50_ms': float(p50),
+            'p99_ms': float(p99)
+        })
+    for row in rows:
+        row['speedup'] = row['qps'] / rows[0]['qps']
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent search throughput over a frozen RAPTOR index")
+    parser.add_argument('tree', help='tree (JSON or .raptor)')
+    parser.add_argument('--threads', type=int, nargs='+', default=list(BENCHMARK_THREADS))
+    parser.add_argument('--requests', type=int, default=BENCHMARK_REQUESTS, help='queries per thread count')
+    parser.add_argument('--mode', default='hybrid', choices=SEARCH_MODES)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--encoders', type=int, default=None, help='encoder pool size (default: 1 on GPU)')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    args = parser.parse_args()
+
+    from test_raptor_semantic_search import TEST_QUERIES  # 比較テストと同じクエリ
+
+    search = ConcurrentSearchEngine.from_tree_file(Path(args.tree), encoder_pool_size=args.encoders)
+    print(f"🧊 {search.index}")
+    print(f"\n⚡ Concurrency benchmark: {args.requests} {args.mode} queries per run")
+    rows = benchmark_threads(search, TEST_QUERIES, args.threads, args.requests, args.mode, args.top_k)
+    print(f"  {'threads':>7} {'QPS':>9} {'speedup':>8} {'p50':>9} {'p99':>9}")
+    for row in rows:
+        print(f"  {row['threads']:>7} {row['qps']:>9.1f} {row['speedup']:>7.2f}x "
+              f"{row['p50_ms']:>7.1f}ms {row['p99_ms']:>7.1f}ms")
+    print(f"  encoder wait: {search.encoders.wait_seconds:.2f}s over {search.encoders.encodes} encodes "
+          f"({search.encoders.size} encoders)")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'tree': Path(args.tree).name,
+                'mode': args.mode,
+                'encoders': search.encoders.size,
+                'timestamp': datetime.now().isoformat(),
+                'runs': rows
+            }, f, indent=2)
+        print(f"\n💾 Results saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Content-Addressable Document Store
+PMID / 文書ID をキーとする圧縮ドキュメントストア（ランダムアクセス対応）
+
+- 本文はSHA-256で重複排除（同一内容は1回だけ保存）
+- 固定サイズのブロック（既定64KB）単位でzstd圧縮（zstandard未インストール時はzlib）
+- オフセット索引により、コーパス全体を読み込まずに1件単位で取得できる
+
+ディレクトリ構成:
+    blocks.bin   圧縮ブロックの連結
+    blocks.idx   ブロック索引（offset, 圧縮長, 元の長さ）のバイナリ配列
+    index.tsv    key <TAB> sha256 / sha256 <TAB> block <TAB> offset <TAB> length の追記ログ
+                 （改行で終わり、書き込み済みブロック・登録済みハッシュを指す行のみ有効。
+                 書き込み途中で終了した末尾は追記モードで開くときに切り詰める）
+    store.json   コーデック・ブロックサイズ等の設定
+    store.lock   追記モードの排他ロック（書き込みは同時に1プロセスのみ、読み込みはロック不要）
+"""
+
+import hashlib
+import json
+import mmap
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # 任意依存: 未インストール時はzlibで圧縮
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: プロセス間の書き込みロックなし
+    fcntl = None
+
+STORE_FORMAT = 'raptor-docstore'
+STORE_VERSION = 1
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+_BLOCK_DTYPE = np.dtype([('offset', '<u8'), ('clen', '<u4'), ('ulen', '<u4')])
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class _Codec:
+    """ブロック圧縮コーデック（zstd / zlib）"""
+
+    def __init__(self, name: str, level: int):
+        self.name = name
+        if name == 'zstd':
+            if zstandard is None:
+                raise ImportError("This document store uses zstd; install it with: pip install zstandard")
+            self._compressor = zstandard.ZstdCompressor(level=level)
+            self._decompressor = zstandard.ZstdDecompressor()
+        elif name == 'zlib':
+            self._level = level
+        else:
+            raise ValueError(f"Unknown codec: {name}")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.name == 'zstd':
+            return self._compressor.compress(data)
+        return zlib.compress(data, self._level)
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        if self.name == 'zstd':
+            return self._decompressor.decompress(data, max_output_size=size)
+        return zlib.decompress(data)
+
+
+class DocumentStore:
+    """キー（PMID・文書ID）→ 本文 の内容アドレス型圧縮ストア
+
+    使用例:
+        with DocumentStore('pubmed_cache/documents.docstore', mode='a') as store:
+            store.put('text:12345678', text)
+        text = DocumentStore('pubmed_cache/documents.docstore').get('text:12345678')
+    """
+
+    def __init__(self, path: Union[str, Path], mode: str = 'r', block_size: int = DEFAULT_BLOCK_SIZE,
+                 codec: Optional[str] = None, level: int = 3, cache_blocks: int = 32):
+        if mode not in ('r', 'a'):
+            raise ValueError("mode must be 'r' (read-only) or 'a' (append)")
+        self.path = Path(path)
+        self.mode = mode
+        self._lock = threading.RLock()
+        self._cache: "OrderedDict[int, bytes]" = OrderedDict()
+        self._cache_blocks = cache_blocks
+        self._lock_file = None
+        if mode == 'a':
+            # 索引・ブロック数を読み込む前にロックする（他のビルドの追記と混ざらないように）
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._acquire_write_lock()
+
+        config_path = self.path / 'store.json'
+        if config_path.exists():
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            if config.get('format') != STORE_FORMAT:
+                raise ValueError(f"Not a document store: {self.path}")
+        elif mode == 'a':
+            config = {
+                'format': STORE_FORMAT,
+                'version': STORE_VERSION,
+                'codec': codec or ('zstd' if zstandard is not None else 'zlib'),
+                'block_size': block_size,
+                'level': level
+            }
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=2)
+            for name in ('blocks.bin', 'blocks.idx', 'index.tsv'):
+                (self.path / name).touch()
+        else:
+            raise FileNotFoundError(f"Document store not found: {self.path}")
+
+        self.config = config
+        self.block_size = int(config['block_size'])
+        self._codec = _Codec(config['codec'], int(config.get('level', level)))
+
+        # 索引の読み込み（ブロック索引 → 本文・キー索引の順）
+        self._blocks = self._load_blocks()
+        self._keys: Dict[str, str] = {}
+        self._entries: Dict[str, Tuple[int, int, int]] = {}
+        self._load_index()
+        self._block_map = None
+
+        # 書き込み中のブロック（未圧縮）
+        self._pending = bytearray()
+        self._pending_lines: List[str] = []
+        self._index_file = open(self.path / 'index.tsv', 'a', encoding='utf-8') if mode == 'a' else None
+
+    def _acquire_write_lock(self) -> None:
+        """追記モードの排他ロック（他のプロセスが追記中なら開かない）"""
+        if fcntl is None:
+            return
+        self._lock_file = open(self.path / 'store.lock', 'a')
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"Document store is already open for writing by another process: {self.path}")
+
+    def _load_blocks(self) -> np.ndarray:
+        """ブロック索引（途中まで書かれた末尾のレコードは無視し、追記モードでは切り詰める）"""
+        idx_path = self.path / 'blocks.idx'
+        size = idx_path.stat().st_size
+        complete = size - size % _BLOCK_DTYPE.itemsize
+        if complete != size and self.mode == 'a':
+            with open(idx_path, 'r+b') as f:
+                f.truncate(complete)
+        return np.fromfile(idx_path, dtype=_BLOCK_DTYPE, count=complete // _BLOCK_DTYPE.itemsize)
+
+    def _parse_index_line(self, line: bytes) -> bool:
+        """索引1行を検証して登録（不完全・不正な行は False）"""
+        try:
+            parts = line.decode('utf-8').split('\t')
+        except UnicodeDecodeError:
+            return False
+        if len(parts) == 2:
+            key, digest = parts
+            if not _DIGEST.fullmatch(digest) or digest not in self._entries:
+                return False
+            self._keys[key] = digest
+            return True
+        if len(parts) == 4 and _DIGEST.fullmatch(parts[0]) and all(p.isdigit() for p in parts[1:]):
+            block, offset, length = (int(p) for p in parts[1:])
+            if block >= len(self._blocks) or offset + length > int(self._blocks[block]['ulen']):
+                return False  # 索引より先に書くブロック本体が確定していない
+            self._entries[parts[0]] = (block, offset, length)
+            return True
+        return False
+
+    def _load_index(self) -> None:
+        """索引の追記ログを読み込む（改行で終わる有効な行のみ。末尾の書きかけは追記モードで切り詰める）"""
+        index_path = self.path / 'index.tsv'
+        data = index_path.read_bytes()
+        valid_end = 0
+        start = 0
+        while start < len(data):
+            end = data.find(b'\n', start)
+            if end < 0:
+                break  # 改行のない末尾（書き込み途中で終了）
+            if self._parse_index_line(data[start:end]):
+                valid_end = end + 1
+            start = end + 1
+        if valid_end < len(data) and self.mode == 'a':
+            with open(index_path, 'r+b') as f:
+                f.truncate(valid_end)
+
+    # ------------------------------------------------------------------
+    # 書き込み
+    # ------------------------------------------------------------------
+
+    def put(self, key: str, text: str) -> str:
+        """本文を保存しキーを割り当てる（同一内容は再保存しない）。SHA-256を返す"""
+        if self.mode != 'a':
+            raise PermissionError("Document store is opened read-only")
+        digest = content_hash(text)
+        with self._lock:
+            if digest not in self._entries:
+                data = text.encode('utf-8')
+                block = len(self._blocks)
+                self._entries[digest] = (block, len(self._pending), len(data))
+                self._pending.extend(data)
+                self._pending_lines.append(f"{digest}\t{block}\t{self._entries[digest][1]}\t{len(data)}\n")
+            if self._keys.get(key) != digest:
+                self._keys[key] = digest
+                self._pending_lines.append(f"{key}\t{digest}\n")
+            if len(self._pending) >= self.block_size:
+                self._flush_block()
+        return digest
+
+    def put_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        for key, text in items:
+            self.put(key, text)
+
+    def _flush_block(self) -> None:
+        """未圧縮ブロックを圧縮して追記し、索引行を書き出す"""
+        if self._pending:
+            raw = bytes(self._pending)
+            compressed = self._codec.compress(raw)
+            blocks_path = self.path / 'blocks.bin'
+            offset = blocks_path.stat().st_size
+            with open(blocks_path, 'ab') as f:
+                f.write(compressed)
+            entry = np.array([(offset, len(compressed), len(raw))], dtype=_BLOCK_DTYPE)
+            with open(self.path / 'blocks.idx', 'ab') as f:
+                f.write(entry.tobytes())
+            self._blocks = np.concatenate([self._blocks, entry])
+            self._block_map = None
+            self._pending = bytearray()
+        if self._pending_lines:
+            # ブロック本体を書いた後に索引を書く（途中終了時に未完ブロックを参照しない）
+            self._index_file.writelines(self._pending_lines)
+            self._index_file.flush()
+            self._pending_lines = []
+
+    def flush(self) -> None:
+        """書き込み中のブロックを確定"""
+        if self.mode == 'a':
+            with self._lock:
+                self._flush_block()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._index_file is not None:
+                self._index_file.close()
+                self._index_file = None
+            if self._block_map is not None:
+                self._block_map.close()
+                self._block_map = None
+            if self._lock_file is not None:
+                self._lock_file.close()  # ロックも解放される
+                self._lock_file = None
+
+    def __enter__(self) -> 'DocumentStore':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.close()
+        return False
+
+    # ------------------------------------------------------------------
+    # 読み出し
+    # ------------------------------------------------------------------
+
+    def _read_block(self, block: int) -> bytes:
+        cached = self._cache.get(block)
+        if cached is not None:
+            self._cache.move_to_end(block)
+            return cached
+        if block == len(self._blocks):
+            return bytes(self._pending)
+        offset, clen, ulen = self._blocks[block]
+        if self._block_map is None or len(self._block_map) < offset + clen:
+            if self._block_map is not None:
+                self._block_map.close()
+            with open(self.path / 'blocks.bin', 'rb') as f:
+                self._block_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        raw = self._codec.decompress(self._block_map[int(offset):int(offset) + int(clen)], int(ulen))
+        self._cache[block] = raw
+        if len(self._cache) > self._cache_blocks:
+            self._cache.popitem(last=False)
+        return raw
+
+    def get_by_hash(self, digest: str) -> str:
+        with self._lock:
+            block, offset, length = self._entries[digest]
+            raw = self._read_block(block)
+        return raw[offset:offset + length].decode('utf-8')
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """キーに対応する本文（未登録はdefault）"""
+        digest = self._keys.get(key)
+        if digest is None:
+            return default
+        return self.get_by_hash(digest)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Optional[str]]:
+        """複数キーをブロック順にまとめて取得"""
+        keys = list(keys)
+        order = sorted(
+            (k for k in keys if k in self._keys),
+            key=lambda k: self._entries[self._keys[k]][:2]
+        )
+        found = {k: self.get(k) for k in order}
+        return {k: found.get(k) for k in keys}
+
+    def hash_of(self, key: str) -> Optional[str]:
+        return self._keys.get(key)
+
+    def __getitem__(self, key: str) -> str:
+        text = self.get(key)
+        if text is None:
+            raise KeyError(key)
+        return text
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def keys(self) -> Iterator[str]:
+        return iter(list(self._keys))
+
+    def stats(self) -> Dict[str, Union[int, float, str]]:
+        """保存統計（キー数・ユニーク本文数・圧縮率）"""
+        raw = int(self._blocks['ulen'].sum()) + len(self._pending)
+        compressed = int(self._blocks['clen'].sum())
+        return {
+            'keys': len(self._keys),
+            'unique_texts': len(self._entries),
+            'blocks': len(self._blocks),
+            'codec': self._codec.name,
+            'raw_bytes': raw,
+            'compressed_bytes': compressed,
+            'ratio': (raw / compressed) if compressed else 0.0
+        }
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Embedding Contract
+ツリー埋め込みの仕様（モデル・プーリング・正規化）と、それに一致するクエリエンコーダー
+
+ビルド時（TrueRAPTORTree.encode_text）と検索時のクエリで同じ仕様を使うため、
+仕様はツリーのメタデータ（'embedding'）に記録する:
+
+    {"model": "sentence-transformers/all-MiniLM-L6-v2", "pooling": "cls",
+     "normalize": false, "max_length": 512, "dim": 384}
+
+検索側は保存済みの埋め込み行列をそのまま使い、クエリだけを QueryEncoder でエンコードする。
+
+埋め込みキャッシュ（検索時に再エンコードする場合）:
+    embeddings_*.npy   float32行列（pickleなし、mmapで開く）
+    embeddings_*.json  ノードID・件数・次元・エンコーダー設定・フィンガープリント
+フィンガープリントはエンコーダー設定と全ノードの (ID, テキスト) のSHA-256で、
+読み込み時に一致しなければキャッシュを使わない。
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+try:
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+except ImportError:  # 任意依存: クエリのエンコード時にのみ必要
+    torch = None
+
+METADATA_KEY = 'embedding'
+CACHE_VERSION = 1
+POOLING_MODES = ('cls', 'mean')
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+@dataclass(frozen=True)
+class EmbeddingContract:
+    """埋め込みの仕様（ツリーのメタデータに保存）"""
+    model: str = DEFAULT_MODEL
+    pooling: str = 'cls'
+    normalize: bool = False
+    max_length: int = 512
+    dim: int = 0
+
+    def __post_init__(self):
+        if self.pooling not in POOLING_MODES:
+            raise ValueError(f"Unknown pooling: {self.pooling} (expected one of {POOLING_MODES})")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict[str, Any]) -> 'EmbeddingContract':
+        """メタデータから仕様を復元（'embedding' がない旧ツリーはビルダーの既定値: CLS・非正規化）"""
+        spec = metadata.get(METADATA_KEY)
+        if spec:
+            return cls(**{key: spec[key] for key in cls.__dataclass_fields__ if key in spec})
+        return cls(model=metadata.get('embedding_model', DEFAULT_MODEL))
+
+    def matches(self, other: 'EmbeddingContract') -> bool:
+        """同じベクトル空間か（次元は片方が未記録なら比較しない）"""
+        same_dim = not self.dim or not other.dim or self.dim == other.dim
+        return (self.model, self.pooling, self.normalize) == (other.model, other.pooling, other.normalize) and same_dim
+
+
+def pool_hidden_states(last_hidden_state, attention_mask, pooling: str):
+    """Transformerの出力を仕様のプーリングで1ベクトルにまとめる（torchテンソル）"""
+    if pooling == 'cls':
+        return last_hidden_state[:, 0, :]
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    return (last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+
+
+class QueryEncoder:
+    """仕様に一致するクエリエンコーダー（ツリーと同じモデル・プーリング・正規化）"""
+
+    def __init__(self, contract: EmbeddingContract, device: Optional[str] = None):
+        if torch is None:
+            raise ImportError("Query encoding requires torch and transformers; "
+                              "install them with: pip install torch transformers")
+        self.contract = contract
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.tokenizer = AutoTokenizer.from_pretrained(contract.model)
+        self.model = AutoModel.from_pretrained(contract.model).to(self.device)
+        self.model.eval()
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        """テキスト列を (n, dim) のfloat32行列にエンコード"""
+        batches: List[np.ndarray] = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                list(texts[start:start + batch_size]),
+                return_tensors="pt",
+                truncation=True,
+                padding=True,
+                max_length=self.contract.max_length
+            ).to(self.device)
+            with torch.no_grad():
+                outputs = self.model(**inputs)
+                pooled = pool_hidden_states(outputs.last_hidden_state, inputs['attention_mask'],
+                                            self.contract.pooling)
+                if self.contract.normalize:
+                    pooled = torch.nn.functional.normalize(pooled, dim=-1)
+            batches.append(pooled.cpu().numpy().astype(np.float32))
+        dim = self.model.config.hidden_size
+        return np.concatenate(batches) if batches else np.zeros((0, dim), dtype=np.float32)
+
+
+# ============================================================================
+# 埋め込みキャッシュ（.npy + JSONサイドカー）
+# ============================================================================
+
+def embedding_fingerprint(items: Iterable[Tuple[str, str]], encoder_config: Dict[str, Any]) -> str:
+    """エンコーダー設定と (ノードID, テキスト) 列のSHA-256"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION, 'encoder': encoder_config}, sort_keys=True).encode('utf-8'))
+    for node_id, text in items:
+        digest.update(node_id.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def cache_sidecar_path(cache_file: Union[str, Path]) -> Path:
+    return Path(cache_file).with_suffix('.json')
+
+
+def save_embedding_cache(cache_file: Union[str, Path], embeddings: np.ndarray, ids: Sequence[str],
+                         fingerprint: str, encoder_config: Dict[str, Any]) -> Path:
+    """行列（.npy）→ サイドカー（.json）の順に一時ファイル経由で書き出す（サイドカーが完了の印）"""
+    cache_file = Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if len(ids) != len(matrix):
+        raise ValueError(f"ids ({len(ids)}) and embeddings ({len(matrix)}) differ in length")
+
+    sidecar = cache_sidecar_path(cache_file)
+    if sidecar.exists():
+        sidecar.unlink()  # 書き込み中に古いサイドカーと新しい行列が組み合わさらないように
+    tmp_matrix = cache_file.with_name(cache_file.name + f'.tmp-{os.getpid()}')
+    with open(tmp_matrix, 'wb') as f:
+        np.save(f, matrix, allow_pickle=False)
+    os.replace(tmp_matrix, cache_file)
+
+    tmp_sidecar = sidecar.with_name(sidecar.name + f'.tmp-{os.getpid()}')
+    with open(tmp_sidecar, 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'fingerprint': fingerprint,
+            'encoder': encoder_config,
+            'count': int(matrix.shape[0]),
+            'dim': int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            'ids': list(ids),
+        }, f, ensure_ascii=False)
+    os.replace(tmp_sidecar, sidecar)
+    return cache_file
+
+
+def load_embedding_cache(cache_file: Union[str, Path], fingerprint: str,
+                         mmap: bool = True) -> Optional[Tuple[np.ndarray, List[str]]]:
+    """フィンガープリントが一致すれば (行列, ノードID列) を返す。不一致・破損・旧形式は None"""
+    cache_file = Path(cache_file)
+    sidecar = cache_sidecar_path(cache_file)
+    if not cache_file.exists() or not sidecar.exists():
+        return None
+    try:
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if info.get('version') != CACHE_VERSION or info.get('fingerprint') != fingerprint:
+            return None
+        matrix = np.load(cache_file, mmap_mode='r' if mmap else None, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+    if matrix.ndim != 2 or matrix.shape != (info['count'], info['dim']) or len(info['ids']) != info['count']:
+        return None
+    return matrix, info['ids']
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Node Filters
+レベル・リーフ/要約・Treg分化段階・サブツリーによる検索フィルタ（ノード序数上のブールマスク）
+
+FilterIndex は条件ごとのマスクを事前計算（サブツリーは初回のみ計算してキャッシュ）し、
+フィルタは & / | / ~ で組み合わせる。マスクは検索のスコアリング時に適用され、
+対象ノードだけをスコアリングするため、絞り込むほど検索コストは小さくなる。
+
+使用例:
+    from raptor_filters import FilterIndex, level, leaves, summaries, treg_stage, subtree
+
+    filters = FilterIndex.from_artifact(artifact, documents)
+    mask = filters.mask(leaves() & treg_stage(5))                     # Foxp3+ Tregの文書のみ
+    mask = filters.mask(summaries() & subtree('raptor_L0_C3_1730612345'))
+    mask = filters.mask(level(1, 2) | treg_stage(6))
+
+Treg段階（enhanced_treg_vocab.determine_treg_level, 0-6）はリーフは文書の判定レベル、
+内部ノードは配下の文書で最も多い段階とする。
+"""
+
+from collections import OrderedDict
+import threading
+from typing import Any, Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+from raptor_node_store import RAPTORNodeStore
+from raptor_tree_index import TreeIndex
+
+TREG_STAGES = tuple(range(7))
+UNKNOWN_STAGE = -1
+
+
+# ============================================================================
+# フィルタ式
+# ============================================================================
+
+class NodeFilter:
+    """フィルタ式の基底クラス（& / | / ~ で組み合わせ可能）"""
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        raise NotImplementedError
+
+    def __and__(self, other: 'NodeFilter') -> 'NodeFilter':
+        return _Combined('and', self, other)
+
+    def __or__(self, other: 'NodeFilter') -> 'NodeFilter':
+        return _Combined('or', self, other)
+
+    def __invert__(self) -> 'NodeFilter':
+        return _Not(self)
+
+
+class _Combined(NodeFilter):
+    def __init__(self, op: str, left: NodeFilter, right: NodeFilter):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        left = index.mask(self.left)
+        right = index.mask(self.right)
+        return (left & right) if self.op == 'and' else (left | right)
+
+    def __repr__(self) -> str:
+        return f"({self.left!r} {'&' if self.op == 'and' else '|'} {self.right!r})"
+
+
+class _Not(NodeFilter):
+    def __init__(self, inner: NodeFilter):
+        self.inner = inner
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        return ~index.mask(self.inner)
+
+    def __repr__(self) -> str:
+        return f"~{self.inner!r}"
+
+
+class LevelFilter(NodeFilter):
+    def __init__(self, levels: Iterable[int]):
+        self.levels = tuple(sorted(set(int(level) for level in levels)))
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        return index.any_of(index.level_masks, self.levels)
+
+    def __repr__(self) -> str:
+        return f"level{self.levels}"
+
+
+class LeafFilter(NodeFilter):
+    def __init__(self, is_leaf: bool = True):
+        self.is_leaf = bool(is_leaf)
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        return index.leaf_mask if self.is_leaf else ~index.leaf_mask
+
+    def __repr__(self) -> str:
+        return 'leaves' if self.is_leaf else 'summaries'
+
+
+class TregStageFilter(NodeFilter):
+    def __init__(self, stages: Iterable[int]):
+        self.stages = tuple(sorted(set(int(stage) for stage in stages)))
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        return index.any_of(index.stage_masks, self.stages)
+
+    def __repr__(self) -> str:
+        return f"treg_stage{self.stages}"
+
+
+class SubtreeFilter(NodeFilter):
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+
+    def evaluate(self, index: 'FilterIndex') -> np.ndarray:
+        return index.subtree_mask(self.node_id)
+
+    def __repr__(self) -> str:
+        return f"subtree({self.node_id!r})"
+
+
+def level(*levels: int) -> NodeFilter:
+    """指定レベルのノード"""
+    return LevelFilter(levels)
+
+
+def leaves() -> NodeFilter:
+    """リーフ（文書）のみ"""
+    return LeafFilter(True)
+
+
+def summaries() -> NodeFilter:
+    """内部ノード（要約）のみ"""
+    return LeafFilter(False)
+
+
+def treg_stage(*stages: int) -> NodeFilter:
+    """Treg分化段階（0-6）"""
+    return TregStageFilter(stages)
+
+
+def subtree(node_id: str) -> NodeFilter:
+    """指定ノード配下（自身を含む）"""
+    return SubtreeFilter(node_id)
+
+
+def filter_from_spec(spec: Optional[Dict[str, Any]]) -> Optional[NodeFilter]:
+    """JSON形式のフィルタ指定（条件はすべてAND）をフィルタ式に変換
+
+    {"level": [1, 2], "leaf": true, "treg_stage": [5, 6], "subtree": "raptor_L0_C3_1730612345"}
+    """
+    if not spec:
+        return None
+    unknown = set(spec) - {'level', 'leaf', 'treg_stage', 'subtree'}
+    if unknown:
+        raise ValueError(f"Unknown filter keys: {sorted(unknown)}")
+    as_list = lambda value: value if isinstance(value, (list, tuple)) else [value]
+    parts = []
+    if 'level' in spec:
+        parts.append(level(*as_list(spec['level'])))
+    if 'leaf' in spec:
+        parts.append(LeafFilter(bool(spec['leaf'])))
+    if 'treg_stage' in spec:
+        parts.append(treg_stage(*as_list(spec['treg_stage'])))
+    if 'subtree' in spec:
+        parts.append(subtree(str(spec['subtree'])))
+    node_filter = parts[0]
+    for part in parts[1:]:
+        node_filter = node_filter & part
+    return node_filter
+
+
+# ============================================================================
+# 事前計算マスク
+# ============================================================================
+
+class FilterIndex:
+    """ノード序数上の条件マスク（レベル・リーフ・Treg段階は構築時、サブツリーは初回アクセス時）"""
+
+    def __init__(self, store: RAPTORNodeStore, tree_index: Optional[TreeIndex] = None,
+                 leaf_stages: Optional[Dict[str, int]] = None, subtree_cache_size: int = 64):
+        self.store = store
+        self.tree_index = tree_index or TreeIndex.from_store(store)
+        n = len(store)
+        levels = store.levels
+        self.leaf_mask = store.is_leaf_mask.copy()
+        self.level_masks: Dict[int, np.ndarray] = {int(v): levels == v for v in np.unique(levels)}
+        self.stages = self._node_stages(leaf_stages or {})
+        self.stage_masks: Dict[int, np.ndarray] = {
+            int(v): self.stages == v for v in np.unique(self.stages) if v != UNKNOWN_STAGE
+        }
+        self._empty = np.zeros(n, dtype=bool)
+        self._subtree_cache: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._subtree_cache_size = subtree_cache_size
+        self._subtree_lock = threading.Lock()  # 検索スレッド間で共有されるLRU
+
+    def _node_stages(self, leaf_stages: Dict[str, int]) -> np.ndarray:
+        """リーフは文書の段階、内部ノードは配下の文書で最多の段階（不明は -1）"""
+        store, index = self.store, self.tree_index
+        stages = np.full(len(store), UNKNOWN_STAGE, dtype=np.int8)
+        for node_id, stage in leaf_stages.items():
+            if node_id in store and stage is not None:
+                stages[store.ordinal(node_id)] = int(stage)
+
+        leaf_stage = stages[index.leaf_order]
+        for ordinal in np.flatnonzero(~store.is_leaf_mask):
+            under = leaf_stage[index.leaf_start[ordinal]:index.leaf_end[ordinal]]
+            under = under[under >= 0]
+            if len(under):
+                stages[ordinal] = int(np.bincount(under).argmax())
+        return stages
+
+    @classmethod
+    def from_artifact(cls, artifact, documents: Optional[Sequence[Dict[str, Any]]] = None,
+                      classify_missing: bool = False) -> 'FilterIndex':
+        """アーティファクトから構築
+
+        Treg段階の取得順: documents（treg_documents_80x_*.json の determined_level）
+        → ツリーメタデータの doc_ids + doc_levels → classify_missing=True なら本文を判定
+        """
+        return cls(artifact.store, artifact.tree_index,
+                   leaf_stages_for(artifact.store, artifact.metadata, documents, classify_missing))
+
+    # ------------------------------------------------------------------
+    # 評価
+    # ------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def any_of(self, masks: Dict[int, np.ndarray], keys: Sequence[int]) -> np.ndarray:
+        present = [masks[key] for key in keys if key in masks]
+        if not present:
+            return self._empty
+        if len(present) == 1:
+            return present[0]
+        return np.logical_or.reduce(present)
+
+    def subtree_mask(self, node_id: str) -> np.ndarray:
+        with self._subtree_lock:
+            mask = self._subtree_cache.get(node_id)
+            if mask is not None:
+                self._subtree_cache.move_to_end(node_id)
+                return mask
+        if node_id not in self.store:
+            raise KeyError(f"Unknown node: {node_id}")
+        mask = self.tree_index.descendant_mask(self.store.ordinal(node_id))
+        with self._subtree_lock:
+            self._subtree_cache[node_id] = mask
+            if len(self._subtree_cache) > self._subtree_cache_size:
+                self._subtree_cache.popitem(last=False)
+        return mask
+
+    def mask(self, node_filter: Optional[NodeFilter]) -> Optional[np.ndarray]:
+        """フィルタ式をブールマスクに評価（None はフィルタなし）。戻り値は変更しないこと"""
+        if node_filter is None:
+            return None
+        return node_filter.evaluate(self)
+
+    def ordinals(self, node_filter: NodeFilter) -> np.ndarray:
+        """フィルタに一致するノード序数"""
+        return np.flatnonzero(self.mask(node_filter))
+
+
+def leaf_stages_for(store: RAPTORNodeStore, metadata: Dict[str, Any],
+                    documents: Optional[Sequence[Dict[str, Any]]] = None,
+                    classify_missing: bool = False) -> Dict[str, int]:
+    """リーフ（文書ID）→ Treg段階
+
+    doc_levels は構築時の文書順（Level 0 のサンプリング後は doc_{i} の番号順ではない）。
+    doc_ids のない旧メタデータでは、同じ順で追加されたリーフの並びに対応付ける。
+    """
+    if documents:
+        return {doc['id']: doc.get('determined_level') for doc in documents}
+    doc_levels = metadata.get('doc_levels')
+    if doc_levels:
+        doc_ids = metadata.get('doc_ids')
+        if doc_ids is not None:
+            if len(doc_ids) != len(doc_levels):
+                raise ValueError(f"doc_ids ({len(doc_ids)}) and doc_levels ({len(doc_levels)}) differ in length")
+            return dict(zip(doc_ids, doc_levels))
+        leaf_ids = [store.node_id(int(o)) for o in np.flatnonzero(store.is_leaf_mask)]
+        if len(leaf_ids) == len(doc_levels):
+            return dict(zip(leaf_ids, doc_levels))
+    if classify_missing:
+        from enhanced_treg_vocab import determine_treg_level
+        leaf_ids = np.flatnonzero(store.is_leaf_mask)
+        return {store.node_id(int(o)): determine_treg_level(store.view(int(o)).content) for o in leaf_ids}
+    return {}
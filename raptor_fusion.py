@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Score Fusion
+複数リトリーバー（BM25・ベクトル検索など）の候補をノード序数で揃えた密配列上で統合する
+
+手法:
+    rrf      Reciprocal Rank Fusion: Σ w / (rrf_k + rank)（スコアの尺度に依存しない）
+    minmax   候補内で [0, 1] に正規化した重み付き和
+    zscore   候補内で平均0・分散1に正規化した重み付き和
+
+各リトリーバーの候補は (ordinals, scores) の配列（スコア降順、深さは呼び出し側で指定）。
+あるリトリーバーの候補に入らなかったノードは、rrf では寄与0、minmax / zscore では
+そのリトリーバーの候補内最低値として扱う（0点扱いで不当に沈めない）。
+"""
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+FUSION_METHODS = ('rrf', 'minmax', 'zscore')
+RRF_K = 60
+
+Run = Tuple[np.ndarray, np.ndarray]  # (ordinals, scores) スコア降順
+
+
+def normalize_scores(scores: np.ndarray, method: str) -> np.ndarray:
+    """候補スコアの正規化（minmax: [0,1]、zscore: 平均0・分散1、定数列はすべて1 / 0）"""
+    scores = np.asarray(scores, dtype=np.float64)
+    if not len(scores):
+        return scores
+    if method == 'minmax':
+        low, high = scores.min(), scores.max()
+        return (scores - low) / (high - low) if high > low else np.ones_like(scores)
+    if method == 'zscore':
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+    raise ValueError(f"Unknown normalization: {method}")
+
+
+def reciprocal_ranks(count: int, rrf_k: int = RRF_K) -> np.ndarray:
+    """順位 1..count の RRF 寄与 1 / (rrf_k + rank)"""
+    return 1.0 / (rrf_k + np.arange(1, count + 1, dtype=np.float64))
+
+
+def _drop_duplicates(ordinals: np.ndarray, scores: np.ndarray) -> Run:
+    """同じノードが複数回あれば最初（最上位）のみ残す"""
+    _, first = np.unique(ordinals, return_index=True)
+    if len(first) == len(ordinals):
+        return ordinals, scores
+    first.sort()
+    return ordinals[first], scores[first]
+
+
+def fuse_runs(runs: Dict[str, Run], n_nodes: int, method: str = 'rrf',
+              weights: Optional[Dict[str, float]] = None, top_k: int = 10,
+              rrf_k: int = RRF_K) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    """リトリーバーごとの候補を統合し、上位 top_k 件を返す
+
+    Returns:
+        (ordinals, fused_scores, components)
+        components[name] は各上位ノードの正規化済み寄与（rrf では 1/(rrf_k+rank)、候補外は0）
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method} (expected one of {FUSION_METHODS})")
+    weights = weights or {}
+    fused = np.zeros(n_nodes, dtype=np.float64)
+    in_union = np.zeros(n_nodes, dtype=bool)
+    dense: Dict[str, np.ndarray] = {}
+
+    for name, (ordinals, scores) in runs.items():
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float64)
+        valid = (ordinals >= 0) & np.isfinite(scores)
+        ordinals, scores = _drop_duplicates(ordinals[valid], scores[valid])
+        if method == 'rrf':
+            # 入力はスコア降順とは限らないため順位を付け直す
+            order = np.argsort(-scores, kind='stable')
+            ordinals = ordinals[order]
+            values = reciprocal_ranks(len(ordinals), rrf_k)
+            floor = 0.0
+        else:
+            values = normalize_scores(scores, method)
+            floor = float(values.min()) if len(values) else 0.0
+
+        component = np.full(n_nodes, floor, dtype=np.float64)
+        component[ordinals] = values
+        dense[name] = component
+        in_union[ordinals] = True
+
+    candidates = np.flatnonzero(in_union)
+    if not len(candidates):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), {name: np.zeros(0) for name in runs}
+    for name, component in dense.items():
+        fused[candidates] += weights.get(name, 1.0) * component[candidates]
+
+    scores = fused[candidates]
+    if len(candidates) > top_k:
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates, scores = candidates[top], scores[top]
+    order = np.argsort(-scores, kind='stable')
+    candidates, scores = candidates[order], scores[order]
+    components = {name: component[candidates] for name, component in dense.items()}
+    return candidates, scores, components
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Index Manager
+長時間動く検索プロセス向けのバージョン付きインデックス読み込み（再起動なしで新しいビルドに切り替える）
+
+- results/ を監視し、新しい enhanced_treg_raptor_80x_<timestamp>.json が現れたら
+  バックグラウンドスレッドで読み込み（.raptor があればmmap）・ウォームアップしてから切り替える
+- 切り替えは参照の差し替え1回（ロック内）。検索は acquire() で現在の版を参照カウント付きで借り、
+  実行中の検索は古い版のまま完了する。古い版は最後の参照が返った時点で解放（mmap・FAISS・BM25）
+- ビルドはJSON → .raptor の順に書き出されるため、.raptor が揃うか、JSONのみの場合は
+  最終更新から settle_seconds 経過するまで読み込まない。読み込みに失敗した版は現在の版を維持する
+
+使用例:
+    manager = IndexManager('results')
+    manager.load_latest()
+    manager.start_watching(poll_interval=5.0)
+
+    with manager.acquire() as version:      # 検索中は version が解放されない
+        version.engine.search_batch(queries, version.tree_data, mode='hybrid')
+
+    python raptor_query_server.py --watch results/   # 検索サーバーで自動切り替え
+"""
+
+import gc
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from raptor_artifact import artifact_path_for, is_artifact, load_tree_data
+from raptor_search import SemanticSearchEngine, load_search_engine
+
+TREE_PATTERN = 'enhanced_treg_raptor_*.json'
+POLL_INTERVAL = 5.0
+SETTLE_SECONDS = 30.0
+HISTORY_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+
+def latest_tree_file(results_dir: Union[str, Path], pattern: str = TREE_PATTERN) -> Optional[Path]:
+    """最新のビルド（ファイル名のタイムスタンプ順で最後）"""
+    tree_files = sorted(Path(results_dir).glob(pattern))
+    return tree_files[-1] if tree_files else None
+
+
+def tree_ready(tree_file: Path, settle_seconds: float = SETTLE_SECONDS) -> bool:
+    """読み込んでよいか（.raptor が完成済み、またはJSONのみで最終更新から settle_seconds 経過）"""
+    if is_artifact(artifact_path_for(tree_file)):
+        return True
+    try:
+        return time.time() - tree_file.stat().st_mtime >= settle_seconds
+    except FileNotFoundError:
+        return False
+
+
+class IndexVersion:
+    """読み込み済みの1ビルド（検索エンジン + tree_data）と参照カウント"""
+
+    def __init__(self, version: str, tree_file: Path, engine: SemanticSearchEngine, tree_data: Dict,
+                 load_seconds: float = 0.0):
+        self.version = version
+        self.tree_file = tree_file
+        self.engine = engine
+        self.tree_data = tree_data
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.refs = 0
+        self.retired = False
+        self.released = False
+
+    def release(self) -> None:
+        """エンジン・ツリーへの参照を外し、mmap・FAISS・BM25のメモリを解放"""
+        self.engine = None
+        self.tree_data = None
+        self.released = True
+        gc.collect()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'tree': self.tree_file.name,
+            'nodes': len(self.engine.node_ids) if self.engine is not None else 0,
+            'load_seconds': round(self.load_seconds, 2),
+            'loaded_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.loaded_at)),
+            'refs': self.refs,
+            'retired': self.retired,
+            'released': self.released
+        }
+
+    def __repr__(self) -> str:
+        return f"IndexVersion({self.version}, refs={self.refs}, retired={self.retired})"
+
+
+def load_version(tree_file: Path, warm_up: bool = True) -> IndexVersion:
+    """ビルドを読み込み、初回検索の遅延がないように正規化行列・BM25を用意した版を作る"""
+    tree_file = Path(tree_file)
+    start = time.time()
+    engine = load_search_engine(tree_file)
+    tree_data = load_tree_data(tree_file)
+    if warm_up:
+        engine.search_batch(["regulatory T cell"], tree_data, mode="hybrid", top_k=1)
+    version = tree_file.stem.replace('enhanced_treg_raptor_', '')
+    return IndexVersion(version, tree_file, engine, tree_data, time.time() - start)
+
+
+class IndexManager:
+    """現在の版の参照・切り替えと results ディレクトリの監視"""
+
+    def __init__(self, results_dir: Optional[Union[str, Path]] = None, pattern: str = TREE_PATTERN,
+                 settle_seconds: float = SETTLE_SECONDS,
+                 loader: Callable[[Path], IndexVersion] = load_version,
+                 on_swap: Optional[Callable[[IndexVersion, Optional[IndexVersion]], None]] = None):
+        self.results_dir = Path(results_dir) if results_dir is not None else None
+        self.pattern = pattern
+        self.settle_seconds = settle_seconds
+        self.loader = loader
+        self.on_swap = on_swap
+        self._current: Optional[IndexVersion] = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # 読み込みは同時に1つまで
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self._failed: Dict[Path, float] = {}  # 読み込みに失敗したファイル → 失敗時のmtime
+        self.retired: List[IndexVersion] = []  # 解放待ち（実行中の検索が参照中）
+        self.history: List[Dict[str, Any]] = []
+        self.swaps = 0
+        self.failed_loads = 0
+
+    @classmethod
+    def for_tree(cls, tree_file: Union[str, Path], **kwargs) -> 'IndexManager':
+        """1ビルドを固定で提供（監視なし）"""
+        manager = cls(**kwargs)
+        manager.load(Path(tree_file))
+        return manager
+
+    @property
+    def current(self) -> Optional[IndexVersion]:
+        return self._current
+
+    # ------------------------------------------------------------------
+    # 参照
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def acquire(self) -> Iterator[IndexVersion]:
+        """現在の版を借りる（with を抜けるまで切り替え後も解放されない）"""
+        with self._lock:
+            version = self._current
+            if version is None:
+                raise RuntimeError("No index loaded yet")
+            version.refs += 1
+        try:
+            yield version
+        finally:
+            with self._lock:
+                version.refs -= 1
+                release = version.retired and version.refs == 0 and not version.released
+            if release:
+                self._release(version)
+
+    def _release(self, version: IndexVersion) -> None:
+        with self._lock:
+            if version in self.retired:
+                self.retired.remove(version)
+        version.release()
+        logger.info("🧹 Released index version %s", version.version)
+
+    # ------------------------------------------------------------------
+    # 読み込み・切り替え
+    # ------------------------------------------------------------------
+
+    def swap(self, version: IndexVersion) -> Optional[IndexVersion]:
+        """現在の版を差し替え、前の版を返す（参照がなければその場で解放）"""
+        with self._lock:
+            previous = self._current
+            self._current = version
+            self.swaps += 1
+            release = False
+            if previous is not None:
+                previous.retired = True
+                release = previous.refs == 0
+                if not release:
+                    self.retired.append(previous)
+            self.history.append({'version': version.version, 'tree': version.tree_file.name,
+                                 'swapped_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                 'load_seconds': round(version.load_seconds, 2)})
+            del self.history[:-HISTORY_SIZE]
+        logger.info("🔄 Index version %s → %s", previous.version if previous else None, version.version)
+        if self.on_swap is not None:
+            self.on_swap(version, previous)
+        if release:
+            self._release(previous)
+        return previous
+
+    def load(self, tree_file: Path) -> IndexVersion:
+        """ビルドを読み込んで切り替える（現在の検索は止めない）"""
+        with self._load_lock:
+            print(f"📂 Loading index version: {tree_file.name}")
+            version = self.loader(tree_file)
+            print(f"  ✓ Loaded {version.version} in {version.load_seconds:.1f}s")
+            self.swap(version)
+            return version
+
+    def load_latest(self) -> Optional[IndexVersion]:
+        """results ディレクトリの最新ビルドを読み込む（読み込み可能な状態でなくても待たない）"""
+        tree_file = latest_tree_file(self.results_dir, self.pattern)
+        if tree_file is None:
+            raise FileNotFoundError(f"No tree matching {self.pattern} in {self.results_dir}")
+        return self.load(tree_file)
+
+    def check_for_update(self) -> Optional[IndexVersion]:
+        """新しいビルドがあり読み込み可能なら切り替える（失敗時は現在の版を維持）"""
+        tree_file = latest_tree_file(self.results_dir, self.pattern)
+        current = self._current
+        if tree_file is None or (current is not None and tree_file.name <= current.tree_file.name):
+            return None
+        if not tree_ready(tree_file, self.settle_seconds):
+            return None
+        try:
+            mtime = tree_file.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        if self._failed.get(tree_file) == mtime:
+            return None  # 同じ内容の再試行はしない（書き直されたら再試行）
+        try:
+            return self.load(tree_file)
+        except Exception:
+            self.failed_loads += 1
+            self._failed[tree_file] = mtime
+            logger.exception("Failed to load %s; keeping version %s", tree_file.name,
+                             current.version if current else None)
+            return None
+
+    # ------------------------------------------------------------------
+    # 監視
+    # ------------------------------------------------------------------
+
+    def start_watching(self, poll_interval: float = POLL_INTERVAL) -> None:
+        """results ディレクトリをバックグラウンドスレッドで定期確認"""
+        if self.results_dir is None:
+            raise ValueError("IndexManager needs results_dir to watch for new builds")
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(poll_interval,),
+                                         name='raptor-index-watcher', daemon=True)
+        self._watcher.start()
+        print(f"👀 Watching {self.results_dir}/{self.pattern} every {poll_interval}s")
+
+    def _watch(self, poll_interval: float) -> None:
+        while not self._stop.wait(poll_interval):
+            self.check_for_update()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'current': self._current.info() if self._current is not None else None,
+                'retired': [version.info() for version in self.retired],
+                'swaps': self.swaps,
+                'failed_loads': self.failed_loads,
+                'history': list(self.history)
+            }
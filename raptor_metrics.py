@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Latency Metrics
+直近のレイテンシ履歴（秒）の要約（検索サーバーの /metrics とシャードごとのタイミングで共通）
+
+使用例:
+    latencies = deque(maxlen=1000)
+    latencies.append(time.perf_counter() - start)
+    latency_summary_ms(latencies)   # {'count': 1, 'p50': 2.1, 'p99': 2.1, 'max': 2.1, 'last': 2.1}
+"""
+
+from typing import Dict, Sequence, Union
+
+import numpy as np
+
+LATENCY_FIELDS = ('count', 'p50', 'p99', 'max', 'last')
+
+
+def latency_summary_ms(latencies: Sequence[float]) -> Dict[str, Union[int, float]]:
+    """レイテンシ（秒、古い順）の件数・p50 / p99・最大・直近値（ms、小数3桁）"""
+    if not latencies:
+        return {'count': 0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0, 'last': 0.0}
+    array = np.fromiter(latencies, dtype=np.float64, count=len(latencies)) * 1000.0
+    p50, p99 = np.percentile(array, [50, 99])
+    return {
+        'count': len(array),
+        'p50': round(float(p50), 3),
+        'p99': round(float(p99), 3),
+        'max': round(float(array.max()), 3),
+        'last': round(float(array[-1]), 3)
+    }
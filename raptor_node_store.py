@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+"""
+Columnar RAPTOR Node Store
+RAPTORノードを列指向（columnar）形式で保持するノードストア
+
+- 埋め込みは連続したfloat32行列（ノード序数でインデックス）
+- parent / level / cluster などは整数配列
+- children / source_documents はCSR形式（offset + count + 参照配列）
+- テキストはインターン化（内部ノードのcontent=summary、リーフのsummary=content[:200]を共有）
+
+`TrueRAPTORTree.nodes` はこのストアを使用し、従来の `Dict[str, RAPTORNode]` と同じ
+Mapping インターフェース（`[]`, `items()`, `values()`, `update()` など）を提供する。
+"""
+
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass
+class RAPTORNode:
+    """RAPTOR Tree Node with clustering support"""
+    node_id: str
+    parent_id: Optional[str]
+    children: List[str]
+    level: int
+    content: str
+    summary: str
+    is_leaf: bool
+    cluster_id: Optional[int]
+    embedding: Optional[np.ndarray]
+    source_documents: List[str]
+    cluster_size: int = 0
+
+
+def _grow(array: np.ndarray, capacity: int, fill=0) -> np.ndarray:
+    """配列の先頭軸をcapacityまで拡張（既存値はコピー）"""
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class _RefBuffer:
+    """CSR参照配列用の追記専用int64バッファ"""
+    __slots__ = ('data', 'size')
+
+    def __init__(self, capacity: int = 64):
+        self.data = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> '_RefBuffer':
+        buffer = cls.__new__(cls)
+        buffer.data = np.asarray(array, dtype=np.int64)
+        buffer.size = len(buffer.data)
+        return buffer
+
+    def extend(self, values: Sequence[int]) -> int:
+        """値を追記し、開始オフセットを返す"""
+        start = self.size
+        end = start + len(values)
+        if end > len(self.data):
+            self.data = _grow(self.data, max(end, 2 * len(self.data)))
+        self.data[start:end] = values
+        self.size = end
+        return start
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+
+class BlobStrings:
+    """UTF-8ブロブ + オフセット配列による遅延デコード文字列テーブル
+
+    ブロブは bytes / mmap / np.memmap のいずれでもよく、アクセス時にのみデコードする。
+    追記された文字列はメモリ上の追加リストに保持する。
+    """
+    __slots__ = ('_blob', '_offsets', '_extra')
+
+    def __init__(self, blob, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+        self._extra: List[str] = []
+
+    @staticmethod
+    def encode(strings: Sequence[str]) -> Tuple[bytes, np.ndarray]:
+        """文字列列をUTF-8ブロブとオフセット配列に変換"""
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return b''.join(encoded), offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1 + len(self._extra)
+
+    def __getitem__(self, index: int) -> str:
+        base = len(self._offsets) - 1
+        if index >= base:
+            return self._extra[index - base]
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        chunk = self._blob[start:end]
+        if isinstance(chunk, np.ndarray):
+            chunk = chunk.tobytes()
+        return bytes(chunk).decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value: str) -> None:
+        self._extra.append(value)
+
+
+class RAPTORNodeView:
+    """ストア内の1ノードを参照する軽量ビュー（RAPTORNode互換の属性を提供）"""
+    __slots__ = ('_store', '_ord')
+
+    def __init__(self, store: 'RAPTORNodeStore', ordinal: int):
+        self._store = store
+        self._ord = ordinal
+
+    @property
+    def ordinal(self) -> int:
+        return self._ord
+
+    @property
+    def node_id(self) -> str:
+        return self._store._ids[self._ord]
+
+    @property
+    def parent_id(self) -> Optional[str]:
+        return self._store._parent_id(self._ord)
+
+    @parent_id.setter
+    def parent_id(self, value: Optional[str]) -> None:
+        self._store.set_parent(self._ord, value)
+
+    @property
+    def children(self) -> List[str]:
+        """子ノードIDのリスト（コピー。変更はストアに反映されない）"""
+        return self._store._ref_symbols(self._store._child_start, self._store._child_count, self._store._child_refs, self._ord)
+
+    @property
+    def level(self) -> int:
+        return int(self._store._level[self._ord])
+
+    @property
+    def content(self) -> str:
+        return self._store._text(int(self._store._content_ref[self._ord]))
+
+    @property
+    def summary(self) -> str:
+        store = self._store
+        text = store._text(int(store._summary_ref[self._ord]))
+        length = int(store._summary_len[self._ord])
+        return text if length < 0 else text[:length]
+
+    @property
+    def is_leaf(self) -> bool:
+        return bool(self._store._is_leaf[self._ord])
+
+    @property
+    def cluster_id(self) -> Optional[int]:
+        value = int(self._store._cluster[self._ord])
+        return None if value < 0 else value
+
+    @property
+    def embedding(self) -> Optional[np.ndarray]:
+        """埋め込み行（ストア行列へのビュー。コピーなし）"""
+        store = self._store
+        if store._embeddings is None or not store._has_embedding[self._ord]:
+            return None
+        return store._embeddings[self._ord]
+
+    @property
+    def source_documents(self) -> List[str]:
+        store = self._store
+        return store._ref_symbols(store._src_start, store._src_count, store._src_refs, self._ord)
+
+    @property
+    def cluster_size(self) -> int:
+        return int(self._store._cluster_size[self._ord])
+
+    def to_dict(self) -> Dict[str, object]:
+        """JSON出力（tree_nodes）と同じ形のノード辞書（埋め込みなし）"""
+        return {
+            'node_id': self.node_id,
+            'parent_id': self.parent_id,
+            'children': self.children,
+            'level': self.level,
+            'content': self.content,
+            'summary': self.summary,
+            'is_leaf': self.is_leaf,
+            'cluster_id': self.cluster_id,
+            'cluster_size': self.cluster_size,
+            'source_documents': self.source_documents
+        }
+
+    def to_node(self) -> RAPTORNode:
+        """独立したRAPTORNode（dataclass）として取り出す"""
+        embedding = self.embedding
+        return RAPTORNode(
+            node_id=self.node_id,
+            parent_id=self.parent_id,
+            children=self.children,
+            level=self.level,
+            content=self.content,
+            summary=self.summary,
+            is_leaf=self.is_leaf,
+            cluster_id=self.cluster_id,
+            embedding=None if embedding is None else np.array(embedding),
+            source_documents=self.source_documents,
+            cluster_size=self.cluster_size
+        )
+
+    def __repr__(self) -> str:
+        return (f"RAPTORNodeView(node_id={self.node_id!r}, level={self.level}, "
+                f"is_leaf={self.is_leaf}, children={self._store._child_count[self._ord]})")
+
+
+class RAPTORNodeStore(Mapping):
+    """列指向のRAPTORノードストア（node_id → RAPTORNodeView のMapping）"""
+    __slots__ = (
+        '_ids', '_ord_of', '_symbols', '_symbol_of', '_symbol_ord', '_node_sym',
+        '_texts', '_text_of', '_capacity', '_size', '_embedding_dim', '_embeddings',
+        '_has_embedding', '_parent_sym', '_level', '_cluster', '_cluster_size', '_is_leaf',
+        '_content_ref', '_summary_ref', '_summary_len', '_token_count',
+        '_child_start', '_child_count', '_child_refs',
+        '_src_start', '_src_count', '_src_refs'
+    )
+
+    def __init__(self, capacity: int = 1024, embedding_dim: Optional[int] = None):
+        self._ids: List[str] = []
+        self._ord_of: Dict[str, int] = {}
+
+        # シンボル表（ノードIDと文書IDを共通の整数参照に変換）
+        self._symbols: List[str] = []
+        self._symbol_of: Dict[str, int] = {}
+        self._symbol_ord = np.full(capacity, -1, dtype=np.int64)
+
+        # インターン化テキスト
+        self._texts: List[str] = []
+        self._text_of: Dict[str, int] = {}
+
+        self._capacity = capacity
+        self._size = 0
+        self._embedding_dim = embedding_dim
+        self._embeddings = (np.zeros((capacity, embedding_dim), dtype=np.float32)
+                            if embedding_dim else None)
+        self._has_embedding = np.zeros(capacity, dtype=bool)
+
+        self._node_sym = np.full(capacity, -1, dtype=np.int64)
+        self._parent_sym = np.full(capacity, -1, dtype=np.int64)
+        self._level = np.zeros(capacity, dtype=np.int32)
+        self._cluster = np.full(capacity, -1, dtype=np.int32)
+        self._cluster_size = np.zeros(capacity, dtype=np.int32)
+        self._is_leaf = np.zeros(capacity, dtype=bool)
+        self._content_ref = np.full(capacity, -1, dtype=np.int32)
+        self._summary_ref = np.full(capacity, -1, dtype=np.int32)
+        self._summary_len = np.full(capacity, -1, dtype=np.int32)
+        self._token_count = np.full(capacity, -1, dtype=np.int32)  # contentのトークン数（-1は未計算）
+
+        # CSR（行ごとのoffset + count。上書き時は新しい区間を追記）
+        self._child_start = np.zeros(capacity, dtype=np.int64)
+        self._child_count = np.zeros(capacity, dtype=np.int32)
+        self._child_refs = _RefBuffer(max(64, capacity))
+        self._src_start = np.zeros(capacity, dtype=np.int64)
+        self._src_count = np.zeros(capacity, dtype=np.int32)
+        self._src_refs = _RefBuffer(max(64, capacity))
+
+    # ------------------------------------------------------------------
+    # 内部ヘルパー
+    # ------------------------------------------------------------------
+
+    def _ensure_capacity(self, needed: int) -> None:
+        """ノード列の容量を確保（倍々で拡張）"""
+        if needed <= self._capacity:
+            return
+        capacity = max(needed, 2 * self._capacity)
+        self._node_sym = _grow(self._node_sym, capacity, -1)
+        self._parent_sym = _grow(self._parent_sym, capacity, -1)
+        self._level = _grow(self._level, capacity)
+        self._cluster = _grow(self._cluster, capacity, -1)
+        self._cluster_size = _grow(self._cluster_size, capacity)
+        self._is_leaf = _grow(self._is_leaf, capacity, False)
+        self._content_ref = _grow(self._content_ref, capacity, -1)
+        self._summary_ref = _grow(self._summary_ref, capacity, -1)
+        self._summary_len = _grow(self._summary_len, capacity, -1)
+        self._token_count = _grow(self._token_count, capacity, -1)
+        self._child_start = _grow(self._child_start, capacity)
+        self._child_count = _grow(self._child_count, capacity)
+        self._src_start = _grow(self._src_start, capacity)
+        self._src_count = _grow(self._src_count, capacity)
+        self._has_embedding = _grow(self._has_embedding, capacity, False)
+        if self._embeddings is not None:
+            self._embeddings = _grow(self._embeddings, capacity)
+        self._capacity = capacity
+
+    def _intern_symbol(self, name: str) -> int:
+        """ID文字列をシンボル番号に変換（未登録なら追加）"""
+        name = str(name)
+        sym = self._symbol_of.get(name)
+        if sym is None:
+            sym = len(self._symbols)
+            self._symbols.append(name)
+            self._symbol_of[name] = sym
+            if sym >= len(self._symbol_ord):
+                self._symbol_ord = _grow(self._symbol_ord, max(sym + 1, 2 * len(self._symbol_ord)), -1)
+        return sym
+
+    def _intern_text(self, text: str) -> int:
+        """テキストをインターン化して参照番号を返す"""
+        text = text or ''
+        ref = self._text_of.get(text)
+        if ref is None:
+            ref = len(self._texts)
+            self._texts.append(text)
+            self._text_of[text] = ref
+        return ref
+
+    def _text(self, ref: int) -> str:
+        return self._texts[ref] if ref >= 0 else ''
+
+    def _parent_id(self, ordinal: int) -> Optional[str]:
+        sym = int(self._parent_sym[ordinal])
+        return None if sym < 0 else self._symbols[sym]
+
+    def _ref_symbols(self, starts: np.ndarray, counts: np.ndarray,
+                     refs: _RefBuffer, ordinal: int) -> List[str]:
+        start = int(starts[ordinal])
+        syms = refs.data[start:start + int(counts[ordinal])]
+        return [self._symbols[s] for s in syms]
+
+    def _set_embedding(self, ordinal: int, embedding: Optional[np.ndarray]) -> None:
+        if self._embeddings is not None and not self._embeddings.flags.writeable:
+            # 読み取り専用（mmap）の行列は書き込み前にコピー
+            self._embeddings = np.array(self._embeddings)
+        if embedding is None:
+            self._has_embedding[ordinal] = False
+            if self._embeddings is not None:
+                self._embeddings[ordinal] = 0.0
+            return
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self._embeddings is None:
+            self._embedding_dim = len(vector)
+            self._embeddings = np.zeros((self._capacity, self._embedding_dim), dtype=np.float32)
+        if len(vector) != self._embedding_dim:
+            raise ValueError(
+                f"Embedding dimension mismatch for node {self._ids[ordinal]}: "
+                f"{len(vector)} != {self._embedding_dim}"
+            )
+        self._embeddings[ordinal] = vector
+        self._has_embedding[ordinal] = True
+
+    # ------------------------------------------------------------------
+    # Mapping インターフェース（Dict[str, RAPTORNode] 互換）
+    # ------------------------------------------------------------------
+
+    def __getitem__(self, node_id: str) -> RAPTORNodeView:
+        return RAPTORNodeView(self, self._ord_of[node_id])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, node_id) -> bool:
+        return node_id in self._ord_of
+
+    def __setitem__(self, node_id: str, node) -> None:
+        self.add(node, node_id=node_id)
+
+    def update(self, other=(), **kwargs) -> None:
+        """dict.update互換: RAPTORNode（またはビュー）を一括追加"""
+        items = other.items() if hasattr(other, 'items') else other
+        for node_id, node in items:
+            self.add(node, node_id=node_id)
+        for node_id, node in kwargs.items():
+            self.add(node, node_id=node_id)
+
+    def add(self, node, node_id: Optional[str] = None) -> int:
+        """ノードを追加（既存IDは上書き）し、序数を返す"""
+        node_id = str(node_id if node_id is not None else node.node_id)
+        ordinal = self._ord_of.get(node_id)
+        if ordinal is None:
+            ordinal = self._size
+            self._ensure_capacity(ordinal + 1)
+            self._ids.append(node_id)
+            self._ord_of[node_id] = ordinal
+            sym = self._intern_symbol(node_id)
+            self._node_sym[ordinal] = sym
+            self._symbol_ord[sym] = ordinal
+            self._size += 1
+
+        self._parent_sym[ordinal] = (-1 if node.parent_id is None
+                                     else self._intern_symbol(node.parent_id))
+        self._level[ordinal] = int(node.level)
+        self._cluster[ordinal] = -1 if node.cluster_id is None else int(node.cluster_id)
+        self._cluster_size[ordinal] = int(node.cluster_size)
+        self._is_leaf[ordinal] = bool(node.is_leaf)
+
+        # テキスト: summaryがcontentの先頭部分なら同じ参照を共有
+        content = node.content or ''
+        summary = node.summary or ''
+        content_ref = self._intern_text(content)
+        self._content_ref[ordinal] = content_ref
+        if content.startswith(summary):
+            self._summary_ref[ordinal] = content_ref
+            self._summary_len[ordinal] = -1 if len(summary) == len(content) else len(summary)
+        else:
+            self._summary_ref[ordinal] = self._intern_text(summary)
+            self._summary_len[ordinal] = -1
+        self._token_count[ordinal] = -1
+
+        children = [self._intern_symbol(c) for c in node.children]
+        self._child_start[ordinal] = self._child_refs.extend(children)
+        self._child_count[ordinal] = len(children)
+        sources = [self._intern_symbol(d) for d in node.source_documents]
+        self._src_start[ordinal] = self._src_refs.extend(sources)
+        self._src_count[ordinal] = len(sources)
+
+        self._set_embedding(ordinal, node.embedding)
+        return ordinal
+
+    def set_parent(self, node: 'int | str', parent_id: Optional[str]) -> None:
+        """親ノードIDを設定（序数またはノードIDで指定）"""
+        ordinal = node if isinstance(node, (int, np.integer)) else self._ord_of[node]
+        self._parent_sym[ordinal] = -1 if parent_id is None else self._intern_symbol(parent_id)
+
+    # ------------------------------------------------------------------
+    # 序数ベースのアクセス
+    # ------------------------------------------------------------------
+
+    def ordinal(self, node_id: str) -> int:
+        return self._ord_of[node_id]
+
+    def node_id(self, ordinal: int) -> str:
+        return self._ids[ordinal]
+
+    @property
+    def node_ids(self) -> List[str]:
+        return self._ids
+
+    def view(self, ordinal: int) -> RAPTORNodeView:
+        return RAPTORNodeView(self, int(ordinal))
+
+    @property
+    def embedding_dim(self) -> Optional[int]:
+        return self._embedding_dim
+
+    # ------------------------------------------------------------------
+    # ベクトル化された列アクセス（読み取り専用ビュー）
+    # ------------------------------------------------------------------
+
+    def _column(self, array: np.ndarray) -> np.ndarray:
+        column = array[:self._size]
+        column.flags.writeable = False
+        return column
+
+    @property
+    def levels(self) -> np.ndarray:
+        return self._column(self._level)
+
+    @property
+    def cluster_ids(self) -> np.ndarray:
+        """クラスタID配列（None は -1）"""
+        return self._column(self._cluster)
+
+    @property
+    def cluster_sizes(self) -> np.ndarray:
+        return self._column(self._cluster_size)
+
+    @property
+    def is_leaf_mask(self) -> np.ndarray:
+        return self._column(self._is_leaf)
+
+    @property
+    def has_embedding_mask(self) -> np.ndarray:
+        return self._column(self._has_embedding)
+
+    @property
+    def token_counts(self) -> np.ndarray:
+        """contentのトークン数（生成モデルのトークナイザーで計算、-1は未計算）"""
+        return self._column(self._token_count)
+
+    def set_token_counts(self, counts: Sequence[int], ordinals: Optional[Sequence[int]] = None) -> None:
+        """トークン数を設定（ordinals省略時は全ノード）"""
+        if not self._token_count.flags.writeable:
+            self._token_count = np.array(self._token_count)
+        counts = np.asarray(counts, dtype=np.int32)
+        if ordinals is None:
+            self._token_count[:self._size] = counts
+        else:
+            self._token_count[np.asarray(ordinals, dtype=np.int64)] = counts
+
+    def embedding_matrix(self) -> np.ndarray:
+        """全ノードの埋め込み行列 (n_nodes, dim)。コピーなしのビュー"""
+        if self._embeddings is None:
+            return np.zeros((self._size, 0), dtype=np.float32)
+        return self._embeddings[:self._size]
+
+    def parent_ordinals(self) -> np.ndarray:
+        """親ノードの序数配列（親なし・未登録は -1）"""
+        parent_sym = self._parent_sym[:self._size]
+        return np.where(parent_sym >= 0, self._symbol_ord[np.maximum(parent_sym, 0)], -1)
+
+    def ordinals_at_level(self, level: int) -> np.ndarray:
+        return np.flatnonzero(self._level[:self._size] == level)
+
+    def max_level(self) -> int:
+        return int(self._level[:self._size].max()) if self._size else 0
+
+    def leaf_count(self) -> int:
+        return int(np.count_nonzero(self._is_leaf[:self._size]))
+
+    def children_ordinals(self, ordinal: int) -> np.ndarray:
+        """子ノードの序数配列（ストアに存在しない子は除外）"""
+        start = int(self._child_start[ordinal])
+        syms = self._child_refs.data[start:start + int(self._child_count[ordinal])]
+        ords = self._symbol_ord[syms]
+        return ords[ords >= 0]
+
+    def _csr(self, starts: np.ndarray, counts: np.ndarray, refs: _RefBuffer) -> Tuple[np.ndarray, np.ndarray]:
+        counts = counts[:self._size].astype(np.int64)
+        indptr = np.zeros(self._size + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        # 各行の区間 [start, start+count) を連結した参照位置
+        positions = np.repeat(starts[:self._size] - indptr[:-1], counts) + np.arange(indptr[-1])
+        return indptr, refs.data[positions]
+
+    def children_csr(self) -> Tuple[np.ndarray, np.ndarray]:
+        """子ノードのCSR (indptr, child_ordinals)。未登録の子は -1"""
+        indptr, syms = self._csr(self._child_start, self._child_count, self._child_refs)
+        return indptr, self._symbol_ord[syms]
+
+    def source_documents_csr(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """source_documentsのCSR (indptr, symbol_ids, symbol_table)"""
+        indptr, syms = self._csr(self._src_start, self._src_count, self._src_refs)
+        return indptr, syms, self._symbols
+
+    # ------------------------------------------------------------------
+    # 列データの入出力（バイナリアーティファクト用）
+    # ------------------------------------------------------------------
+
+    def to_columns(self) -> Dict[str, np.ndarray]:
+        """コンパクトなCSRに詰め直した整数列を返す"""
+        n = self._size
+        child_indptr, child_refs = self._csr(self._child_start, self._child_count, self._child_refs)
+        src_indptr, src_refs = self._csr(self._src_start, self._src_count, self._src_refs)
+        return {
+            'node_sym': self._node_sym[:n].copy(),
+            'parent_sym': self._parent_sym[:n].copy(),
+            'level': self._level[:n].copy(),
+            'cluster': self._cluster[:n].copy(),
+            'cluster_size': self._cluster_size[:n].copy(),
+            'is_leaf': self._is_leaf[:n].copy(),
+            'has_embedding': self._has_embedding[:n].copy(),
+            'content_ref': self._content_ref[:n].copy(),
+            'summary_ref': self._summary_ref[:n].copy(),
+            'summary_len': self._summary_len[:n].copy(),
+            'token_count': self._token_count[:n].copy(),
+            'child_indptr': child_indptr,
+            'child_refs': child_refs,
+            'src_indptr': src_indptr,
+            'src_refs': src_refs,
+        }
+
+    @property
+    def symbols(self) -> Sequence[str]:
+        return self._symbols
+
+    @property
+    def texts(self) -> Sequence[str]:
+        return self._texts
+
+    @classmethod
+    def from_columns(cls, columns: Mapping, symbols: List[str], texts: Sequence[str],
+                     embeddings: Optional[np.ndarray] = None) -> 'RAPTORNodeStore':
+        """to_columns() の出力からストアを復元（埋め込み・テキストはコピーしない）"""
+        n = len(columns['node_sym'])
+        store = cls.__new__(cls)
+        store._size = n
+        store._capacity = n
+
+        store._symbols = list(symbols)
+        store._symbol_of = {name: i for i, name in enumerate(store._symbols)}
+        store._node_sym = np.asarray(columns['node_sym'], dtype=np.int64)
+        store._ids = [store._symbols[s] for s in store._node_sym]
+        store._ord_of = {node_id: i for i, node_id in enumerate(store._ids)}
+        store._symbol_ord = np.full(max(len(store._symbols), 1), -1, dtype=np.int64)
+        store._symbol_ord[store._node_sym] = np.arange(n, dtype=np.int64)
+
+        store._texts = texts
+        store._text_of = {}
+
+        store._parent_sym = np.asarray(columns['parent_sym'], dtype=np.int64)
+        store._level = np.asarray(columns['level'], dtype=np.int32)
+        store._cluster = np.asarray(columns['cluster'], dtype=np.int32)
+        store._cluster_size = np.asarray(columns['cluster_size'], dtype=np.int32)
+        store._is_leaf = np.asarray(columns['is_leaf'], dtype=bool)
+        store._has_embedding = np.asarray(columns['has_embedding'], dtype=bool)
+        store._content_ref = np.asarray(columns['content_ref'], dtype=np.int32)
+        store._summary_ref = np.asarray(columns['summary_ref'], dtype=np.int32)
+        store._summary_len = np.asarray(columns['summary_len'], dtype=np.int32)
+        store._token_count = (np.asarray(columns['token_count'], dtype=np.int32) if 'token_count' in columns
+                              else np.full(n, -1, dtype=np.int32))
+
+        child_indptr = np.asarray(columns['child_indptr'], dtype=np.int64)
+        store._child_start = child_indptr[:-1].copy()
+        store._child_count = np.diff(child_indptr).astype(np.int32)
+        store._child_refs = _RefBuffer.from_array(columns['child_refs'])
+        src_indptr = np.asarray(columns['src_indptr'], dtype=np.int64)
+        store._src_start = src_indptr[:-1].copy()
+        store._src_count = np.diff(src_indptr).astype(np.int32)
+        store._src_refs = _RefBuffer.from_array(columns['src_refs'])
+
+        if embeddings is not None and embeddings.ndim == 2 and embeddings.shape[1] > 0:
+            store._embeddings = embeddings
+            store._embedding_dim = int(embeddings.shape[1])
+        else:
+            store._embeddings = None
+            store._embedding_dim = None
+        return store
+
+    def memory_usage(self) -> Dict[str, int]:
+        """おおよそのメモリ使用量（バイト）"""
+        arrays = [
+            self._node_sym, self._parent_sym, self._level, self._cluster, self._cluster_size,
+            self._is_leaf, self._content_ref, self._summary_ref, self._summary_len, self._token_count,
+            self._child_start, self._child_count, self._src_start, self._src_count,
+            self._has_embedding, self._symbol_ord, self._child_refs.data, self._src_refs.data
+        ]
+        return {
+            'embeddings': int(self._embeddings.nbytes) if self._embeddings is not None else 0,
+            'columns': int(sum(a.nbytes for a in arrays)),
+            'texts': int(sum(len(t) for t in self._texts)) if isinstance(self._texts, list) else 0,
+            'symbols': int(sum(len(s) for s in self._symbols)),
+        }
+
+
+class NodeDictView(Mapping):
+    """ストアを node_id → ノード辞書 のMappingとして公開（アクセス時に辞書を生成）
+
+    JSON出力の `tree_nodes` を前提とした既存スクリプトに、全ノードを
+    展開せずにそのまま渡すためのアダプタ。
+    """
+    __slots__ = ('_store',)
+
+    def __init__(self, store: RAPTORNodeStore):
+        self._store = store
+
+    @property
+    def store(self) -> RAPTORNodeStore:
+        return self._store
+
+    def __getitem__(self, node_id: str) -> Dict[str, object]:
+        return self._store[node_id].to_dict()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._store)
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def __contains__(self, node_id) -> bool:
+        return node_id in self._store
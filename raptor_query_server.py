@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Query Server
+ツリーインデックスとクエリエンコーダーを1回だけ読み込み、ローカルの複数クライアントで共有する検索サーバー（asyncio）
+
+- HTTP/1.1（TCP または Unixソケット、keep-alive対応）。外部依存なし
+- 同時に届いたクエリを短い時間窓（既定 5ms、最大 64件）でマイクロバッチにまとめ、
+  1回のエンコードとフィルタ・モードごとに1回の行列積（SemanticSearchEngine.search_batch）で処理する。
+  バッチ処理中に届いたクエリは次のバッチにまとまるため、負荷が高いほどバッチが大きくなる
+- 待ち行列が上限（既定 1024クエリ）に達したら 503 + Retry-After で即座に拒否する（バックプレッシャー）
+- /metrics: 直近のレイテンシ p50 / p99（待ち時間を含む）・バッチサイズ・待ち行列長・拒否数
+- --watch で results/ の新しいビルドに無停止で切り替え（raptor_index_manager.py）。
+  バッチは開始時の版で最後まで処理される
+
+エンドポイント:
+    POST /search   {"query": "Foxp3 stability", "mode": "hybrid", "top_k": 5}
+                   "queries": [...] で複数クエリを1リクエストで送信可
+                   "mode": "keyword" / "semantic" / "hybrid"、"fusion": "rrf" / "minmax" / "zscore"
+                   "filter": {"level": [1, 2], "leaf": true, "treg_stage": [5], "subtree": "raptor_L0_C3_..."}
+    GET  /health   インデックスの版・モデル・ノード数・待ち行列（バッチ処理が停止していれば 503）
+    GET  /metrics  レイテンシ統計
+
+使用例:
+    python raptor_query_server.py results/enhanced_treg_raptor_80x_*.json --port 8765
+    python raptor_query_server.py results/enhanced_treg_raptor_80x_*.raptor --unix /tmp/raptor.sock
+    python raptor_query_server.py --watch results/     # 最新ビルドを提供し、新しいビルドに自動で切り替え
+
+    curl -s localhost:8765/search -d '{"query": "IL-10 suppression", "mode": "semantic", "top_k": 3}'
+    curl -s --unix-socket /tmp/raptor.sock http://localhost/metrics
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from raptor_filters import NodeFilter, filter_from_spec
+from raptor_fusion import FUSION_METHODS
+from raptor_index_manager import POLL_INTERVAL, SETTLE_SECONDS, IndexManager
+from raptor_metrics import latency_summary_ms
+from raptor_search import HYBRID_FUSION, SEARCH_MODES
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+BATCH_WINDOW_MS = 5.0
+MAX_BATCH_SIZE = 64
+MAX_PENDING = 1024
+MAX_TOP_K = 100
+MAX_BODY_BYTES = 1 << 20
+REQUEST_TIMEOUT = 30.0
+READ_TIMEOUT = 10.0  # リクエスト行の後、ヘッダー・本文を受信しきるまで
+KEEP_ALIVE_TIMEOUT = 60.0  # 次のリクエストを待つアイドル時間（超えたら接続を閉じる）
+LATENCY_WINDOW = 10_000
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            408: 'Request Timeout', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+            504: 'Gateway Timeout'}
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """待ち行列が上限に達している"""
+
+
+@dataclass
+class _PendingQuery:
+    query: str
+    mode: str
+    top_k: int
+    node_filter: Optional[NodeFilter]
+    fusion: str
+    future: asyncio.Future
+    enqueued: float
+
+    @property
+    def group_key(self) -> Tuple[str, str, str]:
+        """同じ行列積・同じ統合で処理できるクエリのまとまり"""
+        return self.mode, repr(self.node_filter), self.fusion
+
+
+class LatencyStats:
+    """直近 window 件のクエリレイテンシ（秒）とバッチサイズ"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.started = time.time()
+
+    def record_query(self, latency: float, queue_wait: float, ok: bool = True) -> None:
+        self.latencies.append(latency)
+        self.queue_waits.append(queue_wait)
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    def record_batch(self, size: int) -> None:
+        self.batch_sizes.append(size)
+        self.batches += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        uptime = time.time() - self.started
+        return {
+            'uptime_s': round(uptime, 1),
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'qps': round(self.completed / uptime, 2) if uptime > 0 else 0.0,
+            'latency_ms': latency_summary_ms(self.latencies),
+            'queue_wait_ms': latency_summary_ms(self.queue_waits),
+            'batch_size': {
+                'mean': round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else 0.0,
+                'max': int(max(self.batch_sizes)) if self.batch_sizes else 0
+            },
+            'window': len(self.latencies)
+        }
+
+
+class QueryBatcher:
+    """待ち行列のクエリをマイクロバッチにまとめ、専用スレッドで検索する（エンジンは1スレッドからのみ使用）"""
+
+    def __init__(self, manager: IndexManager, stats: LatencyStats,
+                 window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_pending: int = MAX_PENDING):
+        self.manager = manager
+        self.stats = stats
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.queue: 'asyncio.Queue[_PendingQuery]' = asyncio.Queue(maxsize=max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='raptor-batch')
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    def submit(self, queries: List[_PendingQuery]) -> None:
+        """リクエストのクエリをまとめて投入（全件入らなければ1件も入れず Overloaded）"""
+        if self.queue.qsize() + len(queries) > self.max_pending:
+            self.stats.rejected += len(queries)
+            raise Overloaded(f"{self.queue.qsize()} queries pending")
+        for pending in queries:
+            self.queue.put_nowait(pending)
+
+    async def _collect(self) -> List[_PendingQuery]:
+        """最初の1件が届いてから時間窓の間（または上限件数まで）クエリを集める"""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        return [pending for pending in batch if not pending.future.done()]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                outcomes = await loop.run_in_executor(self._executor, self._search, batch)
+            except Exception as e:  # エンコード失敗など: バッチ全体をエラーにする
+                logger.exception("Batch of %d queries failed", len(batch))
+                outcomes = [e] * len(batch)
+            finished = time.perf_counter()
+            self.stats.record_batch(len(batch))
+            for pending, outcome in zip(batch, outcomes):
+                ok = not isinstance(outcome, Exception)
+                self.stats.record_query(finished - pending.enqueued, started - pending.enqueued, ok)
+                if pending.future.done():  # タイムアウト済み
+                    continue
+                if ok:
+                    pending.future.set_result(outcome)
+                else:
+                    pending.future.set_exception(outcome)
+
+    def _search(self, batch: List[_PendingQuery]) -> List[Any]:
+        """バッチ全体を開始時の版で処理（途中で切り替わっても同じ版を使い続ける）"""
+        with self.manager.acquire() as version:
+            return self._search_version(batch, version.engine, version.tree_data)
+
+    @staticmethod
+    def _search_version(batch: List[_PendingQuery], engine, tree_data: Dict) -> List[Any]:
+        """バッチ全体を1回でエンコードし、(モード, フィルタ, 統合手法) ごとに search_batch で検索"""
+        outcomes: List[Any] = [None] * len(batch)
+        embedded = [i for i, pending in enumerate(batch) if pending.mode != 'keyword']
+        embeddings = engine.encode_queries([batch[i].query for i in embedded]) if embedded else None
+        embedding_row = {i: row for row, i in enumerate(embedded)}
+
+        groups: Dict[Tuple[str, str, str], List[int]] = {}
+        for i, pending in enumerate(batch):
+            groups.setdefault(pending.group_key, []).append(i)
+        for members in groups.values():
+            first = batch[members[0]]
+            try:
+                found = engine.search_batch(
+                    [batch[i].query for i in members], tree_data, mode=first.mode,
+                    top_k=max(batch[i].top_k for i in members),
+                    query_embeddings=(embeddings[[embedding_row[i] for i in members]]
+                                      if first.mode != 'keyword' else None),
+                    node_filter=first.node_filter, fusion=first.fusion
+                )
+                for i, hits in zip(members, found):
+                    outcomes[i] = hits[:batch[i].top_k]
+            except Exception as e:  # フィルタの不明ノードなど: そのグループのみエラー
+                for i in members:
+                    outcomes[i] = e
+        return outcomes
+
+
+class RAPTORQueryServer:
+    """IndexManager の現在の版で検索リクエストに応答するHTTPサーバー"""
+
+    def __init__(self, manager: IndexManager, window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_pending: int = MAX_PENDING, request_timeout: float = REQUEST_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, keep_alive_timeout: float = KEEP_ALIVE_TIMEOUT):
+        self.manager = manager
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.stats = LatencyStats()
+        self.batcher: Optional[QueryBatcher] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @classmethod
+    def from_tree_file(cls, tree_file: Path, **kwargs) -> 'RAPTORQueryServer':
+        """1ビルドを固定で提供"""
+        return cls(IndexManager.for_tree(tree_file), **kwargs)
+
+    # ------------------------------------------------------------------
+    # 起動・停止
+    # ------------------------------------------------------------------
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                    unix_path: Optional[str] = None) -> None:
+        self.batcher = QueryBatcher(self.manager, self.stats,
+                                    self.window_ms, self.max_batch_size, self.max_pending)
+        self.batcher.start()
+        if unix_path:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=unix_path)
+            print(f"🚀 RAPTOR query server listening on unix:{unix_path}")
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+            print(f"🚀 RAPTOR query server listening on http://{host}:{port}")
+        print(f"  Micro-batching: window={self.window_ms}ms, max_batch={self.max_batch_size}, "
+              f"max_pending={self.max_pending}")
+
+    async def serve_forever(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                            unix_path: Optional[str] = None) -> None:
+        await self.start(host, port, unix_path)
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.batcher is not None:
+            await self.batcher.stop()
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break  # アイドル・停止したクライアントの接続は閉じる
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed request line'}, keep_alive=False)
+                    break
+                try:
+                    headers = await asyncio.wait_for(self._read_headers(reader), self.read_timeout)
+                except asyncio.TimeoutError:
+                    await self._respond(writer, 408, {'error': 'timed out reading headers'}, keep_alive=False)
+                    break
+
+                length = self._content_length(headers)
+                if length is None:
+                    await self._respond(writer, 400, {'error': 'invalid Content-Length'}, keep_alive=False)
+                    break
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, {'error': f'body exceeds {MAX_BODY_BYTES} bytes'},
+                                        keep_alive=False)
+                    break
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout) if length else b''
+                except asyncio.TimeoutError:
+                    await self._respond(writer, 408, {'error': 'timed out reading body'}, keep_alive=False)
+                    break
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+
+                status, payload, extra = await self._route(method, target.split('?', 1)[0], body)
+                await self._respond(writer, status, payload, keep_alive, extra)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    def _content_length(headers: Dict[str, str]) -> Optional[int]:
+        """Content-Length（なければ0、数値でない・負なら None）"""
+        value = headers.get('content-length') or '0'
+        if not value.isdigit():
+            return None
+        return int(value)
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, payload: Dict, keep_alive: bool,
+                       extra: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+                 "Content-Type: application/json; charset=utf-8",
+                 f"Content-Length: {len(body)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in (extra or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict, Optional[Dict[str, str]]]:
+        if path in ('/health', '/metrics') and method != 'GET':
+            return 405, {'error': 'use GET'}, None
+        if path == '/health':
+            status, payload = self._health()
+            return status, payload, None
+        if path == '/metrics':
+            return 200, {**self.stats.snapshot(), 'queue': self.batcher.queue.qsize()}, None
+        if path == '/search':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}, None
+            return await self._search(body)
+        return 404, {'error': f'unknown path: {path}'}, None
+
+    def _health(self) -> Tuple[int, Dict]:
+        healthy = self.batcher is not None and self.batcher.running
+        index = self.manager.status()
+        current = self.manager.current
+        return (200 if healthy else 503), {
+            'status': 'ok' if healthy else 'batcher stopped',
+            'index': index['current'],
+            'retired_versions': len(index['retired']),
+            'swaps': index['swaps'],
+            'model': current.engine.model_name if current is not None and current.engine is not None else None,
+            'queue': self.batcher.queue.qsize() if self.batcher else 0,
+            'max_pending': self.max_pending,
+            'uptime_s': round(time.time() - self.stats.started, 1)
+        }
+
+    def _parse_search(self, body: bytes) -> Tuple[List[str], bool, Dict[str, Any]]:
+        """リクエスト本文を検証し (クエリ列, 単一クエリか, 検索条件) を返す（不正なら ValueError）"""
+        try:
+            request = json.loads(body or b'{}')
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+        if not isinstance(request, dict):
+            raise ValueError("request body must be a JSON object")
+        single = 'queries' not in request
+        queries = [request.get('query')] if single else request['queries']
+        if not isinstance(queries, list) or not queries or \
+                not all(isinstance(q, str) and q.strip() for q in queries):
+            raise ValueError("'query' must be a non-empty string ('queries' a non-empty list of them)")
+        if len(queries) > self.max_pending:
+            raise ValueError(f"at most {self.max_pending} queries per request")
+
+        mode = request.get('mode', 'hybrid')
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"'mode' must be one of {SEARCH_MODES}")
+        fusion = request.get('fusion', HYBRID_FUSION)
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"'fusion' must be one of {FUSION_METHODS}")
+        top_k = request.get('top_k', 5)
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or not 1 <= top_k <= MAX_TOP_K:
+            raise ValueError(f"'top_k' must be an integer in 1..{MAX_TOP_K}")
+        node_filter = filter_from_spec(request.get('filter'))
+        return queries, single, {'mode': mode, 'fusion': fusion, 'top_k': top_k, 'node_filter': node_filter}
+
+    async def _search(self, body: bytes) -> Tuple[int, Dict, Optional[Dict[str, str]]]:
+        try:
+            queries, single, options = self._parse_search(body)
+        except ValueError as e:
+            return 400, {'error': str(e)}, None
+
+        loop = asyncio.get_running_loop()
+        enqueued = time.perf_counter()
+        pending = [_PendingQuery(query=query, future=loop.create_future(), enqueued=enqueued, **options)
+                   for query in queries]
+        try:
+            self.batcher.submit(pending)
+        except Overloaded as e:
+            return 503, {'error': f'server overloaded ({e})'}, {'Retry-After': '1'}
+
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(p.future for p in pending)), self.request_timeout)
+        except asyncio.TimeoutError:
+            return 504, {'error': f'no result within {self.request_timeout}s'}, None
+        except (KeyError, ValueError) as e:  # 不明なサブツリーノード、フィルタ非対応のエンジンなど
+            return 400, {'error': str(e.args[0]) if e.args else repr(e)}, None
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}, None
+
+        latency_ms = round((time.perf_counter() - enqueued) * 1000.0, 3)
+        if single:
+            return 200, {'query': queries[0], 'mode': options['mode'], 'results': results[0],
+                         'latency_ms': latency_ms}, None
+        return 200, {'queries': queries, 'mode': options['mode'], 'results': list(results),
+                     'latency_ms': latency_ms}, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local RAPTOR query server with request micro-batching")
+    parser.add_argument('tree', nargs='?', help='tree to serve (JSON or .raptor); default: latest in --watch')
+    parser.add_argument('--watch', metavar='RESULTS_DIR',
+                        help='serve the latest build in this directory and hot-swap to new builds')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between checks for new builds (--watch)')
+    parser.add_argument('--settle-seconds', type=float, default=SETTLE_SECONDS,
+                        help='wait this long after a JSON-only build is written before loading it')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--batch-window-ms', type=float, default=BATCH_WINDOW_MS,
+                        help='how long to collect concurrent queries into one batch')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH_SIZE, help='max queries per batch')
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING,
+                        help='queued queries before requests are rejected with 503')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT, help='per-request timeout (seconds)')
+    parser.add_argument('--keep-alive-timeout', type=float, default=KEEP_ALIVE_TIMEOUT,
+                        help='close idle connections after this many seconds')
+    args = parser.parse_args()
+    if not args.tree and not args.watch:
+        parser.error("give a tree file or --watch RESULTS_DIR")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    manager = IndexManager(args.watch, settle_seconds=args.settle_seconds)
+    if args.tree:
+        manager.load(Path(args.tree))
+    else:
+        manager.load_latest()
+    if args.watch:
+        manager.start_watching(args.poll_interval)
+
+    server = RAPTORQueryServer(
+        manager, window_ms=args.batch_window_ms, max_batch_size=args.max_batch,
+        max_pending=args.max_pending, request_timeout=args.timeout,
+        keep_alive_timeout=args.keep_alive_timeout
+    )
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print("\n🛑 Server stopped")
+        print(json.dumps(server.stats.snapshot(), indent=2))
+    finally:
+        manager.stop()
+
+
+if __name__ == "__main__":
+    main()
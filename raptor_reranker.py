@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Cross-Encoder Reranker
+第1段（セマンティック / ハイブリッド検索）の上位N件だけをクロスエンコーダーで並べ直す第2段
+
+- (クエリ, ノード本文) のペアをバッチでスコアリング（全ノードはスコアリングしない）
+- 上限は候補数 N とレイテンシ予算（ms）。予算内に収まらないと見込まれるバッチは実行しない
+  （最初のバッチは必ず実行）。第1段の上位から順にスコアリングし、先頭から連続してスコアが揃った
+  範囲だけを並べ替える（範囲外の候補はキャッシュ済みでも第1段の順位のまま後ろに残す）
+- (クエリ, ノードID, 本文) ごとのスコアをLRUキャッシュ（同じクエリの再検索・ページングで再計算しない）
+
+使用例:
+    reranker = CrossEncoderReranker()
+    first = engine.hybrid_search(query, tree_data, top_k=50)
+    texts = [node_text(r['node_id']) for r in first]
+    results = reranker.rerank(query, first, texts, top_k=5, budget_ms=200)
+    reranker.last_timings   # {'scored': 32, 'cached': 0, 'skipped_budget': 18, 'rerank_seconds': 0.19, ...}
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+except ImportError:  # 任意依存: 第2段を使う場合のみ必要
+    torch = None
+
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"  # ローカルのHFキャッシュから読み込み
+# Alternative: "ncbi/MedCPT-Cross-Encoder" for biomedical queries
+RERANK_CANDIDATES = 50  # 第2段に渡す第1段の上位件数
+RERANK_BUDGET_MS = 200.0  # 第2段のレイテンシ予算（None で候補数のみ制限）
+RERANK_BATCH_SIZE = 16
+RERANK_CACHE_SIZE = 20_000
+
+
+class CrossEncoderReranker:
+    """クロスエンコーダーによる第2段の並べ替え（バッチ・予算・ペア単位キャッシュ）"""
+
+    def __init__(self, model_name: str = RERANK_MODEL, device: Optional[str] = None,
+                 max_length: int = 512, batch_size: int = RERANK_BATCH_SIZE,
+                 cache_size: int = RERANK_CACHE_SIZE):
+        if torch is None:
+            raise ImportError("Cross-encoder reranking requires torch and transformers; "
+                              "install them with: pip install torch transformers")
+        self.model_name = model_name
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).to(self.device)
+        self.model.eval()
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[Tuple[str, str, int], float]' = OrderedDict()
+        self.last_timings: Dict[str, Any] = {}
+
+    # ------------------------------------------------------------------
+    # スコアリング
+    # ------------------------------------------------------------------
+
+    def score_pairs(self, query: str, texts: Sequence[str]) -> np.ndarray:
+        """(クエリ, テキスト) ペアの関連度（1バッチ分、キャッシュなし）"""
+        inputs = self.tokenizer(
+            [query] * len(texts), list(texts),
+            return_tensors="pt",
+            truncation='only_second',
+            padding=True,
+            max_length=self.max_length
+        ).to(self.device)
+        with torch.no_grad():
+            logits = self.model(**inputs).logits
+        # 回帰（1出力）はそのまま、2クラス分類は「関連あり」のロジット
+        scores = logits[:, 0] if logits.shape[-1] == 1 else logits[:, -1]
+        return scores.float().cpu().numpy()
+
+    def _cache_key(self, query: str, node_id: str, text: str) -> Tuple[str, str, int]:
+        return query, node_id, hash(text)  # 本文が変わったノード（新しいビルド）は別キー
+
+    def _cache_get(self, key: Tuple[str, str, int]) -> Optional[float]:
+        score = self._cache.get(key)
+        if score is not None:
+            self._cache.move_to_end(key)
+        return score
+
+    def _cache_put(self, key: Tuple[str, str, int], score: float) -> None:
+        self._cache[key] = score
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # ------------------------------------------------------------------
+    # 並べ替え
+    # ------------------------------------------------------------------
+
+    def rerank(self, query: str, candidates: List[Dict], texts: Sequence[str], top_k: int = 5,
+               max_candidates: int = RERANK_CANDIDATES,
+               budget_ms: Optional[float] = RERANK_BUDGET_MS) -> List[Dict]:
+        """第1段の結果（順位順）を並べ替えて上位 top_k 件を返す
+
+        Args:
+            candidates: 第1段の結果辞書（'node_id' 必須、順位順）
+            texts: 各候補のクロスエンコーダー入力（summary + content など）
+            max_candidates: 第2段でスコアリングする最大件数 N
+            budget_ms: 第2段の予算。次のバッチが予算を超えると見込まれたら打ち切る
+                （最初のバッチは見積もりに使う実測がないため、予算を超える場合も必ず実行する）
+
+        第1段の上位から連続してスコアが揃った範囲（キャッシュ済みを含む）だけをクロスエンコーダーの
+        順に並べ替え、それ以降は第1段の順のまま後ろに続ける（結果がキャッシュの状態に依存しない）。
+        結果には 'rerank_score'（並べ替え範囲外は None）と 'first_stage_rank' を追加する。
+        """
+        start = time.perf_counter()
+        candidates = candidates[:max_candidates]
+        keys = [self._cache_key(query, c['node_id'], text) for c, text in zip(candidates, texts)]
+        scores: List[Optional[float]] = [self._cache_get(key) for key in keys]
+        from_cache = [score is not None for score in scores]
+
+        # 第1段の上位から順にバッチでスコアリング（予算は直近の最大バッチ時間で見積もる）
+        slowest_batch = 0.0
+        batches = 0
+        scored = 0
+        prefix = 0  # 先頭からスコアが揃った件数
+        while True:
+            while prefix < len(candidates) and scores[prefix] is not None:
+                prefix += 1  # キャッシュ済みの続きは予算を使わずに含める
+            if prefix == len(candidates):
+                break
+            elapsed = time.perf_counter() - start
+            if budget_ms is not None and batches and (elapsed + slowest_batch) * 1000.0 > budget_ms:
+                break
+            batch = [i for i in range(prefix, len(candidates)) if scores[i] is None][:self.batch_size]
+            batch_start = time.perf_counter()
+            batch_scores = self.score_pairs(query, [texts[i] for i in batch])
+            slowest_batch = max(slowest_batch, time.perf_counter() - batch_start)
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+                self._cache_put(keys[i], scores[i])
+            batches += 1
+            scored += len(batch)
+
+        # 先頭の範囲はクロスエンコーダーの順、それ以降は第1段の順
+        ranked = sorted(range(prefix), key=lambda i: -scores[i]) + list(range(prefix, len(candidates)))
+        results = []
+        for i in ranked[:top_k]:
+            result = dict(candidates[i])
+            result['rerank_score'] = scores[i] if i < prefix else None
+            result['first_stage_rank'] = i + 1
+            results.append(result)
+
+        self.last_timings = {
+            'candidates': len(candidates),
+            'scored': scored,
+            'cached': sum(from_cache[:prefix]),
+            'skipped_budget': len(candidates) - prefix,
+            'batches': batches,
+            'rerank_seconds': time.perf_counter() - start
+        }
+        return results
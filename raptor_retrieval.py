@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Retrieval
+ツリー構造を使った検索
+
+- TreeTraversalRetriever: ルートの子から開始し、各深さでクエリとのコサイン類似度が高い
+  上位 beam_width 件を残して正規化した木（raptor_tree_index.TreeIndex）の子へ降りていく。
+  スコア計算は選択ノードの子に限られるため、1クエリのコストはおおよそ log(n) に比例する。
+- CollapsedTreeRetriever: 全ノード（要約・リーフ）を1回の行列積でスコアリングし、
+  トークン予算内に貪欲に詰める。祖先・子孫関係にあり内容が重複するノードは除外する。
+
+どちらも node_mask（raptor_filters.FilterIndex.mask の結果）を受け取り、一致するノードだけを
+スコアリングする（ツリー探索では一致ノードを配下に持たない枝は降りない）。
+"""
+
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from raptor_node_store import RAPTORNodeStore
+from raptor_tree_index import TreeIndex
+
+
+class _NodeScorer:
+    """埋め込み行列とノルムを保持し、指定ノードのコサイン類似度を計算"""
+
+    def __init__(self, store: RAPTORNodeStore, tree_index: Optional[TreeIndex] = None):
+        self.store = store
+        self.index = tree_index or TreeIndex.from_store(store)
+        self._embeddings = store.embedding_matrix()
+        # ノルムのみ事前計算（行列全体の正規化コピーは作らない）
+        norms = np.linalg.norm(self._embeddings, axis=1) if self._embeddings.size else np.zeros(len(store))
+        self._inv_norms = np.where(store.has_embedding_mask & (norms > 0), 1.0 / np.maximum(norms, 1e-12), 0.0)
+
+    @staticmethod
+    def _normalize_query(query_embedding: np.ndarray) -> np.ndarray:
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        return query / norm if norm > 0 else query
+
+    def score(self, ordinals: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """指定ノードのみのコサイン類似度（埋め込みなしは -inf）"""
+        scores = (self._embeddings[ordinals] @ query) * self._inv_norms[ordinals]
+        return np.where(self._inv_norms[ordinals] > 0, scores, -np.inf)
+
+    def score_all(self, query: np.ndarray, node_mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """全ノード（node_mask 指定時は一致ノードのみ）のコサイン類似度。対象外は -inf"""
+        if not self._embeddings.size:
+            return np.full(len(self.store), -np.inf)
+        if node_mask is not None:
+            scores = np.full(len(self.store), -np.inf)
+            ordinals = np.flatnonzero(node_mask)
+            scores[ordinals] = self.score(ordinals, query)
+            return scores
+        scores = (self._embeddings @ query) * self._inv_norms
+        return np.where(self._inv_norms > 0, scores, -np.inf)
+
+
+class TreeTraversalRetriever(_NodeScorer):
+    """ビームサーチによるツリー探索型リトリーバー
+
+    使用例:
+        retriever = TreeTraversalRetriever(artifact.store, artifact.tree_index)
+        result = retriever.retrieve(query_embedding, beam_width=3, top_k=5)
+        result['results']  # 到達したリーフ（スコア順）
+        result['path']     # 深さごとの候補数と選択ノード（説明用）
+    """
+
+    def _start_nodes(self) -> np.ndarray:
+        """探索の開始ノード（単一ルートならその子、複数ルートならルート自体）"""
+        roots = self.index.roots
+        roots = roots[~self.store.is_leaf_mask[roots]] if len(roots) > 1 else roots
+        if len(roots) == 1:
+            return self.index.children(int(roots[0]))
+        return roots
+
+    def _reachable(self, node_mask: np.ndarray) -> np.ndarray:
+        """配下（自身を含む）に一致ノードを持つノード（前順の累積和で一括計算）"""
+        in_preorder = np.concatenate([[0], np.cumsum(node_mask[self.index.preorder])])
+        return in_preorder[self.index.tout + 1] - in_preorder[self.index.tin] > 0
+
+    def retrieve(self, query_embedding: np.ndarray, beam_width: int = 3, max_depth: Optional[int] = None,
+                 top_k: int = 5, include_internal: bool = False,
+                 node_mask: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """クエリ埋め込みでツリーを探索
+
+        Args:
+            beam_width: 各深さで残すノード数
+            max_depth: 降りる深さの上限（Noneでリーフまで）
+            top_k: 返す結果数
+            include_internal: Trueなら選択した内部ノードも結果候補に含める
+            node_mask: 結果にできるノード（一致ノードを配下に持たない枝は探索しない）
+        """
+        query = self._normalize_query(query_embedding)
+        is_leaf = self.store.is_leaf_mask
+        reachable = self._reachable(node_mask) if node_mask is not None else None
+        allowed = node_mask if node_mask is not None else np.ones(len(self.store), dtype=bool)
+        frontier = self._start_nodes()
+        path: List[Dict[str, Any]] = []
+        hit_ordinals: List[np.ndarray] = []
+        hit_scores: List[np.ndarray] = []
+        scored = 0
+        depth = 0
+        expand = np.zeros(0, dtype=np.int64)
+
+        while max_depth is None or depth < max_depth:
+            if reachable is not None:
+                frontier = frontier[reachable[frontier]]
+            if not len(frontier):
+                break
+            scores = self.score(frontier, query)
+            scored += len(frontier)
+            width = min(beam_width, len(frontier))
+            top = np.argpartition(-scores, width - 1)[:width]
+            top = top[np.argsort(-scores[top])]
+            selected, selected_scores = frontier[top], scores[top]
+            path.append({
+                'depth': depth,
+                'candidates': int(len(frontier)),
+                'selected': [{'node_id': self.store.node_id(int(o)), 'score': float(s),
+                              'level': int(self.store.levels[o]), 'is_leaf': bool(is_leaf[o])}
+                             for o, s in zip(selected, selected_scores)]
+            })
+
+            # リーフの候補はすべて結果候補に、内部ノードは選択されたものを任意で追加
+            leaf_mask = is_leaf[frontier] & allowed[frontier]
+            hit_ordinals.append(frontier[leaf_mask])
+            hit_scores.append(scores[leaf_mask])
+            if include_internal:
+                internal = ~is_leaf[selected] & allowed[selected]
+                hit_ordinals.append(selected[internal])
+                hit_scores.append(selected_scores[internal])
+
+            expand = selected[~is_leaf[selected]]
+            frontier = (np.concatenate([self.index.children(int(o)) for o in expand])
+                        if len(expand) else np.zeros(0, dtype=np.int64))
+            depth += 1
+
+        # max_depthで打ち切った場合は最終ビーム（未展開の内部ノード）も結果候補とする
+        if len(frontier) and len(expand) and not include_internal:
+            expand = expand[allowed[expand]]
+            hit_ordinals.append(expand)
+            hit_scores.append(self.score(expand, query))
+
+        ordinals = np.concatenate(hit_ordinals) if hit_ordinals else np.zeros(0, dtype=np.int64)
+        scores = np.concatenate(hit_scores) if hit_scores else np.zeros(0)
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        results = [{
+            'node_id': self.store.node_id(int(ordinals[i])),
+            'score': float(scores[i]),
+            'level': int(self.store.levels[ordinals[i]]),
+            'is_leaf': bool(is_leaf[ordinals[i]]),
+            'path': self.index.path_to_root_ids(int(ordinals[i]))[1:]
+        } for i in order if np.isfinite(scores[i])]
+
+        return {'results': results, 'path': path, 'scored_nodes': scored, 'total_nodes': len(self.store)}
+
+
+class CollapsedTreeRetriever(_NodeScorer):
+    """ツリーを平坦化した検索 + トークン予算付きコンテキスト組み立て
+
+    トークン数はビルド時に生成モデルのトークナイザーで計算した列（store.token_counts）を使う。
+    未計算のノードは文字数 / chars_per_token で見積もる。
+
+    使用例:
+        retriever = CollapsedTreeRetriever(artifact.store, artifact.tree_index)
+        result = retriever.retrieve(query_embedding, token_budget=2000)
+        prompt = result['context']   # 選択ノードの本文（既定はツリー順）
+        result['node_ids']           # 使用したノード
+    """
+
+    def __init__(self, store: RAPTORNodeStore, tree_index: Optional[TreeIndex] = None,
+                 chars_per_token: float = 4.0):
+        super().__init__(store, tree_index)
+        self.chars_per_token = chars_per_token
+
+    def token_count(self, ordinal: int) -> int:
+        count = int(self.store.token_counts[ordinal])
+        if count >= 0:
+            return count
+        return int(np.ceil(len(self.store.view(ordinal).content) / self.chars_per_token))
+
+    def _redundant_with(self, ordinal: int, related: np.ndarray, threshold: float) -> bool:
+        """関連ノード（祖先・子孫）のいずれかと埋め込みが近すぎる（新しい情報がない）か"""
+        if not len(related):
+            return False
+        similarity = self.score(related, self._embeddings[ordinal] * self._inv_norms[ordinal])
+        return bool(np.any(similarity >= threshold))
+
+    def retrieve(self, query_embedding: np.ndarray, token_budget: int = 2000, candidates: int = 256,
+                 redundancy_threshold: float = 0.9, min_score: Optional[float] = None,
+                 separator_tokens: int = 4, order: str = 'tree',
+                 node_mask: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """全ノードをスコアリングし、トークン予算内でコンテキストを組み立てる
+
+        Args:
+            token_budget: コンテキスト全体のトークン上限
+            candidates: 貪欲選択で検討する上位ノード数
+            redundancy_threshold: 選択済みの祖先・子孫とのコサイン類似度がこれ以上なら除外
+            min_score: クエリとの類似度の下限
+            separator_tokens: ノード間の区切りに見込むトークン数
+            order: コンテキストの並び順（'tree': ツリー前順で要約→詳細、'score': スコア順）
+            node_mask: 対象ノード（一致ノードのみスコアリング）
+        """
+        if order not in ('tree', 'score'):
+            raise ValueError("order must be 'tree' or 'score'")
+        query = self._normalize_query(query_embedding)
+        scores = self.score_all(query, node_mask)
+        valid = np.flatnonzero(np.isfinite(scores))
+        if min_score is not None:
+            valid = valid[scores[valid] >= min_score]
+        if len(valid) > candidates:
+            valid = valid[np.argpartition(-scores[valid], candidates - 1)[:candidates]]
+        ranked = valid[np.argsort(-scores[valid], kind='stable')]
+
+        tin, tout = self.index.tin, self.index.tout
+        selected: List[int] = []
+        used = 0
+        skipped_redundant = 0
+        skipped_budget = 0
+        for ordinal in ranked:
+            cost = self.token_count(int(ordinal)) + separator_tokens
+            if used + cost > token_budget:
+                skipped_budget += 1
+                continue
+            if selected:
+                chosen = np.asarray(selected, dtype=np.int64)
+                # 祖先（chosen ⊇ ordinal）または子孫（ordinal ⊇ chosen）にあたる選択済みノード
+                related = chosen[((tin[chosen] <= tin[ordinal]) & (tin[ordinal] <= tout[chosen]))
+                                 | ((tin[ordinal] <= tin[chosen]) & (tin[chosen] <= tout[ordinal]))]
+                if self._redundant_with(int(ordinal), related, redundancy_threshold):
+                    skipped_redundant += 1
+                    continue
+            selected.append(int(ordinal))
+            used += cost
+            if token_budget - used <= separator_tokens:
+                break
+
+        if order == 'tree':
+            selected.sort(key=lambda o: tin[o])
+        nodes = []
+        blocks = []
+        for ordinal in selected:
+            view = self.store.view(ordinal)
+            label = 'Document' if view.is_leaf else f'Summary (level {view.level})'
+            blocks.append(f"[{label}: {view.node_id}]\n{view.content}")
+            nodes.append({'node_id': view.node_id, 'score': float(scores[ordinal]), 'level': view.level,
+                          'is_leaf': view.is_leaf, 'tokens': self.token_count(ordinal)})
+
+        return {
+            'context': '\n\n'.join(blocks),
+            'node_ids': [node['node_id'] for node in nodes],
+            'nodes': nodes,
+            'tokens_used': used,
+            'token_budget': token_budget,
+            'skipped_redundant': skipped_redundant,
+            'skipped_budget': skipped_budget
+        }
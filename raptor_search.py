@@ -0,0 +1,613 @@
+"""
+RAPTOR Semantic Search Engine
+RAPTORツリーのキーワード（BM25）・セマンティック・ハイブリッド検索と2段階（クロスエンコーダー）再ランキング
+
+- SemanticSearchEngine: ツリーの埋め込み行列・ベクトルインデックス・BM25インデックス上の検索
+  （単発 / バッチ、フィルタ、融合方式、第2段の再ランキング）
+- load_search_engine: ツリーファイルからエンジンを作成（保存済み埋め込みがあればクエリのみエンコード）
+
+サーバー・インデックス管理・シャード・並行検索（raptor_query_server.py など）はこのモジュールを使い、
+比較テスト（test_raptor_semantic_search.py）もここからインポートする。
+sentence-transformers は埋め込みのないツリーをエンコードする場合のみ必要
+（埋め込み仕様つきのツリーは raptor_embedding.QueryEncoder でクエリをエンコード）。
+インポート時にファイルシステムへは書き込まない（キャッシュディレクトリは使用時に作成）。
+
+使用例:
+    from raptor_search import load_search_engine
+    engine = load_search_engine('results/enhanced_treg_raptor_80x_20251102_182135.json')
+    results = engine.search_batch(queries, tree_data, mode='hybrid', top_k=5)
+"""
+
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from raptor_artifact import artifact_path_for, is_artifact, load_tree_artifact, load_tree_data
+from raptor_bm25 import BM25Index
+from raptor_filters import FilterIndex, NodeFilter
+from raptor_fusion import fuse_runs
+from raptor_reranker import RERANK_BUDGET_MS, RERANK_CANDIDATES
+from raptor_embedding import (
+    EmbeddingContract, QueryEncoder, embedding_fingerprint, load_embedding_cache, save_embedding_cache
+)
+from raptor_vector_index import VectorIndex, normalize_rows
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # 任意依存: 埋め込みのないツリーを再エンコードする場合のみ必要
+    SentenceTransformer = None
+
+# ============================================================================
+# Configuration
+# ============================================================================
+
+# Semantic model selection (only for trees without stored embeddings;
+# otherwise queries are encoded with the tree's own embedding contract)
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # Fast, general-purpose model (384 dimensions)
+# Alternative: "pritamdeka/S-PubMedBert-MS-MARCO" for biomedical domain
+
+# Hybrid search weights
+KEYWORD_WEIGHT = 0.4  # 40% keyword score
+SEMANTIC_WEIGHT = 0.6  # 60% semantic score
+HYBRID_FUSION = "minmax"  # "rrf", "minmax" or "zscore" (raptor_fusion.py)
+HYBRID_CANDIDATES = {"keyword": 100, "semantic": 100}  # candidate depth per retriever before fusion
+SEARCH_MODES = ("keyword", "semantic", "hybrid")
+
+# Batch search: max query × node scores held in memory at once (float32)
+BATCH_SCORE_ELEMENTS = 64_000_000
+
+# Cache settings
+EMBEDDINGS_CACHE_DIR = Path("data/embeddings_cache")
+
+# ============================================================================
+# Search Engine
+# ============================================================================
+
+class _StoreNodeInfo:
+    """ノードストアの level / is_leaf / text を序数で遅延参照（node_info リストの代わり）"""
+    
+    def __init__(self, store):
+        self.store = store
+    
+    def __len__(self) -> int:
+        return len(self.store)
+    
+    def __getitem__(self, ordinal: int) -> Dict:
+        view = self.store.view(int(ordinal))
+        return {
+            "level": view.level,
+            "is_leaf": view.is_leaf,
+            "text": (view.summary + " " + view.content)[:200]
+        }
+
+
+class SemanticSearchEngine:
+    def __init__(self, model_name: str = EMBEDDING_MODEL, contract: EmbeddingContract = None):
+        # Use CUDA if available, otherwise CPU
+        import torch
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.contract = contract  # ツリーの埋め込み仕様（指定時はツリーと同じエンコーダーでクエリのみエンコード）
+        self.query_encoder = None
+        self.model = None
+        if contract is not None:
+            print(f"🔧 Loading query encoder: {contract.model} (pooling={contract.pooling}, normalize={contract.normalize})")
+            print(f"  Using device: {device}")
+            self.query_encoder = QueryEncoder(contract, device=device)
+        else:
+            if SentenceTransformer is None:
+                raise ImportError("Encoding trees without stored embeddings requires sentence-transformers; "
+                                  "pip install sentence-transformers")
+            print(f"🔧 Loading embedding model: {model_name}")
+            print(f"  Using device: {device}")
+            self.model = SentenceTransformer(model_name, device=device)
+        self.model_name = contract.model if contract is not None else model_name
+        self.embeddings = None
+        self.node_ids = None
+        self.node_info = None
+        self.vector_index = None  # 正規化埋め込みのFAISSインデックス（ノード数で構成を自動選択）
+        self.normalized_embeddings = None  # バッチ検索用（行列積1回でスコアリング）
+        self.last_batch_timings = {}
+        self.keyword_index = None  # BM25転置インデックス（アーティファクトに保存済みなら読み込み）
+        self.missing_rows = None  # 埋め込みのないノード（ツリーの行列を直接使う場合）
+        self._keyword_rows = None  # BM25の文書番号 → node_ids の行（同一順序なら None）
+        self._keyword_rows_for = None  # _keyword_rows を対応付けた (keyword_index, node_ids)
+        self.filter_index = None  # レベル・リーフ・Treg段階・サブツリーのマスク（raptor_filters.py）
+        self._filter_rows = None  # node_ids の行 → FilterIndex のノード序数（同一順序なら None）
+        self._filter_rows_for = None  # _filter_rows を対応付けた (filter_index, node_ids)
+        self.reranker = None  # 第2段のクロスエンコーダー（raptor_reranker.py、任意）
+        self.last_stage_timings = {}
+        
+    @classmethod
+    def from_artifact(cls, artifact) -> 'SemanticSearchEngine':
+        """
+        Search engine over the tree's build-time embeddings (no re-encoding; queries use the tree's encoder)
+        """
+        engine = cls(contract=EmbeddingContract.from_metadata(artifact.metadata))
+        engine.load_tree_embeddings(artifact)
+        return engine
+    
+    def load_tree_embeddings(self, artifact) -> None:
+        """
+        Use the stored embedding matrix, vector index and BM25 index of a loaded tree (RAPTORArtifact)
+        """
+        tree_contract = EmbeddingContract.from_metadata(artifact.metadata)
+        if self.contract is None or not self.contract.matches(tree_contract):
+            raise ValueError(
+                f"Tree embeddings were built with {tree_contract.to_dict()}; "
+                f"create the engine with SemanticSearchEngine.from_artifact() to encode queries to match"
+            )
+        store = artifact.store
+        print(f"📂 Using stored tree embeddings: {len(store)} nodes, dim={store.embedding_dim}")
+        # 行 = ノード序数（アーティファクトのFAISSインデックスのIDと一致）
+        self.embeddings = store.embedding_matrix()
+        self.node_ids = store.node_ids
+        self.node_info = _StoreNodeInfo(store)
+        has_embedding = store.has_embedding_mask
+        self.missing_rows = None if has_embedding.all() else ~has_embedding
+        self.normalized_embeddings = None
+        self.vector_index = artifact.vector_index
+        self.keyword_index = artifact.bm25_index
+        self.filter_index = FilterIndex.from_artifact(artifact)
+        print(f"  ✓ Vector index: {self.vector_index.kind} ({len(self.vector_index)} vectors)")
+        
+    def encoder_config(self) -> Dict:
+        """キャッシュのフィンガープリントに含めるエンコーダー設定"""
+        return {
+            "library": "sentence-transformers",
+            "model": self.model_name,
+            "text": "summary + ' ' + content"
+        }
+    
+    def build_embeddings(self, tree_data: Dict, cache_file: Path = None) -> None:
+        """
+        Build embeddings for all nodes (with a fingerprinted .npy + .json cache)
+        """
+        texts = []
+        node_ids = []
+        node_info = []
+        
+        # Get tree_nodes from the loaded data
+        tree_nodes = tree_data.get("tree_nodes", {})
+        
+        for node_id, info in tree_nodes.items():
+            # Get text from summary or content
+            summary = info.get("summary", "")
+            content = info.get("content", "")
+            text = summary + " " + content
+            
+            if text.strip():
+                texts.append(text)
+                node_ids.append(node_id)
+                node_info.append({
+                    "level": info.get("level", -1),
+                    "is_leaf": info.get("is_leaf", False),
+                    "text": text[:200]
+                })
+        
+        # Cache is valid only for the same node texts and encoder
+        fingerprint = embedding_fingerprint(zip(node_ids, texts), self.encoder_config())
+        if cache_file:
+            cached = load_embedding_cache(cache_file, fingerprint)
+            if cached is not None and cached[1] == node_ids:
+                print(f"📂 Loading cached embeddings from {cache_file.name} (mmap)")
+                self.embeddings = cached[0]
+                self.node_ids = node_ids
+                self.node_info = node_info
+                print(f"  ✓ Loaded {len(self.node_ids)} node embeddings")
+                self._build_vector_index()
+                return
+            if cache_file.exists():
+                print(f"⚠️ Embeddings cache {cache_file.name} does not match this tree/encoder; rebuilding")
+        
+        print("🔨 Building embeddings for all nodes...")
+        
+        # Generate embeddings (batch processing for efficiency)
+        print(f"  Processing {len(texts)} nodes...")
+        start_time = time.time()
+        # Use larger batch size for GPU, smaller for CPU
+        import torch
+        batch_size = 32 if torch.cuda.is_available() else 8
+        self.embeddings = self.model.encode(
+            texts, 
+            show_progress_bar=True, 
+            batch_size=batch_size, 
+            convert_to_numpy=True
+        )
+        elapsed = time.time() - start_time
+        print(f"  ✓ Generated {len(self.embeddings)} embeddings in {elapsed:.2f}s")
+        
+        self.node_ids = node_ids
+        self.node_info = node_info
+        self._build_vector_index()
+        
+        # Cache the embeddings
+        if cache_file:
+            print(f"💾 Saving embeddings cache to {cache_file.name}")
+            save_embedding_cache(cache_file, self.embeddings, node_ids, fingerprint, self.encoder_config())
+    
+    def _build_vector_index(self) -> None:
+        """埋め込みから近傍探索インデックスを構築（IDは node_ids の位置）"""
+        self.normalized_embeddings = normalize_rows(self.embeddings)
+        self.missing_rows = None
+        self.vector_index = VectorIndex.build(self.normalized_embeddings)
+        print(f"  ✓ Vector index: {self.vector_index.kind} ({len(self.vector_index)} vectors)")
+    
+    def load_keyword_index(self, tree_file: Path) -> None:
+        """アーティファクトに保存済みのBM25インデックスを読み込む（なければ初回検索時に構築）"""
+        tree_file = Path(tree_file)
+        if is_artifact(tree_file) or is_artifact(artifact_path_for(tree_file)):
+            self.keyword_index = load_tree_artifact(tree_file).bm25_index
+            print(f"  ✓ BM25 index: {len(self.keyword_index.vocabulary)} terms, {len(self.keyword_index)} nodes")
+    
+    def keyword_search(self, query: str, tree_data: Dict, top_k: int = 5,
+                       node_filter: NodeFilter = None) -> List[Dict]:
+        """
+        BM25 keyword search over the inverted index (built once per tree)
+        """
+        self._ensure_keyword_index(tree_data)
+        docs, scores = self.keyword_index.top_k(query, top_k, mask=self._keyword_mask(self.row_mask(node_filter)))
+        return self._keyword_results(docs, scores, tree_data)
+    
+    def _keyword_results(self, docs: np.ndarray, scores: np.ndarray, tree_data: Dict) -> List[Dict]:
+        """BM25の文書番号・スコア列から結果辞書を作る"""
+        tree_nodes = tree_data.get("tree_nodes", {})
+        results = []
+        for doc, score in zip(docs, scores):
+            node_id = self.keyword_index.labels[doc]
+            node_info = tree_nodes[node_id]
+            results.append({
+                "node_id": node_id,
+                "score": float(score),
+                "level": node_info.get("level", -1),
+                "is_leaf": node_info.get("is_leaf", False),
+                "text": (node_info.get("summary", "") + " " + node_info.get("content", ""))[:200]
+            })
+        return results
+    
+    def _ensure_keyword_index(self, tree_data: Dict) -> None:
+        """BM25インデックスを用意し、文書番号を埋め込み行（node_ids）に対応付ける"""
+        if self.keyword_index is None:
+            print("🔨 Building BM25 index...")
+            self.keyword_index = BM25Index.from_tree_nodes(tree_data.get("tree_nodes", {}))
+        # 対応付けはインデックス・node_ids ごとに1回（検索ごとに全ラベルを比較しない）
+        aligned_for = self._keyword_rows_for
+        if aligned_for is not None and aligned_for[0] is self.keyword_index and aligned_for[1] is self.node_ids:
+            return
+        if list(self.keyword_index.labels) == list(self.node_ids):
+            self._keyword_rows = None
+        else:
+            row_of = {node_id: row for row, node_id in enumerate(self.node_ids)}
+            self._keyword_rows = np.array([row_of.get(label, -1) for label in self.keyword_index.labels],
+                                          dtype=np.int64)
+        self._keyword_rows_for = (self.keyword_index, self.node_ids)
+    
+    def keyword_candidates(self, query: str, tree_data: Dict, depth: int,
+                           row_mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25上位 depth 件を (行, スコア) で返す（行は node_ids の位置、埋め込みのないノードは -1）"""
+        self._ensure_keyword_index(tree_data)
+        docs, scores = self.keyword_index.top_k(query, depth, mask=self._keyword_mask(row_mask))
+        return self._keyword_to_rows(docs), scores
+    
+    def _keyword_to_rows(self, docs: np.ndarray) -> np.ndarray:
+        return docs if self._keyword_rows is None else self._keyword_rows[docs]
+    
+    def semantic_candidates(self, query_embedding: np.ndarray, depth: int,
+                            row_mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """ベクトル検索上位 depth 件を (行, スコア) で返す"""
+        scores, rows = self.vector_index.search(query_embedding, depth, id_mask=row_mask)
+        return rows[0], scores[0]
+    
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Encode a batch of queries in one pass (L2-normalized rows)
+        """
+        import torch
+        batch_size = 64 if torch.cuda.is_available() else 16
+        if self.query_encoder is not None:
+            embeddings = self.query_encoder.encode(list(queries), batch_size=batch_size)
+        else:
+            embeddings = self.model.encode(list(queries), batch_size=batch_size, convert_to_numpy=True)
+        return normalize_rows(embeddings)
+    
+    def _semantic_results(self, indices: np.ndarray, scores: np.ndarray) -> List[Dict]:
+        """行番号・スコア列から結果辞書を作る（-1 はスキップ）"""
+        results = []
+        for idx, score in zip(indices, scores):
+            if idx < 0:
+                continue
+            results.append({
+                "node_id": self.node_ids[idx],
+                "score": float(score),  # 0-1 range
+                "level": self.node_info[idx]["level"],
+                "is_leaf": self.node_info[idx]["is_leaf"],
+                "text": self.node_info[idx]["text"]
+            })
+        return results
+    
+    def row_mask(self, node_filter: NodeFilter = None) -> np.ndarray:
+        """
+        Boolean mask over node_ids rows for a filter (None = no filter)
+        e.g. leaves() & treg_stage(5), summaries() | level(1)
+        """
+        if node_filter is None:
+            return None
+        if self.filter_index is None:
+            raise ValueError("Filtered search needs a FilterIndex: use SemanticSearchEngine.from_artifact() "
+                             "or set engine.filter_index = FilterIndex(store, ...)")
+        mask = self.filter_index.mask(node_filter)
+        self._ensure_filter_rows()
+        return mask if self._filter_rows is None else mask[self._filter_rows]
+    
+    def _ensure_filter_rows(self) -> None:
+        """FilterIndex のノード序数を node_ids の行に対応付ける（インデックス・node_ids ごとに1回）"""
+        aligned_for = self._filter_rows_for
+        if aligned_for is not None and aligned_for[0] is self.filter_index and aligned_for[1] is self.node_ids:
+            return
+        store = self.filter_index.store
+        if list(store.node_ids) == list(self.node_ids):
+            self._filter_rows = None
+        else:
+            self._filter_rows = np.array([store.ordinal(node_id) for node_id in self.node_ids], dtype=np.int64)
+        self._filter_rows_for = (self.filter_index, self.node_ids)
+    
+    def prepare(self, tree_data: Dict) -> None:
+        """
+        Build all state that searches otherwise create lazily (normalized matrix, BM25, row mappings),
+        so that searching only reads the engine (see raptor_concurrent_search.FrozenSearchIndex)
+        """
+        if self.normalized_embeddings is None and not self._search_vector_index():
+            self.normalized_embeddings = normalize_rows(self.embeddings)
+        self._ensure_keyword_index(tree_data)
+        if self.filter_index is not None:
+            self._ensure_filter_rows()
+    
+    def _keyword_mask(self, row_mask: np.ndarray) -> np.ndarray:
+        """行マスクをBM25の文書番号上のマスクに変換"""
+        if row_mask is None or self._keyword_rows is None:
+            return row_mask
+        return (self._keyword_rows >= 0) & row_mask[np.maximum(self._keyword_rows, 0)]
+    
+    def semantic_search(self, query: str, top_k: int = 5, query_embedding: np.ndarray = None,
+                        node_filter: NodeFilter = None) -> List[Dict]:
+        """
+        Pure semantic search using cosine similarity (inner product on normalized vectors)
+        node_filter restricts the search to matching nodes during the index search
+        """
+        # Encode query (unless the caller already encoded it)
+        if query_embedding is None:
+            query_embedding = self.encode_queries([query])[0]
+        
+        # Top-k from the vector index (no full sort over all nodes)
+        scores, indices = self.vector_index.search(query_embedding, top_k, id_mask=self.row_mask(node_filter))
+        return self._semantic_results(indices[0], scores[0])
+    
+    def _search_vector_index(self) -> bool:
+        """バッチのセマンティック検索を近傍探索インデックスで行うか（厳密なflat以外）"""
+        return self.vector_index is not None and not self.vector_index.exact
+    
+    def batch_semantic_scores(self, query_embeddings: np.ndarray, top_k: int,
+                              row_mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k for a batch of normalized queries: one matmul per chunk + row-wise argpartition
+        (with row_mask only the matching rows are multiplied)
+        Approximate / compressed vector indexes (hnsw, ivf, sq8, ivfpq) are searched as a batch instead,
+        without materializing a normalized copy of the embedding matrix (missing results are -1)
+        Returns (scores, indices) of shape (n_queries, k), sorted by score descending
+        """
+        if self._search_vector_index():
+            return self.vector_index.search(query_embeddings, top_k, id_mask=row_mask)
+        if self.normalized_embeddings is None:
+            self.normalized_embeddings = normalize_rows(self.embeddings)
+        candidates = None
+        if row_mask is not None or self.missing_rows is not None:
+            allowed = np.ones(len(self.normalized_embeddings), dtype=bool) if row_mask is None else row_mask.copy()
+            if self.missing_rows is not None:
+                allowed &= ~self.missing_rows
+            candidates = np.flatnonzero(allowed)
+        matrix = self.normalized_embeddings if candidates is None else self.normalized_embeddings[candidates]
+        n_nodes = len(matrix)
+        k = min(top_k, n_nodes)
+        n_queries = len(query_embeddings)
+        top_scores = np.zeros((n_queries, k), dtype=np.float32)
+        top_indices = np.zeros((n_queries, k), dtype=np.int64)
+        if k == 0:
+            return top_scores, top_indices
+        
+        chunk = max(1, BATCH_SCORE_ELEMENTS // max(n_nodes, 1))
+        for start in range(0, n_queries, chunk):
+            scores = query_embeddings[start:start + chunk] @ matrix.T
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            part = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-part, axis=1)
+            top_indices[start:start + chunk] = np.take_along_axis(top, order, axis=1)
+            top_scores[start:start + chunk] = np.take_along_axis(part, order, axis=1)
+        if candidates is not None:
+            top_indices = candidates[top_indices]
+        return top_scores, top_indices
+    
+    def batch_search(self, queries: List[str], tree_data: Dict, top_k: int = 5,
+                     keyword_weight: float = KEYWORD_WEIGHT,
+                     semantic_weight: float = SEMANTIC_WEIGHT,
+                     fusion: str = HYBRID_FUSION, depths: Dict[str, int] = None,
+                     node_filter: NodeFilter = None) -> List[Dict]:
+        """
+        Keyword, semantic and hybrid results for a batch of queries
+        (queries are encoded once and shared by semantic and hybrid search)
+        """
+        depths = {**HYBRID_CANDIDATES, **(depths or {})}
+        row_mask = self.row_mask(node_filter)
+        start = time.time()
+        query_embeddings = self.encode_queries(queries)
+        encode_time = time.time() - start
+        
+        start = time.time()
+        scores, indices = self.batch_semantic_scores(query_embeddings, max(top_k, depths["semantic"]), row_mask)
+        semantic_time = time.time() - start
+        
+        results = []
+        start = time.time()
+        self._ensure_keyword_index(tree_data)
+        keyword_mask = self._keyword_mask(row_mask)
+        for i, query in enumerate(queries):
+            docs, keyword_scores = self.keyword_index.top_k(query, max(top_k, depths["keyword"]), mask=keyword_mask)
+            runs = {
+                "keyword": (self._keyword_to_rows(docs[:depths["keyword"]]), keyword_scores[:depths["keyword"]]),
+                "semantic": (indices[i][:depths["semantic"]], scores[i][:depths["semantic"]])
+            }
+            results.append({
+                "query": query,
+                "keyword": self._keyword_results(docs[:top_k], keyword_scores[:top_k], tree_data),
+                "semantic": self._semantic_results(indices[i][:top_k], scores[i][:top_k]),
+                "hybrid": self._fuse(runs, fusion, keyword_weight, semantic_weight, top_k)
+            })
+        fusion_time = time.time() - start
+        
+        self.last_batch_timings = {
+            "queries": len(queries),
+            "encode": encode_time,
+            "semantic": semantic_time,
+            "keyword_hybrid": fusion_time
+        }
+        return results
+    
+    def search_batch(self, queries: List[str], tree_data: Dict, mode: str = "hybrid", top_k: int = 5,
+                     query_embeddings: np.ndarray = None, node_filter: NodeFilter = None,
+                     fusion: str = HYBRID_FUSION, depths: Dict[str, int] = None,
+                     keyword_weight: float = KEYWORD_WEIGHT,
+                     semantic_weight: float = SEMANTIC_WEIGHT) -> List[List[Dict]]:
+        """
+        Results of one search mode ("keyword", "semantic" or "hybrid") for a batch of queries
+        (semantic scores for the whole batch come from one matmul; query_embeddings may be precomputed)
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode} (expected one of {SEARCH_MODES})")
+        depths = {**HYBRID_CANDIDATES, **(depths or {})}
+        row_mask = self.row_mask(node_filter)
+        if mode != "keyword":
+            if query_embeddings is None:
+                query_embeddings = self.encode_queries(queries)
+            depth = top_k if mode == "semantic" else depths["semantic"]
+            scores, indices = self.batch_semantic_scores(query_embeddings, depth, row_mask)
+        if mode != "semantic":
+            self._ensure_keyword_index(tree_data)
+            keyword_mask = self._keyword_mask(row_mask)
+        
+        results = []
+        for i, query in enumerate(queries):
+            if mode == "semantic":
+                results.append(self._semantic_results(indices[i], scores[i]))
+                continue
+            depth = top_k if mode == "keyword" else depths["keyword"]
+            docs, keyword_scores = self.keyword_index.top_k(query, depth, mask=keyword_mask)
+            if mode == "keyword":
+                results.append(self._keyword_results(docs, keyword_scores, tree_data))
+                continue
+            runs = {
+                "keyword": (self._keyword_to_rows(docs), keyword_scores),
+                "semantic": (indices[i], scores[i])
+            }
+            results.append(self._fuse(runs, fusion, keyword_weight, semantic_weight, top_k))
+        return results
+    
+    def hybrid_search(self, query: str, tree_data: Dict, 
+                     keyword_weight: float = KEYWORD_WEIGHT,
+                     semantic_weight: float = SEMANTIC_WEIGHT,
+                     top_k: int = 5, query_embedding: np.ndarray = None,
+                     fusion: str = HYBRID_FUSION, depths: Dict[str, int] = None,
+                     node_filter: NodeFilter = None) -> List[Dict]:
+        """
+        Hybrid search: fuses BM25 and semantic candidates over node-aligned score arrays
+        (fusion: "rrf", "minmax" or "zscore"; depths: candidates per retriever;
+        node_filter: only matching nodes are scored by either retriever)
+        """
+        depths = {**HYBRID_CANDIDATES, **(depths or {})}
+        if query_embedding is None:
+            query_embedding = self.encode_queries([query])[0]
+        row_mask = self.row_mask(node_filter)
+        runs = {
+            "keyword": self.keyword_candidates(query, tree_data, depths["keyword"], row_mask),
+            "semantic": self.semantic_candidates(query_embedding, depths["semantic"], row_mask)
+        }
+        return self._fuse(runs, fusion, keyword_weight, semantic_weight, top_k)
+    
+    def two_stage_search(self, query: str, tree_data: Dict, top_k: int = 5, first_stage: str = "hybrid",
+                         candidates: int = RERANK_CANDIDATES, budget_ms: float = RERANK_BUDGET_MS,
+                         query_embedding: np.ndarray = None, node_filter: NodeFilter = None) -> List[Dict]:
+        """
+        First stage (semantic or hybrid top-N) reranked by the cross-encoder within budget_ms
+        Stage timings are kept in last_stage_timings
+        """
+        if self.reranker is None:
+            raise ValueError("Two-stage search needs a reranker: engine.reranker = CrossEncoderReranker()")
+        start = time.time()
+        if first_stage == "semantic":
+            first = self.semantic_search(query, candidates, query_embedding=query_embedding, node_filter=node_filter)
+        else:
+            first = self.hybrid_search(query, tree_data, top_k=candidates, query_embedding=query_embedding,
+                                       node_filter=node_filter)
+        first_stage_time = time.time() - start
+        
+        start = time.time()
+        texts = self.node_texts([result["node_id"] for result in first], tree_data)
+        results = self.reranker.rerank(query, first, texts, top_k=top_k, max_candidates=candidates,
+                                       budget_ms=budget_ms)
+        self.last_stage_timings = {
+            "first_stage": first_stage_time,
+            "rerank": time.time() - start,
+            **{key: value for key, value in self.reranker.last_timings.items() if key != "rerank_seconds"}
+        }
+        return results
+    
+    def node_texts(self, node_ids: List[str], tree_data: Dict) -> List[str]:
+        """クロスエンコーダー入力用の本文（summary + content、結果辞書の200文字ではなく全文）"""
+        tree_nodes = tree_data.get("tree_nodes", {})
+        return [(tree_nodes[node_id].get("summary", "") + " " + tree_nodes[node_id].get("content", "")).strip()
+                for node_id in node_ids]
+    
+    def _fuse(self, runs: Dict, fusion: str, keyword_weight: float, semantic_weight: float,
+              top_k: int) -> List[Dict]:
+        """候補を統合し、上位 top_k 件のみ結果辞書に変換"""
+        rows, scores, components = fuse_runs(
+            runs, len(self.node_ids), method=fusion,
+            weights={"keyword": keyword_weight, "semantic": semantic_weight}, top_k=top_k
+        )
+        results = []
+        for i, row in enumerate(rows):
+            info = self.node_info[row]
+            results.append({
+                "node_id": self.node_ids[row],
+                "score": float(scores[i]),
+                "keyword_score": float(components["keyword"][i]),
+                "semantic_score": float(components["semantic"][i]),
+                "level": info["level"],
+                "is_leaf": info["is_leaf"],
+                "text": info["text"]
+            })
+        return results
+
+# ============================================================================
+# Loading
+# ============================================================================
+
+def load_search_engine(tree_file: Path) -> SemanticSearchEngine:
+    """
+    Search engine for a tree file (stored tree embeddings when present, otherwise cached re-encoding)
+    """
+    tree_file = Path(tree_file)
+    # Load tree (uses the .raptor artifact next to the JSON when present)
+    artifact = load_tree_artifact(tree_file)
+    
+    if artifact.store.embedding_dim:
+        # Search the build-time embeddings directly; only queries are encoded (same model/pooling)
+        return SemanticSearchEngine.from_artifact(artifact)
+    
+    # Tree without stored embeddings: encode all nodes with EMBEDDING_MODEL (cached)
+    tree_data = load_tree_data(tree_file)
+    semantic_engine = SemanticSearchEngine(EMBEDDING_MODEL)
+    EMBEDDINGS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_file = EMBEDDINGS_CACHE_DIR / f"embeddings_{tree_file.stem}_{EMBEDDING_MODEL.replace('/', '_')}.npy"
+    semantic_engine.build_embeddings(tree_data, cache_file=cache_file)
+    semantic_engine.load_keyword_index(tree_file)
+    return semantic_engine
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Sharded Search
+複数のツリー（スケール違い・compare_3versions_fixed.py の各版・トピック別に分割したコーパス）を
+1つの検索窓口で並列に検索し、シャードごとの上位k件をヒープでマージして全体の上位k件を返す
+
+- シャード = 1ツリーの SemanticSearchEngine + tree_data。スレッドで並列に検索する
+  （行列積・FAISS・BM25のnumpy処理はGILを解放するため、モデルを複製するプロセス並列は使わない）
+- クエリのエンコードは埋め込み仕様（モデル・プーリング・正規化）が同じシャード間で1回だけ
+- ノードIDは "シャード名:ローカルID" で名前空間化（結果には shard / local_node_id も付ける）
+- シャードごとのレイテンシ（直近・p50 / p99）を記録
+
+スコアの比較可能性: セマンティック検索のコサイン類似度は同じ埋め込み仕様のシャード間で比較できる。
+BM25（語のIDFがシャードごと）とハイブリッド（候補内で正規化）のスコアはシャード内の値のため、
+マージは近似になる。
+
+使用例:
+    sharded = ShardedSearchEngine.from_tree_files({
+        'v1': 'results/enhanced_treg_raptor_80x_20251102_142100.json',
+        'v3': 'results/enhanced_treg_raptor_80x_20251102_182135.json',
+    })
+    results = sharded.search("Foxp3 stability", top_k=10, mode='semantic')
+    results[0]['node_id']         # 'v3:doc_42'
+    sharded.last_shard_timings    # {'v1': 0.004, 'v3': 0.005}
+
+    python raptor_sharded_search.py results/enhanced_treg_raptor_80x_*.json --query "IL-10 suppression"
+"""
+
+import argparse
+import heapq
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from raptor_artifact import load_tree_data
+from raptor_filters import NodeFilter
+from raptor_metrics import latency_summary_ms
+from raptor_search import HYBRID_FUSION, SEARCH_MODES, SemanticSearchEngine, load_search_engine
+
+SHARD_SEPARATOR = ':'
+LATENCY_WINDOW = 1_000
+
+logger = logging.getLogger(__name__)
+
+
+def namespaced_id(shard: str, node_id: str) -> str:
+    return f"{shard}{SHARD_SEPARATOR}{node_id}"
+
+
+def split_node_id(global_id: str) -> Tuple[str, str]:
+    """"シャード名:ローカルID" → (シャード名, ローカルID)"""
+    shard, separator, node_id = global_id.partition(SHARD_SEPARATOR)
+    if not separator:
+        raise ValueError(f"Not a namespaced node id: {global_id}")
+    return shard, node_id
+
+
+def shard_name_for(tree_file: Union[str, Path]) -> str:
+    """ツリーファイル名からシャード名（enhanced_treg_raptor_80x_20251102_182135 → 80x_20251102_182135）"""
+    return Path(tree_file).stem.replace('enhanced_treg_raptor_', '')
+
+
+class SearchShard:
+    """1ツリー分の検索エンジンとレイテンシ履歴"""
+
+    def __init__(self, name: str, engine: SemanticSearchEngine, tree_data: Dict):
+        if SHARD_SEPARATOR in name:
+            raise ValueError(f"Shard name must not contain '{SHARD_SEPARATOR}': {name}")
+        self.name = name
+        self.engine = engine
+        self.tree_data = tree_data
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.errors = 0
+
+    @property
+    def encoder_key(self) -> Tuple:
+        """同じクエリ埋め込みを共有できるシャードの識別子"""
+        contract = self.engine.contract
+        if contract is not None:
+            return ('contract', contract.model, contract.pooling, contract.normalize)
+        return ('sentence-transformers', self.engine.model_name)
+
+    def search(self, queries: List[str], mode: str, top_k: int, query_embeddings: Optional[np.ndarray],
+               node_filter: Optional[NodeFilter], fusion: str) -> List[List[Dict]]:
+        start = time.perf_counter()
+        try:
+            return self.engine.search_batch(queries, self.tree_data, mode=mode, top_k=top_k,
+                                            query_embeddings=query_embeddings, node_filter=node_filter,
+                                            fusion=fusion)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def latency_ms(self) -> Dict[str, float]:
+        return latency_summary_ms(self.latencies)
+
+
+class ShardedSearchEngine:
+    """複数ツリーの並列検索とグローバル上位k件のマージ"""
+
+    def __init__(self, shards: Sequence[SearchShard], max_workers: Optional[int] = None,
+                 allow_partial: bool = True):
+        names = [shard.name for shard in shards]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Duplicate shard names: {names}")
+        self.shards = list(shards)
+        self.allow_partial = allow_partial  # 失敗したシャードを除いて返す（False なら例外）
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or len(self.shards),
+                                            thread_name_prefix='raptor-shard')
+        self.last_shard_timings: Dict[str, float] = {}
+        self.last_shard_errors: Dict[str, str] = {}
+        if len({shard.encoder_key for shard in self.shards}) > 1:
+            logger.warning("⚠️ Shards use different embedding models; semantic scores are merged as-is")
+
+    @classmethod
+    def from_tree_files(cls, tree_files: Union[Mapping[str, Union[str, Path]], Sequence[Union[str, Path]]],
+                        **kwargs) -> 'ShardedSearchEngine':
+        """ツリーファイルからシャードを作る（リストならシャード名はファイル名から）"""
+        if not isinstance(tree_files, Mapping):
+            tree_files = {shard_name_for(path): path for path in tree_files}
+        shards = []
+        for name, path in tree_files.items():
+            print(f"📂 Loading shard '{name}': {Path(path).name}")
+            shards.append(SearchShard(name, load_search_engine(Path(path)), load_tree_data(path)))
+        return cls(shards, **kwargs)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    # ------------------------------------------------------------------
+    # 検索
+    # ------------------------------------------------------------------
+
+    def _encode(self, queries: List[str], mode: str) -> Dict[Tuple, np.ndarray]:
+        """埋め込み仕様ごとに1回だけクエリをエンコード"""
+        if mode == 'keyword':
+            return {}
+        embeddings: Dict[Tuple, np.ndarray] = {}
+        for shard in self.shards:
+            if shard.encoder_key not in embeddings:
+                embeddings[shard.encoder_key] = shard.engine.encode_queries(queries)
+        return embeddings
+
+    def batch_search(self, queries: List[str], top_k: int = 5, mode: str = 'semantic',
+                     node_filter: Optional[NodeFilter] = None, fusion: str = HYBRID_FUSION) -> List[List[Dict]]:
+        """全シャードを並列に検索し、クエリごとにスコア順でマージした上位 top_k 件"""
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode} (expected one of {SEARCH_MODES})")
+        embeddings = self._encode(queries, mode)
+        futures = {
+            shard.name: self._executor.submit(shard.search, queries, mode, top_k,
+                                              embeddings.get(shard.encoder_key), node_filter, fusion)
+            for shard in self.shards
+        }
+
+        per_shard: Dict[str, List[List[Dict]]] = {}
+        self.last_shard_errors = {}
+        for shard in self.shards:
+            try:
+                per_shard[shard.name] = futures[shard.name].result()
+            except Exception as e:
+                shard.errors += 1
+                if not self.allow_partial:
+                    raise
+                logger.warning(f"⚠️ Shard '{shard.name}' failed: {e}")
+                self.last_shard_errors[shard.name] = f"{type(e).__name__}: {e}"
+        self.last_shard_timings = {shard.name: shard.latencies[-1] for shard in self.shards if shard.latencies}
+
+        return [self._merge({name: results[i] for name, results in per_shard.items()}, top_k)
+                for i in range(len(queries))]
+
+    def search(self, query: str, top_k: int = 5, mode: str = 'semantic',
+               node_filter: Optional[NodeFilter] = None, fusion: str = HYBRID_FUSION) -> List[Dict]:
+        return self.batch_search([query], top_k, mode, node_filter, fusion)[0]
+
+    @staticmethod
+    def _merge(shard_results: Dict[str, List[Dict]], top_k: int) -> List[Dict]:
+        """スコア降順のシャード結果をヒープでk-wayマージ（上位 top_k 件のみ取り出す）"""
+        runs = [
+            [{**result, 'node_id': namespaced_id(name, result['node_id']),
+              'local_node_id': result['node_id'], 'shard': name} for result in results]
+            for name, results in shard_results.items()
+        ]
+        merged = heapq.merge(*runs, key=lambda result: -result['score'])
+        return [result for _, result in zip(range(top_k), merged)]
+
+    def node(self, global_id: str) -> Dict[str, Any]:
+        """名前空間付きIDからノード情報（tree_nodes の辞書）を引く"""
+        shard_name, node_id = split_node_id(global_id)
+        for shard in self.shards:
+            if shard.name == shard_name:
+                return shard.tree_data['tree_nodes'][node_id]
+        raise KeyError(f"Unknown shard: {shard_name}")
+
+    def shard_latency(self) -> Dict[str, Dict[str, float]]:
+        """シャードごとのレイテンシ（直近 LATENCY_WINDOW 回、/metrics と同じ項目: raptor_metrics.py）と失敗数"""
+        return {shard.name: {**shard.latency_ms(), 'errors': shard.errors} for shard in self.shards}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search several RAPTOR trees in parallel and merge top-k")
+    parser.add_argument('trees', nargs='+', help='trees (JSON or .raptor); NAME=PATH to set the shard name')
+    parser.add_argument('--query', action='append', required=True, help='query (repeat for several)')
+    parser.add_argument('--mode', default='semantic', choices=SEARCH_MODES)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    tree_files = {}
+    for spec in args.trees:
+        name, separator, path = spec.partition('=')
+        if separator:
+            tree_files[name] = path
+        else:
+            tree_files[shard_name_for(spec)] = spec
+    sharded = ShardedSearchEngine.from_tree_files(tree_files)
+    try:
+        start = time.time()
+        results = sharded.batch_search(args.query, top_k=args.top_k, mode=args.mode)
+        elapsed = time.time() - start
+        for query, hits in zip(args.query, results):
+            print(f"\n❓ {query}")
+            for rank, hit in enumerate(hits, 1):
+                print(f"  {rank:>2}. {hit['node_id']:<48} score={hit['score']:.4f} "
+                      f"level={hit['level']} {'leaf' if hit['is_leaf'] else 'summary'}")
+        print(f"\n⏱️  {elapsed * 1000:.1f}ms for {len(args.query)} queries over {len(sharded.shards)} shards")
+        for name, latency in sharded.shard_latency().items():
+            print(f"  {name:<28} last={latency['last']:.1f}ms p50={latency['p50']:.1f}ms "
+                  f"p99={latency['p99']:.1f}ms errors={latency['errors']}")
+        for name, error in sharded.last_shard_errors.items():
+            print(f"  ⚠️ {name}: {error}")
+    finally:
+        sharded.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Tree SQLite Export
+ビルド成果物をインデックス付きSQLiteデータベースへ書き出し、アドホッククエリに使う
+
+テーブル:
+    nodes           ノード（level / parent / cluster / depth / Euler区間 tin・tout / 本文）
+    edges           親子関係（childrenの並び順を保持）
+    node_documents  ノード配下の全文書（木インデックスから展開、30件の切り詰めなし）
+    documents       文書メタデータ（PMID・タイトル・判定レベル、treg_documents_80x_*.jsonから）
+    level_stats     レベル別統計
+    meta            ビルドメタデータ（JSON）
+
+使用例:
+    python raptor_sqlite.py export results/enhanced_treg_raptor_80x_*.json \\
+        --documents results/treg_documents_80x_*.json
+    python raptor_sqlite.py query results/enhanced_treg_raptor_80x_*.sqlite --pmid 12345678
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+from raptor_node_store import RAPTORNodeStore
+from raptor_tree_index import TreeIndex
+
+SQLITE_SUFFIX = '.sqlite'
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE nodes (
+    ord INTEGER PRIMARY KEY,
+    node_id TEXT NOT NULL UNIQUE,
+    parent_id TEXT,
+    level INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    tin INTEGER NOT NULL,
+    tout INTEGER NOT NULL,
+    is_leaf INTEGER NOT NULL,
+    cluster_id INTEGER,
+    cluster_size INTEGER NOT NULL,
+    document_count INTEGER NOT NULL,
+    content TEXT,
+    summary TEXT,
+    source_documents TEXT
+);
+CREATE TABLE edges (parent_id TEXT NOT NULL, child_id TEXT NOT NULL, position INTEGER NOT NULL);
+CREATE TABLE node_documents (node_id TEXT NOT NULL, document_id TEXT NOT NULL);
+CREATE TABLE documents (
+    document_id TEXT PRIMARY KEY,
+    pmid TEXT,
+    title TEXT,
+    determined_level INTEGER,
+    label TEXT
+);
+CREATE TABLE level_stats (
+    level INTEGER PRIMARY KEY,
+    node_count INTEGER NOT NULL,
+    leaf_count INTEGER NOT NULL,
+    avg_cluster_size REAL,
+    min_cluster_size INTEGER,
+    max_cluster_size INTEGER,
+    document_count INTEGER NOT NULL
+);
+"""
+
+# 一括挿入の後に作成する（挿入中のインデックス更新を避ける）
+_INDEXES = """
+CREATE INDEX idx_nodes_level ON nodes(level);
+CREATE INDEX idx_nodes_parent ON nodes(parent_id);
+CREATE INDEX idx_nodes_tin ON nodes(tin);
+CREATE INDEX idx_edges_parent ON edges(parent_id, position);
+CREATE INDEX idx_edges_child ON edges(child_id);
+CREATE INDEX idx_node_documents_doc ON node_documents(document_id);
+CREATE INDEX idx_node_documents_node ON node_documents(node_id);
+CREATE INDEX idx_documents_pmid ON documents(pmid);
+"""
+
+_NODE_COLUMNS = ('node_id', 'parent_id', 'level', 'content', 'summary', 'is_leaf',
+                 'cluster_id', 'cluster_size', 'source_documents')
+
+
+def sqlite_path_for(json_path: Union[str, Path]) -> Path:
+    """JSON出力に対応するデータベースのパス（同名 + .sqlite）"""
+    json_path = Path(json_path)
+    return json_path.with_name(json_path.stem + SQLITE_SUFFIX)
+
+
+def export_sqlite(store: RAPTORNodeStore, db_path: Union[str, Path],
+                  metadata: Optional[Dict[str, Any]] = None,
+                  documents: Optional[Sequence[Dict[str, Any]]] = None,
+                  tree_index: Optional[TreeIndex] = None) -> Path:
+    """ノードストアをSQLiteへ書き出す（一時ファイル→リネーム）
+
+    documents には treg_documents_80x_*.json の内容（id / pmid / title / determined_level / label）を渡す。
+    """
+    db_path = Path(db_path)
+    tmp_path = db_path.with_name(db_path.name + f'.tmp-{os.getpid()}')
+    if tmp_path.exists():
+        tmp_path.unlink()
+    index = tree_index or TreeIndex.from_store(store)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.executescript(_SCHEMA)
+
+        def node_rows():
+            for ordinal in range(len(store)):
+                node = store.view(ordinal)
+                yield (ordinal, node.node_id, node.parent_id, node.level, int(index.depth[ordinal]),
+                       int(index.tin[ordinal]), int(index.tout[ordinal]), int(node.is_leaf),
+                       node.cluster_id, node.cluster_size, index.document_count(ordinal),
+                       node.content, node.summary,
+                       json.dumps(node.source_documents, ensure_ascii=False, separators=(',', ':')))
+
+        def edge_rows():
+            for ordinal in range(len(store)):
+                node_id = store.node_id(ordinal)
+                for position, child_id in enumerate(store.view(ordinal).children):
+                    yield node_id, child_id, position
+
+        def membership_rows():
+            for ordinal in range(len(store)):
+                node_id = store.node_id(ordinal)
+                for document_id in index.subtree_documents(ordinal):
+                    yield node_id, document_id
+
+        conn.executemany('INSERT INTO nodes VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', node_rows())
+        conn.executemany('INSERT INTO edges VALUES (?,?,?)', edge_rows())
+        conn.executemany('INSERT INTO node_documents VALUES (?,?)', membership_rows())
+        if documents:
+            conn.executemany('INSERT OR REPLACE INTO documents VALUES (?,?,?,?,?)', (
+                (doc['id'], str(doc.get('pmid', '')), doc.get('title', ''),
+                 doc.get('determined_level'), doc.get('label'))
+                for doc in documents
+            ))
+        conn.execute("""
+            INSERT INTO level_stats
+            SELECT level, COUNT(*), SUM(is_leaf), AVG(cluster_size), MIN(cluster_size),
+                   MAX(cluster_size), SUM(document_count)
+            FROM nodes GROUP BY level
+        """)
+        conn.executemany('INSERT INTO meta VALUES (?,?)', [
+            ('schema_version', str(SCHEMA_VERSION)),
+            ('metadata', json.dumps(metadata or {}, ensure_ascii=False, default=str)),
+        ])
+        conn.executescript(_INDEXES)
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, db_path)
+    return db_path
+
+
+class RAPTORTreeDB:
+    """SQLiteに書き出したツリーへの読み取り専用クエリAPI
+
+    返すノード辞書はJSON出力（tree_nodes）と同じ形。
+    """
+
+    def __init__(self, db_path: Union[str, Path]):
+        self.path = Path(db_path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"Tree database not found: {self.path}")
+        self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self) -> 'RAPTORTreeDB':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.close()
+        return False
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        """任意のSQL（アドホック分析用）"""
+        return self._conn.execute(sql, params).fetchall()
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'metadata'").fetchone()
+        return json.loads(row['value']) if row else {}
+
+    # ------------------------------------------------------------------
+    # ノード
+    # ------------------------------------------------------------------
+
+    def _to_dicts(self, rows: Iterable[sqlite3.Row]) -> List[Dict[str, Any]]:
+        rows = list(rows)
+        if not rows:
+            return []
+        children: Dict[str, List[str]] = {row['node_id']: [] for row in rows}
+        ids = list(children)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for edge in self._conn.execute(
+                f"SELECT parent_id, child_id FROM edges WHERE parent_id IN ({placeholders}) "
+                f"ORDER BY parent_id, position", chunk
+            ):
+                children[edge['parent_id']].append(edge['child_id'])
+
+        result = []
+        for row in rows:
+            result.append({
+                'node_id': row['node_id'],
+                'parent_id': row['parent_id'],
+                'children': children[row['node_id']],
+                'level': row['level'],
+                'content': row['content'],
+                'summary': row['summary'],
+                'is_leaf': bool(row['is_leaf']),
+                'cluster_id': row['cluster_id'],
+                'cluster_size': row['cluster_size'],
+                'source_documents': json.loads(row['source_documents'] or '[]')
+            })
+        return result
+
+    def _select(self, where: str, params: Sequence[Any] = (), order: str = 'ord',
+                limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        sql = f"SELECT {', '.join(_NODE_COLUMNS)} FROM nodes WHERE {where} ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self._to_dicts(self._conn.execute(sql, params))
+
+    def node(self, node_id: str) -> Optional[Dict[str, Any]]:
+        found = self._select('node_id = ?', (node_id,))
+        return found[0] if found else None
+
+    def nodes_at_level(self, level: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self._select('level = ?', (level,), limit=limit)
+
+    def children(self, node_id: str) -> List[Dict[str, Any]]:
+        return self._select('node_id IN (SELECT child_id FROM edges WHERE parent_id = ?)', (node_id,))
+
+    def subtree(self, node_id: str, internal_only: bool = False) -> List[Dict[str, Any]]:
+        """配下の全ノード（Euler区間による範囲検索、前順）"""
+        where = 'tin BETWEEN (SELECT tin FROM nodes WHERE node_id = ?) AND (SELECT tout FROM nodes WHERE node_id = ?)'
+        if internal_only:
+            where += ' AND is_leaf = 0'
+        return self._select(where, (node_id, node_id), order='tin')
+
+    def path_to_root(self, node_id: str) -> List[Dict[str, Any]]:
+        """自身からルートまで（Euler区間で祖先を選択）"""
+        return self._select(
+            'tin <= (SELECT tin FROM nodes WHERE node_id = ?) AND tout >= (SELECT tin FROM nodes WHERE node_id = ?)',
+            (node_id, node_id), order='depth DESC'
+        )
+
+    # ------------------------------------------------------------------
+    # 文書・統計
+    # ------------------------------------------------------------------
+
+    def clusters_containing(self, document_id: Optional[str] = None, pmid: Optional[str] = None,
+                            level: Optional[int] = None) -> List[Dict[str, Any]]:
+        """文書（文書IDまたはPMID）を含むクラスタノード（深い順）"""
+        if document_id is None:
+            if pmid is None:
+                raise ValueError("document_id or pmid is required")
+            row = self._conn.execute('SELECT document_id FROM documents WHERE pmid = ?', (str(pmid),)).fetchone()
+            if row is None:
+                return []
+            document_id = row['document_id']
+        where = 'is_leaf = 0 AND node_id IN (SELECT node_id FROM node_documents WHERE document_id = ?)'
+        params: List[Any] = [document_id]
+        if level is not None:
+            where += ' AND level = ?'
+            params.append(level)
+        return self._select(where, params, order='depth DESC')
+
+    def documents_under(self, node_id: str) -> List[str]:
+        """ノード配下の全文書ID"""
+        rows = self._conn.execute('SELECT document_id FROM node_documents WHERE node_id = ?', (node_id,))
+        return [row['document_id'] for row in rows]
+
+    def level_stats(self) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self._conn.execute('SELECT * FROM level_stats ORDER BY level')]
+
+    def level_distribution(self, node_id: str) -> Dict[int, int]:
+        """クラスタ配下文書のTreg判定レベル分布"""
+        rows = self._conn.execute("""
+            SELECT d.determined_level AS level, COUNT(*) AS n
+            FROM node_documents nd JOIN documents d ON d.document_id = nd.document_id
+            WHERE nd.node_id = ? GROUP BY d.determined_level ORDER BY d.determined_level
+        """, (node_id,))
+        return {row['level']: row['n'] for row in rows}
+
+
+def main():
+    """コマンドライン: export / query"""
+    from raptor_artifact import load_tree_artifact
+
+    parser = argparse.ArgumentParser(description="RAPTOR tree SQLite export and query tool")
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help='export a tree (JSON or .raptor) to SQLite')
+    export.add_argument('tree')
+    export.add_argument('--documents', help='treg_documents_80x_*.json metadata')
+    export.add_argument('-o', '--output', help='output database path')
+    query = sub.add_parser('query', help='run a quick query against an exported database')
+    query.add_argument('db')
+    query.add_argument('--level', type=int, help='list nodes at this level')
+    query.add_argument('--pmid', help='list clusters containing this PMID')
+    query.add_argument('--node', help='show level distribution under this node')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        artifact = load_tree_artifact(args.tree)
+        documents = None
+        if args.documents:
+            with open(args.documents, 'r', encoding='utf-8') as f:
+                documents = json.load(f)
+        output = args.output or sqlite_path_for(Path(args.tree).with_suffix('.json'))
+        path = export_sqlite(artifact.store, output, artifact.metadata, documents, artifact.tree_index)
+        print(f"✓ {Path(args.tree).name} → {path.name} ({len(artifact.store)} nodes)")
+        return
+
+    with RAPTORTreeDB(args.db) as db:
+        if args.level is not None:
+            for node in db.nodes_at_level(args.level):
+                print(f"{node['node_id']}\tsize={node['cluster_size']}\t{node['summary'][:80]}")
+        elif args.pmid:
+            for node in db.clusters_containing(pmid=args.pmid):
+                print(f"L{node['level']}\t{node['node_id']}\tsize={node['cluster_size']}")
+        elif args.node:
+            for level, count in db.level_distribution(args.node).items():
+                print(f"Level {level}: {count}")
+        else:
+            for row in db.level_stats():
+                print(f"Level {row['level']:>2}: {row['node_count']} nodes "
+                      f"(leaves: {row['leaf_count']}, avg size: {row['avg_cluster_size']:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Streaming RAPTOR Tree JSON Writer
+ノードを1件ずつディスクへ書き出すストリーミングJSONシリアライザ
+
+- 出力全体の辞書をメモリ上に構築しない（ピークメモリはノード1件分）
+- 区切り文字を詰めたコンパクトなJSON、埋め込みは浮動小数点リスト（指定時はfloat32のbase64）
+- 同じディレクトリの一時ファイルへ書き込み、完了時にos.replaceでアトミックに置き換え
+"""
+
+import base64
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+
+_SEPARATORS = (',', ':')
+
+
+def _default_file_mode() -> int:
+    """open(..., 'w') で作成した場合と同じパーミッション（0o666 & ~umask）"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def encode_embedding(embedding: Optional[np.ndarray], encoding: str = 'b64') -> Any:
+    """埋め込みをJSON値に変換（'b64': float32バイト列のbase64、'list': 浮動小数点リスト）"""
+    if embedding is None:
+        return None
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    if encoding == 'list':
+        return vector.tolist()
+    if encoding == 'b64':
+        return {
+            'dtype': 'float32',
+            'dim': int(vector.shape[0]),
+            'b64': base64.b64encode(vector.tobytes()).decode('ascii')
+        }
+    raise ValueError(f"Unknown embedding encoding: {encoding}")
+
+
+def decode_embedding(value: Any) -> Optional[np.ndarray]:
+    """encode_embedding() の出力（または従来のリスト形式）をfloat32配列に戻す"""
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        raw = base64.b64decode(value['b64'])
+        return np.frombuffer(raw, dtype=np.dtype(value.get('dtype', 'float32'))).astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def node_record(node, content_limit: Optional[int] = None, sources_limit: Optional[int] = None,
+                embedding_encoding: Optional[str] = None) -> Dict[str, Any]:
+    """ノード（RAPTORNode / RAPTORNodeView）をJSON出力用の辞書に変換"""
+    content = node.content or ''
+    summary = node.summary or ''
+    sources = node.source_documents
+    if content_limit is not None:
+        content = content[:content_limit]
+        summary = summary[:content_limit]
+    if sources_limit is not None:
+        sources = sources[:sources_limit]
+    record = {
+        'node_id': str(node.node_id),
+        'parent_id': str(node.parent_id) if node.parent_id else None,
+        'children': [str(c) for c in node.children],
+        'level': int(node.level),
+        'content': content,
+        'summary': summary,
+        'is_leaf': bool(node.is_leaf),
+        'cluster_id': int(node.cluster_id) if node.cluster_id is not None else None,
+        'cluster_size': int(node.cluster_size),
+        'source_documents': [str(d) for d in sources]
+    }
+    if embedding_encoding is not None:
+        record['embedding'] = encode_embedding(node.embedding, embedding_encoding)
+    return record
+
+
+class StreamingJSONTreeWriter:
+    """ヘッダー → ノード辞書（逐次）→ トレーラーの順にJSONを書き出すライター
+
+    使用例:
+        with StreamingJSONTreeWriter(path, header={'metadata': meta}, nodes_key='nodes') as writer:
+            for node_id, node in tree.items():
+                writer.write_node(node_id, node_record(node, embedding_encoding='b64'))
+    """
+
+    def __init__(self, output_path: Union[str, Path], header: Optional[Dict[str, Any]] = None,
+                 nodes_key: str = 'nodes', trailer: Optional[Dict[str, Any]] = None):
+        self.output_path = Path(output_path)
+        self.header = header or {}
+        self.trailer = trailer or {}
+        self.nodes_key = nodes_key
+        self.node_count = 0
+        self._file = None
+        self._tmp_path: Optional[str] = None
+
+    def _write_fields(self, fields: Dict[str, Any]) -> None:
+        for key, value in fields.items():
+            self._file.write(json.dumps(str(key), ensure_ascii=False))
+            self._file.write(':')
+            self._file.write(json.dumps(value, ensure_ascii=False, separators=_SEPARATORS))
+            self._file.write(',')
+
+    def open(self) -> 'StreamingJSONTreeWriter':
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(
+            prefix=f".{self.output_path.name}.", suffix='.tmp', dir=self.output_path.parent
+        )
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, _default_file_mode())  # mkstemp は 0600 で作成するため、umask に従うよう戻す
+        self._file = os.fdopen(fd, 'w', encoding='utf-8')
+        self._file.write('{')
+        self._write_fields(self.header)
+        self._file.write(json.dumps(self.nodes_key) + ':{')
+        return self
+
+    def write_node(self, node_id: str, record: Dict[str, Any]) -> None:
+        """ノード1件を書き出す"""
+        if self.node_count:
+            self._file.write(',')
+        self._file.write(json.dumps(str(node_id), ensure_ascii=False))
+        self._file.write(':')
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=_SEPARATORS))
+        self.node_count += 1
+
+    def close(self) -> Path:
+        """トレーラーを書き出してアトミックにリネーム"""
+        self._file.write('}')
+        for key, value in self.trailer.items():
+            self._file.write(',')
+            self._file.write(json.dumps(str(key), ensure_ascii=False))
+            self._file.write(':')
+            self._file.write(json.dumps(value, ensure_ascii=False, separators=_SEPARATORS))
+        self._file.write('}')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.output_path)
+        self._tmp_path = None
+        return self.output_path
+
+    def abort(self) -> None:
+        """書き込みを中止して一時ファイルを削除"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._tmp_path and os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._tmp_path = None
+
+    def __enter__(self) -> 'StreamingJSONTreeWriter':
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
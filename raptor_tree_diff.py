@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Tree Structural Diff
+2つのビルド間のツリー構造差分（メンバー文書のJaccard類似度によるノード対応付け）
+
+- 内部ノード × 文書 の疎行列を木インデックスから構築し、積1回で全ペアの共通文書数を計算
+- 相互ベストマッチ（Jaccard >= threshold）でノードを対応付け
+- 報告: 移動した文書・分割/統合されたクラスタ・要約の変更・そのまま再利用できるサブツリー
+
+文書IDはビルドごとの連番（doc_0, doc_1, ...）のため、文書メタデータ
+（treg_documents_80x_*.json）を指定するとPMIDで照合する。
+
+使用例:
+    python raptor_tree_diff.py results/enhanced_treg_raptor_80x_OLD.json results/enhanced_treg_raptor_80x_NEW.json \\
+        --old-documents results/treg_documents_80x_OLD.json --new-documents results/treg_documents_80x_NEW.json
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from raptor_node_store import RAPTORNodeStore
+from raptor_tree_index import TreeIndex
+
+
+class _TreeSide:
+    """片側のビルド: 内部ノードの行番号と文書列への写像"""
+
+    def __init__(self, store: RAPTORNodeStore, index: TreeIndex, leaf_keys: Dict[int, str]):
+        self.store = store
+        self.index = index
+        self.internal = np.flatnonzero(~store.is_leaf_mask)
+        self.row_of = np.full(len(store), -1, dtype=np.int64)
+        self.row_of[self.internal] = np.arange(len(self.internal))
+        self.leaf_keys = leaf_keys
+        self.levels = store.levels[self.internal]
+
+    def membership(self, column_of: Dict[str, int], n_columns: int) -> sparse.csr_matrix:
+        """内部ノード × 文書 の0/1疎行列（配下文書はleaf_orderの連続スライス）"""
+        index = self.index
+        leaf_cols = np.full(len(self.store), -1, dtype=np.int64)
+        for ordinal, key in self.leaf_keys.items():
+            leaf_cols[ordinal] = column_of[key]
+
+        starts = index.leaf_start[self.internal]
+        counts = index.leaf_end[self.internal] - starts
+        total = int(counts.sum())
+        rows = np.repeat(np.arange(len(self.internal)), counts)
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+        cols = leaf_cols[index.leaf_order[offsets]]
+        keep = cols >= 0
+        matrix = sparse.csr_matrix(
+            (np.ones(int(keep.sum()), dtype=np.int32), (rows[keep], cols[keep])),
+            shape=(len(self.internal), n_columns)
+        )
+        matrix.data[:] = 1  # 同一PMIDの重複文書は1件として数える
+        return matrix
+
+
+def _leaf_keys(store: RAPTORNodeStore, documents: Optional[Sequence[Dict[str, Any]]]) -> Dict[int, str]:
+    """リーフ序数 → 照合キー（PMIDがあれば pmid:<PMID>、なければノードID）"""
+    pmids = {doc['id']: str(doc['pmid']) for doc in documents or [] if doc.get('pmid')}
+    keys = {}
+    for ordinal in np.flatnonzero(store.is_leaf_mask):
+        node_id = store.node_id(int(ordinal))
+        keys[int(ordinal)] = f"pmid:{pmids[node_id]}" if node_id in pmids else node_id
+    return keys
+
+
+def _best_per_row(rows: np.ndarray, cols: np.ndarray, scores: np.ndarray,
+                  n_rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """行ごとの最大スコアの列とスコア（候補なしは -1 / 0）"""
+    best_col = np.full(n_rows, -1, dtype=np.int64)
+    best_score = np.zeros(n_rows, dtype=np.float64)
+    if len(rows):
+        order = np.lexsort((-scores, rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = rows[order][1:] != rows[order][:-1]
+        picked = order[first]
+        best_col[rows[picked]] = cols[picked]
+        best_score[rows[picked]] = scores[picked]
+    return best_col, best_score
+
+
+def _fully_exact_subtrees(side: _TreeSide, exact_rows: np.ndarray) -> np.ndarray:
+    """配下の内部ノードがすべて完全一致するサブツリーの根（極大のもののみ、行番号）"""
+    index = side.index
+    n = len(side.store)
+    exact = np.zeros(n, dtype=bool)
+    exact[side.internal[exact_rows]] = True
+    internal = np.zeros(n, dtype=bool)
+    internal[side.internal] = True
+
+    # 前順位置での累積和により、サブツリー区間 [tin, tout] 内の件数をO(1)で取得
+    exact_cum = np.concatenate([[0], np.cumsum(exact[index.preorder])])
+    internal_cum = np.concatenate([[0], np.cumsum(internal[index.preorder])])
+    tin, tout = index.tin[side.internal], index.tout[side.internal]
+    all_exact = (exact_cum[tout + 1] - exact_cum[tin]) == (internal_cum[tout + 1] - internal_cum[tin])
+
+    parent = index.parent[side.internal]
+    parent_row = np.where(parent >= 0, side.row_of[np.maximum(parent, 0)], -1)
+    parent_all_exact = np.where(parent_row >= 0, all_exact[np.maximum(parent_row, 0)], False)
+    return np.flatnonzero(all_exact & ~parent_all_exact)
+
+
+def diff_trees(old_store: RAPTORNodeStore, new_store: RAPTORNodeStore,
+               old_documents: Optional[Sequence[Dict[str, Any]]] = None,
+               new_documents: Optional[Sequence[Dict[str, Any]]] = None,
+               old_index: Optional[TreeIndex] = None, new_index: Optional[TreeIndex] = None,
+               threshold: float = 0.5, containment: float = 0.8, min_share: float = 0.1,
+               limit: Optional[int] = 20) -> Dict[str, Any]:
+    """2つのツリーの構造差分を計算
+
+    Args:
+        threshold: ノード対応付けに必要なJaccard類似度の下限
+        containment: 分割・統合判定で「片側のクラスタがほぼ含まれる」とみなす割合
+        min_share: 分割・統合の各断片が元クラスタに占める最小割合
+        limit: 各リストの出力件数上限（Noneで全件）
+    """
+    start = time.time()
+    old = _TreeSide(old_store, old_index or TreeIndex.from_store(old_store), _leaf_keys(old_store, old_documents))
+    new = _TreeSide(new_store, new_index or TreeIndex.from_store(new_store), _leaf_keys(new_store, new_documents))
+
+    keys = sorted(set(old.leaf_keys.values()) | set(new.leaf_keys.values()))
+    column_of = {key: i for i, key in enumerate(keys)}
+    a = old.membership(column_of, len(keys))
+    b = new.membership(column_of, len(keys))
+    size_a = np.asarray(a.sum(axis=1)).ravel()
+    size_b = np.asarray(b.sum(axis=1)).ravel()
+
+    # 共通文書数（非ゼロは文書を共有するペアのみ）
+    inter = (a @ b.T).tocoo()
+    rows, cols, shared = inter.row.astype(np.int64), inter.col.astype(np.int64), inter.data.astype(np.float64)
+    jaccard = shared / (size_a[rows] + size_b[cols] - shared)
+
+    best_b, best_b_score = _best_per_row(rows, cols, jaccard, len(old.internal))
+    best_a, _ = _best_per_row(cols, rows, jaccard, len(new.internal))
+    mutual = (best_b >= 0) & (best_b_score >= threshold)
+    mutual[mutual] &= best_a[best_b[mutual]] == np.flatnonzero(mutual)
+    matched_old = np.flatnonzero(mutual)
+    matched_new = best_b[matched_old]
+    match_of_old = np.where(mutual, best_b, -1)
+
+    old_id = lambda row: old_store.node_id(int(old.internal[row]))
+    new_id = lambda row: new_store.node_id(int(new.internal[row]))
+
+    def cap(items: List[Any]) -> List[Any]:
+        return items if limit is None else items[:limit]
+
+    # 完全一致（同一メンバー）と再利用可能なサブツリー
+    exact = best_b_score[matched_old] == 1.0
+    reusable_rows = _fully_exact_subtrees(old, matched_old[exact])
+    reusable_docs = int(old.index.leaf_end[old.internal[reusable_rows]].sum()
+                        - old.index.leaf_start[old.internal[reusable_rows]].sum())
+
+    # 要約の変更（対応付いたノードのみ比較）
+    changed_summaries = []
+    for row_a, row_b in zip(matched_old, matched_new):
+        old_summary = old_store.view(int(old.internal[row_a])).summary
+        new_summary = new_store.view(int(new.internal[row_b])).summary
+        if old_summary != new_summary:
+            changed_summaries.append({'old': old_id(row_a), 'new': new_id(row_b),
+                                      'jaccard': round(float(best_b_score[row_a]), 3)})
+
+    # 分割・統合（同一レベル内で、断片がほぼ含まれ一定割合を占めるもの）
+    same_level = old.levels[rows] == new.levels[cols]
+    b_in_a = same_level & (shared / size_b[cols] >= containment) & (shared / size_a[rows] >= min_share)
+    a_in_b = same_level & (shared / size_a[rows] >= containment) & (shared / size_b[cols] >= min_share)
+    unmatched_old = ~mutual
+    unmatched_new = np.ones(len(new.internal), dtype=bool)
+    unmatched_new[matched_new] = False
+
+    splits = []
+    split_parts = np.bincount(rows[b_in_a], minlength=len(old.internal))
+    for row_a in np.flatnonzero(split_parts >= 2):
+        parts = cols[b_in_a & (rows == row_a)]
+        splits.append({'old': old_id(row_a), 'level': int(old.levels[row_a]),
+                       'into': [new_id(c) for c in parts]})
+    merges = []
+    merge_parts = np.bincount(cols[a_in_b], minlength=len(new.internal))
+    for row_b in np.flatnonzero(merge_parts >= 2):
+        parts = rows[a_in_b & (cols == row_b)]
+        merges.append({'new': new_id(row_b), 'level': int(new.levels[row_b]),
+                       'from': [old_id(r) for r in parts]})
+
+    # 移動した文書: 直近の親クラスタの対応先（または分割・統合先）が新ツリーでの親と異なるもの
+    old_parent = {key: old.index.parent[o] for o, key in old.leaf_keys.items()}
+    new_parent = {key: new.index.parent[o] for o, key in new.leaf_keys.items()}
+    common = sorted(set(old_parent) & set(new_parent))
+    old_parent_rows = np.array([old.row_of[old_parent[k]] if old_parent[k] >= 0 else -1 for k in common],
+                               dtype=np.int64)
+    new_parent_rows = np.array([new.row_of[new_parent[k]] if new_parent[k] >= 0 else -1 for k in common],
+                               dtype=np.int64)
+    expected = np.where(old_parent_rows >= 0, match_of_old[np.maximum(old_parent_rows, 0)], -1)
+    n_new = len(new.internal)
+    fragment = b_in_a | a_in_b
+    fragment_pairs = np.unique(rows[fragment] * n_new + cols[fragment])
+    moved_mask = (expected != new_parent_rows) & ~np.isin(old_parent_rows * n_new + new_parent_rows,
+                                                          fragment_pairs)
+    moved = [{'document': common[i],
+              'from': old_id(old_parent_rows[i]) if old_parent_rows[i] >= 0 else None,
+              'to': new_id(new_parent_rows[i]) if new_parent_rows[i] >= 0 else None}
+             for i in np.flatnonzero(moved_mask)[:limit]]
+
+    added = sorted(set(new_parent) - set(old_parent))
+    removed = sorted(set(old_parent) - set(new_parent))
+    total_new_docs = max(len(new_parent), 1)
+
+    return {
+        'summary': {
+            'old_nodes': len(old_store),
+            'new_nodes': len(new_store),
+            'old_internal': len(old.internal),
+            'new_internal': len(new.internal),
+            'documents_added': len(added),
+            'documents_removed': len(removed),
+            'documents_moved': int(moved_mask.sum()),
+            'matched_clusters': len(matched_old),
+            'exact_clusters': int(exact.sum()),
+            'unmatched_old': int(unmatched_old.sum()),
+            'unmatched_new': int(unmatched_new.sum()),
+            'splits': len(splits),
+            'merges': len(merges),
+            'changed_summaries': len(changed_summaries),
+            'reusable_subtrees': len(reusable_rows),
+            'reusable_document_fraction': round(reusable_docs / total_new_docs, 4),
+            'elapsed_seconds': round(time.time() - start, 3)
+        },
+        'parameters': {'threshold': threshold, 'containment': containment, 'min_share': min_share},
+        'documents_added': cap(added),
+        'documents_removed': cap(removed),
+        'moved_documents': moved,
+        'splits': cap(splits),
+        'merges': cap(merges),
+        'changed_summaries': cap(changed_summaries),
+        'reusable_subtrees': cap([{'old': old_id(r), 'new': new_id(match_of_old[r]),
+                                   'documents': old.index.document_count(int(old.internal[r]))}
+                                  for r in reusable_rows])
+    }
+
+
+def _load_documents(path: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+    if not path:
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    from raptor_artifact import load_tree_artifact
+
+    parser = argparse.ArgumentParser(description="Structural diff between two RAPTOR tree builds")
+    parser.add_argument('old_tree', help='older build (JSON or .raptor)')
+    parser.add_argument('new_tree', help='newer build (JSON or .raptor)')
+    parser.add_argument('--old-documents', help='treg_documents_80x_*.json of the older build')
+    parser.add_argument('--new-documents', help='treg_documents_80x_*.json of the newer build')
+    parser.add_argument('--threshold', type=float, default=0.5, help='Jaccard threshold for matching')
+    parser.add_argument('--limit', type=int, default=20, help='max entries per list (0 = all)')
+    parser.add_argument('-o', '--output', help='write the diff as JSON')
+    args = parser.parse_args()
+
+    old_artifact = load_tree_artifact(args.old_tree)
+    new_artifact = load_tree_artifact(args.new_tree)
+    result = diff_trees(
+        old_artifact.store, new_artifact.store,
+        _load_documents(args.old_documents), _load_documents(args.new_documents),
+        old_artifact.tree_index, new_artifact.tree_index,
+        threshold=args.threshold, limit=args.limit or None
+    )
+
+    print("=" * 70)
+    print(f"🔀 Tree diff: {Path(args.old_tree).name} → {Path(args.new_tree).name}")
+    print("=" * 70)
+    for key, value in result['summary'].items():
+        print(f"  {key:<28} {value}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, separators=(',', ':'))
+        print(f"\n💾 Diff saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
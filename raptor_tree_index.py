@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Tree Index
+祖先・子孫クエリ用の事前計算インデックス（Euler tour + リーフ順序）
+
+- tin / tout: 前順走査の区間。aがbの祖先 ⇔ tin[a] <= tin[b] <= tout[a]（整数比較2回）
+- leaf_order: 前順のリーフ列。任意ノードの配下文書は leaf_order[leaf_start:leaf_end] の連続スライス
+- depth / parent: 深さ配列と根までの経路
+
+Top-downクラスタリングでは各クラスタのchildrenに配下の全文書IDが含まれるため、
+リーフは複数レベルの内部ノードから参照される。インデックスでは各リーフの親を
+参照元のうち最も深い（levelが最大の）内部ノードとし、木として扱う。
+"""
+
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+
+from raptor_node_store import RAPTORNodeStore
+
+_INDEX_FIELDS = ('parent', 'depth', 'tin', 'tout', 'preorder', 'leaf_order', 'leaf_start', 'leaf_end')
+
+
+class TreeIndex:
+    """ノード序数ベースの木インデックス（構築は1回、以降のクエリはO(1)またはスライス）"""
+    __slots__ = _INDEX_FIELDS + ('_node_ids', '_child_indptr', '_child_order')
+
+    def __init__(self, node_ids: List[str], **arrays: np.ndarray):
+        self._node_ids = node_ids
+        for name in _INDEX_FIELDS:
+            setattr(self, name, arrays[name])
+        # 正規化した親配列から子のCSRを作る（同じ親の子は序数順）
+        n = len(self.parent)
+        self._child_order = np.argsort(self.parent, kind='stable')
+        counts = np.bincount(self.parent[self.parent >= 0], minlength=n)
+        self._child_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._child_indptr[1:])
+        self._child_order = self._child_order[np.count_nonzero(self.parent < 0):]
+
+    # ------------------------------------------------------------------
+    # 構築
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def canonical_parents(store: RAPTORNodeStore) -> np.ndarray:
+        """明示的なparent_idを優先し、未設定ノードは参照元のうち最も深い内部ノードを親とする"""
+        n = len(store)
+        parents = store.parent_ordinals().astype(np.int64)
+        indptr, child_ords = store.children_csr()
+        edge_parent = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+        valid = (child_ords >= 0) & (child_ords != edge_parent)
+        edge_parent, edge_child = edge_parent[valid], child_ords[valid]
+
+        # 子ごとに親候補のlevelが最大の辺を選ぶ（lexsortの最後のキーが主キー）
+        levels = store.levels.astype(np.int64)
+        order = np.lexsort((levels[edge_parent], edge_child))
+        edge_parent, edge_child = edge_parent[order], edge_child[order]
+        last = np.ones(len(edge_child), dtype=bool)
+        last[:-1] = edge_child[1:] != edge_child[:-1]
+        derived = np.full(n, -1, dtype=np.int64)
+        derived[edge_child[last]] = edge_parent[last]
+
+        return np.where(parents >= 0, parents, derived)
+
+    @classmethod
+    def from_store(cls, store: RAPTORNodeStore) -> 'TreeIndex':
+        """ストアからインデックスを構築（前順走査1回）"""
+        n = len(store)
+        parent = cls.canonical_parents(store)
+        is_leaf = store.is_leaf_mask
+
+        order = np.argsort(parent, kind='stable')
+        counts = np.bincount(parent[parent >= 0], minlength=n)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        children = order[np.count_nonzero(parent < 0):]
+
+        tin = np.full(n, -1, dtype=np.int64)
+        tout = np.full(n, -1, dtype=np.int64)
+        depth = np.zeros(n, dtype=np.int32)
+        preorder = np.empty(n, dtype=np.int64)
+        counter = 0
+
+        # 反復DFS（根は序数順、子も序数順に訪問）
+        roots = np.flatnonzero(parent < 0)
+        for root in roots:
+            stack = [(int(root), False)]
+            while stack:
+                node, exiting = stack.pop()
+                if exiting:
+                    tout[node] = counter - 1
+                    continue
+                if tin[node] >= 0:
+                    continue  # 親配列に循環がある場合の保護
+                tin[node] = counter
+                preorder[counter] = node
+                counter += 1
+                stack.append((node, True))
+                kids = children[indptr[node]:indptr[node + 1]]
+                for child in kids[::-1]:
+                    if tin[child] < 0:
+                        depth[child] = depth[node] + 1
+                        stack.append((int(child), False))
+
+        # 根から到達できないノード（循環）は単独の根として扱う
+        for node in np.flatnonzero(tin < 0):
+            tin[node] = tout[node] = counter
+            preorder[counter] = node
+            parent[node] = -1
+            counter += 1
+
+        leaf_in_preorder = is_leaf[preorder]
+        leaf_order = preorder[leaf_in_preorder]
+        leaves_before = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(leaf_in_preorder, out=leaves_before[1:])
+        leaf_start = leaves_before[tin]
+        leaf_end = leaves_before[tout + 1]
+
+        return cls(list(store.node_ids), parent=parent, depth=depth, tin=tin, tout=tout,
+                   preorder=preorder, leaf_order=leaf_order, leaf_start=leaf_start, leaf_end=leaf_end)
+
+    # ------------------------------------------------------------------
+    # 保存・読み込み
+    # ------------------------------------------------------------------
+
+    def save(self, path: Union[str, Path]) -> None:
+        np.savez(path, **{name: getattr(self, name) for name in _INDEX_FIELDS})
+
+    @classmethod
+    def load(cls, path: Union[str, Path], node_ids: List[str]) -> 'TreeIndex':
+        with np.load(path) as npz:
+            arrays = {name: npz[name] for name in _INDEX_FIELDS}
+        if len(arrays['parent']) != len(node_ids):
+            raise ValueError(f"Tree index size {len(arrays['parent'])} != {len(node_ids)} nodes")
+        return cls(node_ids, **arrays)
+
+    # ------------------------------------------------------------------
+    # クエリ
+    # ------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    @property
+    def roots(self) -> np.ndarray:
+        return np.flatnonzero(self.parent < 0)
+
+    def is_ancestor(self, ancestor, descendant) -> Union[bool, np.ndarray]:
+        """ancestorがdescendantの祖先（自身を含む）か。配列同士でもベクトル化して判定"""
+        t = self.tin[descendant]
+        result = (self.tin[ancestor] <= t) & (t <= self.tout[ancestor])
+        return bool(result) if np.ndim(result) == 0 else result
+
+    def children(self, ordinal: int) -> np.ndarray:
+        """正規化した木での子ノード序数"""
+        return self._child_order[self._child_indptr[ordinal]:self._child_indptr[ordinal + 1]]
+
+    def subtree_ordinals(self, ordinal: int) -> np.ndarray:
+        """配下の全ノード（自身を含む、前順）"""
+        return self.preorder[self.tin[ordinal]:self.tout[ordinal] + 1]
+
+    def descendant_mask(self, ordinal: int) -> np.ndarray:
+        """配下ノードのブールマスク（序数順）"""
+        return (self.tin >= self.tin[ordinal]) & (self.tin <= self.tout[ordinal])
+
+    def subtree_leaves(self, ordinal: int) -> np.ndarray:
+        """配下のリーフ序数（leaf_orderの連続スライス、コピーなし）"""
+        return self.leaf_order[self.leaf_start[ordinal]:self.leaf_end[ordinal]]
+
+    def subtree_documents(self, ordinal: int) -> List[str]:
+        """配下の文書ID（リーフのノードID）"""
+        return [self._node_ids[i] for i in self.subtree_leaves(ordinal)]
+
+    def document_count(self, ordinal: int) -> int:
+        return int(self.leaf_end[ordinal] - self.leaf_start[ordinal])
+
+    def path_to_root(self, ordinal: int) -> List[int]:
+        """自身から根までの序数列"""
+        path = [int(ordinal)]
+        while self.parent[path[-1]] >= 0:
+            path.append(int(self.parent[path[-1]]))
+        return path
+
+    def path_to_root_ids(self, ordinal: int) -> List[str]:
+        return [self._node_ids[i] for i in self.path_to_root(ordinal)]
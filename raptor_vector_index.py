@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+RAPTOR Vector Index
+ツリーノード埋め込みのFAISSインデックス（正規化済み・内積 = コサイン類似度）
+
+ノード数に応じて構成を自動選択:
+    flat  (<= 20,000)     IndexFlatIP      厳密検索
+    hnsw  (<= 500,000)    IndexHNSWFlat    グラフ近似検索（学習不要）
+    ivf   (> 500,000)     IndexIVFFlat     転置リスト近似検索（k-means学習）
+
+メモリを抑える圧縮構成（kind で明示指定）:
+    sq8                   IndexScalarQuantizer  次元ごとのint8量子化（4倍圧縮、全件走査）
+    ivfpq                 IndexIVFPQ            転置リスト + 直積量子化（既定 dim/8 バイト、最大32倍圧縮）
+圧縮構成では近似スコアで k × rescore 件の候補を取り、元の埋め込み（アーティファクトではmmap）で
+厳密に再スコアリングして上位k件を返す。再現率は recall_report で全件探索と比較できる:
+    python raptor_vector_index.py results/enhanced_treg_raptor_80x_*.raptor --kinds flat sq8 ivfpq
+
+FAISS内の行番号 → ノード序数（RAPTORNodeStore）の対応表を保持し、
+アーティファクトに vectors.faiss / vector_ids.npy として保存する。
+faiss未インストール時はnumpyによる厳密検索にフォールバックする（保存はしない）。
+"""
+
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # 任意依存: 未インストール時はnumpyの全件探索
+    faiss = None
+
+INDEX_FILE = 'vectors.faiss'
+IDS_FILE = 'vector_ids.npy'
+CONFIG_FILE = 'vector_index.json'
+
+FLAT_MAX_VECTORS = 20_000
+HNSW_MAX_VECTORS = 500_000
+INDEX_KINDS = ('auto', 'flat', 'hnsw', 'ivf', 'sq8', 'ivfpq')
+COMPRESSED_KINDS = ('sq8', 'ivfpq')
+EXACT_KINDS = ('flat', 'numpy')  # 全件の厳密検索（埋め込み行列との行列積と同じ結果）
+RESCORE_FACTOR = 4  # 圧縮構成で厳密に再スコアリングする候補数（k の倍数）
+# recall_report の全件探索: 同時に保持するクエリ × ノードのスコア数（float32）
+EXACT_SCORE_ELEMENTS = 64_000_000
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2正規化したfloat32のC連続配列（ゼロベクトルはそのまま）"""
+    matrix = np.array(matrix, dtype=np.float32, order='C', ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def choose_index_kind(n_vectors: int) -> str:
+    """ベクトル数に応じたインデックス構成"""
+    if n_vectors <= FLAT_MAX_VECTORS:
+        return 'flat'
+    if n_vectors <= HNSW_MAX_VECTORS:
+        return 'hnsw'
+    return 'ivf'
+
+
+def _ivf_nlist(n_vectors: int, nlist: Optional[int] = None) -> int:
+    """転置リスト数（既定 4√n、k-means学習に1リストあたり39件以上を確保）"""
+    if nlist:
+        return nlist
+    return int(max(1, min(np.clip(4 * np.sqrt(n_vectors), 64, 65536), n_vectors // 39)))
+
+
+def _pq_subquantizers(dim: int, pq_m: Optional[int] = None) -> int:
+    """直積量子化の分割数（既定: dim/8 以下で dim を割り切る最大値 → 1ベクトル約 dim/8 バイト）"""
+    if pq_m:
+        if dim % pq_m:
+            raise ValueError(f"pq_m={pq_m} must divide the embedding dimension {dim}")
+        return pq_m
+    return max(m for m in range(1, max(dim // 8, 1) + 1) if dim % m == 0)
+
+
+def _training_sample(vectors: np.ndarray, size: int) -> np.ndarray:
+    n = len(vectors)
+    if n <= size:
+        return vectors
+    return vectors[np.sort(np.random.default_rng(0).choice(n, size, replace=False))]
+
+
+class _NumpyFlatIndex:
+    """faiss未インストール時の厳密内積検索（IndexFlatIP互換の最小API）"""
+
+    def __init__(self, dim: int):
+        self.d = dim
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+
+    @property
+    def ntotal(self) -> int:
+        return len(self._vectors)
+
+    def add(self, vectors: np.ndarray) -> None:
+        self._vectors = np.vstack([self._vectors, vectors])
+
+    def search(self, queries: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if rows is not None:
+            # 対象行のみスコアリングし、行番号に戻す
+            distances, labels = _NumpyFlatIndex._from_vectors(self._vectors[rows]).search(queries, k)
+            return distances, np.where(labels >= 0, rows[np.maximum(labels, 0)], -1)
+        scores = queries @ self._vectors.T
+        k_eff = min(k, self.ntotal)
+        distances = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        if k_eff == 0:
+            return distances, labels
+        top = np.argpartition(-scores, k_eff - 1, axis=1)[:, :k_eff]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        labels[:, :k_eff] = np.take_along_axis(top, order, axis=1)
+        distances[:, :k_eff] = np.take_along_axis(top_scores, order, axis=1)
+        return distances, labels
+
+    @staticmethod
+    def _from_vectors(vectors: np.ndarray) -> '_NumpyFlatIndex':
+        index = _NumpyFlatIndex(vectors.shape[1])
+        index._vectors = vectors
+        return index
+
+
+class VectorIndex:
+    """正規化埋め込みの近傍探索インデックス + 行番号→ID対応表"""
+
+    def __init__(self, index, ids: np.ndarray, kind: str, params: Optional[Dict[str, Any]] = None):
+        self.index = index
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.kind = kind
+        self.params = params or {}
+        self.rescore = int(self.params.get('rescore', RESCORE_FACTOR))
+        self.vectors: Optional[np.ndarray] = None  # 再スコアリング用の元の埋め込み（IDで引く行列）
+
+    def attach_vectors(self, vectors: np.ndarray) -> 'VectorIndex':
+        """圧縮構成の再スコアリングに使う元の埋め込み（行 = ID、mmapのままでよい）"""
+        self.vectors = vectors
+        return self
+
+    @property
+    def compressed(self) -> bool:
+        return self.kind in COMPRESSED_KINDS
+
+    @property
+    def exact(self) -> bool:
+        return self.kind in EXACT_KINDS
+
+    # ------------------------------------------------------------------
+    # 構築
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, ids: Optional[Sequence[int]] = None, kind: str = 'auto',
+              hnsw_m: int = 32, ef_construction: int = 80, ef_search: int = 128,
+              nlist: Optional[int] = None, nprobe: Optional[int] = None,
+              pq_m: Optional[int] = None, pq_bits: int = 8, rescore: int = RESCORE_FACTOR) -> 'VectorIndex':
+        """埋め込み行列からインデックスを構築（ids省略時は行番号）
+
+        圧縮構成（sq8 / ivfpq）の再スコアリングには attach_vectors で元の埋め込みを渡す
+        （from_store はストアの埋め込みを自動で渡す）
+        """
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown index kind: {kind} (expected one of {INDEX_KINDS})")
+        vectors = normalize_rows(embeddings)
+        n, dim = vectors.shape
+        ids = np.arange(n, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        if kind == 'auto':
+            kind = choose_index_kind(n)
+
+        if faiss is None:
+            if kind != 'flat':
+                logger.warning(f"⚠️ faiss is not installed; using exact numpy search instead of {kind}")
+            index = _NumpyFlatIndex(dim)
+            index.add(vectors)
+            return cls(index, ids, 'numpy')
+
+        params: Dict[str, Any] = {}
+        if kind == 'flat':
+            index = faiss.IndexFlatIP(dim)
+        elif kind == 'hnsw':
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = ef_construction
+            index.hnsw.efSearch = ef_search
+            params = {'m': hnsw_m, 'ef_construction': ef_construction, 'ef_search': ef_search}
+        elif kind == 'ivf':
+            nlist = _ivf_nlist(n, nlist)
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            # 学習はサンプル（リストあたり最大64件）で行う
+            index.train(_training_sample(vectors, nlist * 64))
+            index.nprobe = nprobe or max(8, nlist // 16)
+            params = {'nlist': nlist, 'nprobe': index.nprobe}
+        elif kind == 'sq8':
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            index.train(_training_sample(vectors, 100_000))  # 次元ごとの値域のみ学習
+            params = {'rescore': rescore}
+        else:
+            nlist = _ivf_nlist(n, nlist)
+            pq_m = _pq_subquantizers(dim, pq_m)
+            # 符号帳（2^bits 個）の学習に十分な件数がなければビット数を下げる
+            pq_bits = int(min(pq_bits, max(1, np.log2(max(n, 2) / 39))))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_bits, faiss.METRIC_INNER_PRODUCT)
+            index.train(_training_sample(vectors, max(nlist, 2 ** pq_bits) * 64))
+            index.nprobe = nprobe or max(8, nlist // 16)
+            params = {'nlist': nlist, 'nprobe': index.nprobe, 'pq_m': pq_m, 'pq_bits': pq_bits,
+                      'rescore': rescore}
+        if n:
+            index.add(vectors)
+        return cls(index, ids, kind, params)
+
+    @classmethod
+    def from_store(cls, store, kind: str = 'auto', **kwargs) -> 'VectorIndex':
+        """ノードストアの埋め込み（リーフ・内部ノード）から構築。IDはノード序数"""
+        ordinals = np.flatnonzero(store.has_embedding_mask)
+        dim = store.embedding_dim or 0
+        embeddings = store.embedding_matrix()[ordinals] if dim else np.zeros((0, 0), dtype=np.float32)
+        index = cls.build(embeddings, ordinals, kind=kind, **kwargs)
+        return index.attach_vectors(store.embedding_matrix()) if dim else index
+
+    # ------------------------------------------------------------------
+    # 検索
+    # ------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return int(self.index.ntotal)
+
+    @property
+    def dim(self) -> int:
+        return int(self.index.d)
+
+    def index_bytes(self) -> int:
+        """インデックス本体のバイト数（シリアライズ後のサイズ、numpyは行列サイズ）"""
+        if self.kind == 'numpy':
+            return int(self.index._vectors.nbytes)
+        return int(faiss.serialize_index(self.index).size)
+
+    def bytes_per_vector(self) -> float:
+        return self.index_bytes() / max(len(self), 1)
+
+    def search(self, queries: np.ndarray, k: int,
+               id_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """クエリ（1件または複数）の上位k件 (scores, ids)。候補不足分は id=-1
+
+        id_mask: ID空間（ノード序数）上のブールマスク。一致するIDのみを検索対象にする
+        （faissはIDSelectorBitmapで探索中に除外、numpyは対象行のみスコアリング）
+        圧縮構成で元の埋め込みがあれば k × rescore 件を取り、厳密なスコアで上位k件に絞る
+        """
+        vectors = normalize_rows(queries)
+        empty = (np.full((len(vectors), k), -np.inf, dtype=np.float32),
+                 np.full((len(vectors), k), -1, dtype=np.int64))
+        if len(self) == 0:
+            return empty
+        rescore = self.compressed and self.vectors is not None and self.rescore > 1
+        fetch = k * self.rescore if rescore else k
+        if id_mask is None:
+            scores, rows = self.index.search(vectors, fetch)
+        else:
+            row_mask = np.zeros(len(self.ids), dtype=bool)
+            in_range = self.ids < len(id_mask)
+            row_mask[in_range] = id_mask[self.ids[in_range]]
+            if not row_mask.any():
+                return empty
+            if self.kind == 'numpy':
+                scores, rows = self.index.search(vectors, fetch, rows=np.flatnonzero(row_mask))
+            else:
+                scores, rows = self.index.search(vectors, fetch, params=self._search_params(row_mask))
+        ids = np.where(rows >= 0, self.ids[np.maximum(rows, 0)], -1)
+        if rescore:
+            return self._rescore(vectors, ids, k)
+        return scores, ids
+
+    def _rescore(self, queries: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """候補を元の埋め込みとの厳密なコサイン類似度で並べ直して上位k件"""
+        n_queries, fetch = ids.shape
+        valid = ids >= 0
+        flat = np.maximum(ids, 0).ravel()
+        order = np.argsort(flat, kind='stable')  # mmapの行は昇順に読む
+        candidates = np.empty((len(flat), self.dim), dtype=np.float32)
+        candidates[order] = self.vectors[flat[order]]
+        candidates = normalize_rows(candidates).reshape(n_queries, fetch, self.dim)
+        exact = np.einsum('qfd,qd->qf', candidates, queries)
+        exact[~valid] = -np.inf
+        top = np.argsort(-exact, axis=1, kind='stable')[:, :k]
+        scores = np.take_along_axis(exact, top, axis=1).astype(np.float32)
+        ids = np.where(np.isfinite(scores), np.take_along_axis(ids, top, axis=1), -1)
+        return scores, ids
+
+    def _search_params(self, row_mask: np.ndarray):
+        """行マスクのIDSelectorを設定した検索パラメータ（HNSW / IVFの探索設定は維持）"""
+        bitmap = np.packbits(row_mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(row_mask), faiss.swig_ptr(bitmap))
+        if self.kind == 'hnsw':
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.index.hnsw.efSearch)
+        elif self.kind in ('ivf', 'ivfpq'):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.index.nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        params._bitmap = bitmap  # 検索中にビットマップが解放されないよう参照を保持
+        return params
+
+    def search_labels(self, query: np.ndarray, k: int, labels: Sequence[str],
+                      id_mask: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """単一クエリの上位k件を (ラベル, スコア) で返す（labelsはIDで引けるノードID列など）"""
+        scores, ids = self.search(query, k, id_mask=id_mask)
+        return [(labels[i], float(s)) for i, s in zip(ids[0], scores[0]) if i >= 0]
+
+    # ------------------------------------------------------------------
+    # 保存・読み込み
+    # ------------------------------------------------------------------
+
+    def save(self, directory: Union[str, Path]) -> List[str]:
+        """ディレクトリに保存し、書き出したファイル名を返す（numpyフォールバックは保存しない）"""
+        if self.kind == 'numpy':
+            return []
+        directory = Path(directory)
+        faiss.write_index(self.index, str(directory / INDEX_FILE))
+        np.save(directory / IDS_FILE, self.ids)
+        with open(directory / CONFIG_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'kind': self.kind, 'params': self.params, 'ntotal': len(self),
+                       'dim': self.dim, 'metric': 'inner_product', 'normalized': True}, f, indent=2)
+        return [INDEX_FILE, IDS_FILE, CONFIG_FILE]
+
+    @classmethod
+    def exists(cls, directory: Union[str, Path]) -> bool:
+        """読み込み可能な保存済みインデックスがあるか（faiss未インストール時はFalse）"""
+        return faiss is not None and (Path(directory) / INDEX_FILE).exists()
+
+    @classmethod
+    def load(cls, directory: Union[str, Path], mmap: bool = False) -> 'VectorIndex':
+        if faiss is None:
+            raise ImportError("Loading a saved vector index requires faiss; install it with: pip install faiss-cpu")
+        directory = Path(directory)
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = faiss.read_index(str(directory / INDEX_FILE), flags)
+        with open(directory / CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        params = config.get('params', {})
+        if config['kind'] == 'hnsw' and 'ef_search' in params:
+            index.hnsw.efSearch = params['ef_search']
+        elif config['kind'] in ('ivf', 'ivfpq') and 'nprobe' in params:
+            index.nprobe = params['nprobe']
+        return cls(index, np.load(directory / IDS_FILE), config['kind'], params)
+
+
+# ============================================================================
+# 再現率レポート（圧縮構成 vs 全件探索）
+# ============================================================================
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """正規化済み行列での全件探索の上位k行（クエリをチャンクに分けて行列積）"""
+    k = min(k, len(vectors))
+    top = np.zeros((len(queries), k), dtype=np.int64)
+    chunk = max(1, EXACT_SCORE_ELEMENTS // max(len(vectors), 1))
+    for start in range(0, len(queries), chunk):
+        scores = queries[start:start + chunk] @ vectors.T
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+        top[start:start + chunk] = np.take_along_axis(part, order, axis=1)
+    return top
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray, exclude: Optional[np.ndarray] = None, k: int = 10) -> float:
+    """全件探索の上位k件のうち見つかった割合（exclude: クエリ自身のIDなど、両方から除く）"""
+    hits = 0
+    total = 0
+    for i in range(len(truth)):
+        skip = exclude[i] if exclude is not None else None
+        expected = [x for x in truth[i] if x != skip][:k]
+        got = [x for x in found[i] if x != skip and x >= 0][:k]
+        hits += len(set(got).intersection(expected))
+        total += len(expected)
+    return hits / total if total else 1.0
+
+
+def recall_report(embeddings: np.ndarray, kinds: Sequence[str] = ('flat', 'sq8', 'ivfpq'), k: int = 10,
+                  n_queries: int = 500, rescore_factors: Sequence[int] = (1, RESCORE_FACTOR),
+                  seed: int = 0, **build_kwargs) -> List[Dict[str, Any]]:
+    """構成ごとのメモリ・検索時間・recall@k（全件探索が正解、クエリは自ノードの埋め込みでその自身は除外）
+
+    rescore_factors は圧縮構成のみ（1 = 近似スコアのまま）。
+    """
+    vectors = normalize_rows(embeddings)
+    n, dim = vectors.shape
+    rng = np.random.default_rng(seed)
+    query_ids = np.sort(rng.choice(n, min(n_queries, n), replace=False))
+    queries = vectors[query_ids]
+    truth = exact_top_k(vectors, queries, k + 1)
+    float_bytes = 4 * dim
+
+    report = []
+    for kind in kinds:
+        start = time.time()
+        index = VectorIndex.build(vectors, kind=kind, **build_kwargs).attach_vectors(vectors)
+        build_seconds = time.time() - start
+        bytes_per_vector = index.bytes_per_vector()
+        for factor in (rescore_factors if index.compressed else (1,)):
+            index.rescore = factor
+            start = time.time()
+            _, found = index.search(queries, k + 1)
+            elapsed = time.time() - start
+            report.append({
+                'kind': index.kind,
+                'rescore': factor if index.compressed else None,
+                'params': {key: value for key, value in index.params.items() if key != 'rescore'},
+                'bytes_per_vector': round(bytes_per_vector, 1),
+                'compression': round(float_bytes / bytes_per_vector, 1),
+                f'recall@{k}': round(recall_at_k(found, truth, query_ids, k), 4),
+                'ms_per_query': round(elapsed / len(queries) * 1000, 3),
+                'build_seconds': round(build_seconds, 2)
+            })
+    return report
+
+
+def main():
+    from raptor_artifact import load_tree_artifact
+
+    parser = argparse.ArgumentParser(description="Recall@k and memory of compressed vector indexes vs brute force")
+    parser.add_argument('tree', help='tree with stored embeddings (JSON or .raptor)')
+    parser.add_argument('--kinds', nargs='+', default=['flat', 'sq8', 'ivfpq'], choices=INDEX_KINDS[1:])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500, help='node embeddings sampled as queries')
+    parser.add_argument('--rescore', type=int, nargs='+', default=[1, RESCORE_FACTOR],
+                        help='candidate multipliers for exact re-scoring (compressed kinds)')
+    parser.add_argument('--pq-m', type=int, help='IVF-PQ sub-quantizers (default: about dim/8 bytes per vector)')
+    parser.add_argument('--nprobe', type=int, help='IVF lists searched per query')
+    parser.add_argument('-o', '--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    store = load_tree_artifact(args.tree).store
+    ordinals = np.flatnonzero(store.has_embedding_mask)
+    if not len(ordinals):
+        parser.error(f"{args.tree} has no stored embeddings")
+    embeddings = store.embedding_matrix()[ordinals]
+    print(f"📊 Recall@{args.k}: {len(ordinals)} vectors, dim={embeddings.shape[1]}, {args.queries} queries")
+    report = recall_report(embeddings, args.kinds, k=args.k, n_queries=args.queries,
+                           rescore_factors=args.rescore, pq_m=args.pq_m, nprobe=args.nprobe)
+
+    print(f"  {'kind':<8} {'rescore':>7} {'bytes/vec':>10} {'ratio':>6} {'recall':>8} {'ms/query':>9}")
+    for row in report:
+        rescore = '-' if row['rescore'] is None else f"x{row['rescore']}"
+        print(f"  {row['kind']:<8} {rescore:>7} {row['bytes_per_vector']:>10.1f} {row['compression']:>5.1f}x "
+              f"{row[f'recall@{args.k}']:>8.4f} {row['ms_per_query']:>9.3f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Report saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
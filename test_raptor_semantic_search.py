@@ -5,7 +5,8 @@ RAPTOR Semantic Search Performance Test
 This script implements:
 1. Keyword-based search (baseline)
 2. Pure semantic search (embeddings only)
-3. Hybrid search (keyword + semantic)
+3. Hybrid search (BM25 keyword + semantic)
+4. Two-stage search (hybrid top-N → cross-encoder rerank, optional)
 
 比較項目:
 - 検索速度
@@ -18,14 +19,14 @@ import time
 import numpy as np
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import List, Dict
 from collections import Counter
 import warnings
 warnings.filterwarnings('ignore')
 
-# Sentence-BERT for semantic embeddings
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from raptor_artifact import load_tree_data
+from raptor_reranker import CrossEncoderReranker
+from raptor_search import SemanticSearchEngine, load_search_engine
 
 # ============================================================================
 # Test Queries (same as keyword test)
@@ -44,22 +45,6 @@ TEST_QUERIES = [
     "What are the challenges and prospects for clinical applications of regulatory T cells?"
 ]
 
-# ============================================================================
-# Configuration
-# ============================================================================
-
-# Semantic model selection
-EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # Fast, general-purpose model (384 dimensions)
-# Alternative: "pritamdeka/S-PubMedBert-MS-MARCO" for biomedical domain
-
-# Hybrid search weights
-KEYWORD_WEIGHT = 0.4  # 40% keyword score
-SEMANTIC_WEIGHT = 0.6  # 60% semantic score
-
-# Cache settings
-EMBEDDINGS_CACHE_DIR = Path("data/embeddings_cache")
-EMBEDDINGS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
-
 # ============================================================================
 # 1. Baseline: Keyword Search (from original test)
 # ============================================================================
@@ -101,166 +86,7 @@ def simple_keyword_search(tree_data: Dict, query: str, top_k: int = 5) -> List[D
     return results[:top_k]
 
 # ============================================================================
-# 2. Semantic Search Implementation
-# ============================================================================
-
-class SemanticSearchEngine:
-    def __init__(self, model_name: str = EMBEDDING_MODEL):
-        print(f"🔧 Loading embedding model: {model_name}")
-        # Use CUDA if available, otherwise CPU
-        import torch
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        print(f"  Using device: {device}")
-        self.model = SentenceTransformer(model_name, device=device)
-        self.embeddings = None
-        self.node_ids = None
-        self.node_info = None
-        
-    def build_embeddings(self, tree_data: Dict, cache_file: Path = None) -> None:
-        """
-        Build embeddings for all nodes (with caching)
-        """
-        if cache_file and cache_file.exists():
-            print(f"📂 Loading cached embeddings from {cache_file.name}")
-            cache = np.load(cache_file, allow_pickle=True).item()
-            self.embeddings = cache['embeddings']
-            self.node_ids = cache['node_ids']
-            self.node_info = cache['node_info']
-            print(f"  ✓ Loaded {len(self.node_ids)} node embeddings")
-            return
-        
-        print("🔨 Building embeddings for all nodes...")
-        texts = []
-        node_ids = []
-        node_info = []
-        
-        # Get tree_nodes from the loaded data
-        tree_nodes = tree_data.get("tree_nodes", {})
-        
-        for node_id, info in tree_nodes.items():
-            # Get text from summary or content
-            summary = info.get("summary", "")
-            content = info.get("content", "")
-            text = summary + " " + content
-            
-            if text.strip():
-                texts.append(text)
-                node_ids.append(node_id)
-                node_info.append({
-                    "level": info.get("level", -1),
-                    "is_leaf": info.get("is_leaf", False),
-                    "text": text[:200]
-                })
-        
-        # Generate embeddings (batch processing for efficiency)
-        print(f"  Processing {len(texts)} nodes...")
-        start_time = time.time()
-        # Use larger batch size for GPU, smaller for CPU
-        import torch
-        batch_size = 32 if torch.cuda.is_available() else 8
-        self.embeddings = self.model.encode(
-            texts, 
-            show_progress_bar=True, 
-            batch_size=batch_size, 
-            convert_to_numpy=True
-        )
-        elapsed = time.time() - start_time
-        print(f"  ✓ Generated {len(self.embeddings)} embeddings in {elapsed:.2f}s")
-        
-        self.node_ids = node_ids
-        self.node_info = node_info
-        
-        # Cache the embeddings
-        if cache_file:
-            print(f"💾 Saving embeddings cache to {cache_file.name}")
-            np.save(cache_file, {
-                'embeddings': self.embeddings,
-                'node_ids': node_ids,
-                'node_info': node_info
-            })
-    
-    def semantic_search(self, query: str, top_k: int = 5) -> List[Dict]:
-        """
-        Pure semantic search using cosine similarity
-        """
-        # Encode query
-        query_embedding = self.model.encode([query])[0]
-        
-        # Compute cosine similarities
-        similarities = cosine_similarity([query_embedding], self.embeddings)[0]
-        
-        # Get top-k results
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        
-        results = []
-        for idx in top_indices:
-            results.append({
-                "node_id": self.node_ids[idx],
-                "score": float(similarities[idx]),  # 0-1 range
-                "level": self.node_info[idx]["level"],
-                "is_leaf": self.node_info[idx]["is_leaf"],
-                "text": self.node_info[idx]["text"]
-            })
-        
-        return results
-    
-    def hybrid_search(self, query: str, tree_data: Dict, 
-                     keyword_weight: float = KEYWORD_WEIGHT,
-                     semantic_weight: float = SEMANTIC_WEIGHT,
-                     top_k: int = 5) -> List[Dict]:
-        """
-        Hybrid search: combines keyword and semantic scores
-        """
-        # Get keyword results (all nodes)
-        keyword_results = simple_keyword_search(tree_data, query, top_k=100)
-        keyword_scores = {r["node_id"]: r["score"] for r in keyword_results}
-        
-        # Get semantic results
-        semantic_results = self.semantic_search(query, top_k=100)
-        semantic_scores = {r["node_id"]: r["score"] for r in semantic_results}
-        
-        # Normalize scores to 0-1 range
-        if keyword_scores:
-            max_keyword = max(keyword_scores.values())
-            keyword_scores = {k: v/max_keyword for k, v in keyword_scores.items()}
-        
-        # Combine scores
-        all_node_ids = set(keyword_scores.keys()) | set(semantic_scores.keys())
-        
-        # Get tree_nodes from the loaded data
-        tree_nodes = tree_data.get("tree_nodes", {})
-        
-        combined_results = []
-        for node_id in all_node_ids:
-            kw_score = keyword_scores.get(node_id, 0)
-            sem_score = semantic_scores.get(node_id, 0)
-            
-            # Weighted combination
-            hybrid_score = (keyword_weight * kw_score) + (semantic_weight * sem_score)
-            
-            # Get node info
-            if node_id in tree_nodes:
-                node_info = tree_nodes[node_id]
-                summary = node_info.get("summary", "")
-                content = node_info.get("content", "")
-                text = (summary + " " + content)[:200]
-                
-                combined_results.append({
-                    "node_id": node_id,
-                    "score": hybrid_score,
-                    "keyword_score": kw_score,
-                    "semantic_score": sem_score,
-                    "level": node_info.get("level", -1),
-                    "is_leaf": node_info.get("is_leaf", False),
-                    "text": text
-                })
-        
-        # Sort by hybrid score
-        combined_results.sort(key=lambda x: x["score"], reverse=True)
-        return combined_results[:top_k]
-
-# ============================================================================
-# 3. Performance Testing
+# 2. Performance Testing (engine: raptor_search.py)
 # ============================================================================
 
 def run_comparison_test(tree_file: Path, semantic_engine: SemanticSearchEngine):
@@ -274,8 +100,7 @@ def run_comparison_test(tree_file: Path, semantic_engine: SemanticSearchEngine):
     
     # Load tree data
     print(f"📂 Loading RAPTOR tree: {tree_file.name}")
-    with open(tree_file, 'r', encoding='utf-8') as f:
-        tree_data = json.load(f)
+    tree_data = load_tree_data(tree_file)
     
     # Get number of nodes from tree_nodes
     num_nodes = len(tree_data.get("tree_nodes", {}))
@@ -317,6 +142,31 @@ def run_comparison_test(tree_file: Path, semantic_engine: SemanticSearchEngine):
             print(f"📊 Top result: {hybrid_results[0]['node_id']} (score: {hybrid_results[0]['score']:.4f})")
             print(f"    Breakdown: keyword={hybrid_results[0]['keyword_score']:.4f}, semantic={hybrid_results[0]['semantic_score']:.4f}")
         
+        # 4. Two-stage: hybrid top-N reranked by the cross-encoder (stages timed separately)
+        reranked = None
+        if semantic_engine.reranker is not None:
+            print("\n🎯 Method 4: Two-Stage Search (Hybrid → Cross-Encoder Rerank)")
+            start = time.time()
+            reranked_results = semantic_engine.two_stage_search(query, tree_data, top_k=5)
+            reranked_time = time.time() - start
+            stages = semantic_engine.last_stage_timings
+            print(f"⏱️  Time: {reranked_time:.4f}s (first stage={stages['first_stage']:.4f}s, "
+                  f"rerank={stages['rerank']:.4f}s; scored={stages['scored']}, cached={stages['cached']}, "
+                  f"over budget={stages['skipped_budget']})")
+            if reranked_results:
+                top = reranked_results[0]
+                rerank_score = f"{top['rerank_score']:.4f}" if top['rerank_score'] is not None else "n/a"
+                print(f"📊 Top result: {top['node_id']} (rerank: {rerank_score}, first-stage rank: {top['first_stage_rank']})")
+            reranked = {
+                "time": reranked_time,
+                "first_stage_time": stages["first_stage"],
+                "rerank_time": stages["rerank"],
+                "scored": stages["scored"],
+                "cached": stages["cached"],
+                "skipped_budget": stages["skipped_budget"],
+                "top_results": reranked_results
+            }
+        
         # Store results for comparison
         results_comparison.append({
             "query_id": idx,
@@ -335,7 +185,8 @@ def run_comparison_test(tree_file: Path, semantic_engine: SemanticSearchEngine):
                 "time": hybrid_time,
                 "top_results": hybrid_results,
                 "top_score": hybrid_results[0]["score"] if hybrid_results else 0
-            }
+            },
+            "reranked": reranked
         })
         
         print()
@@ -353,6 +204,24 @@ def run_comparison_test(tree_file: Path, semantic_engine: SemanticSearchEngine):
     print(f"  Keyword:  {np.mean(keyword_times):.4f}s (± {np.std(keyword_times):.4f}s)")
     print(f"  Semantic: {np.mean(semantic_times):.4f}s (± {np.std(semantic_times):.4f}s)")
     print(f"  Hybrid:   {np.mean(hybrid_times):.4f}s (± {np.std(hybrid_times):.4f}s)")
+    reranked_runs = [r["reranked"] for r in results_comparison if r["reranked"] is not None]
+    if reranked_runs:
+        print(f"  Two-stage: {np.mean([r['time'] for r in reranked_runs]):.4f}s "
+              f"(first stage={np.mean([r['first_stage_time'] for r in reranked_runs]):.4f}s, "
+              f"rerank={np.mean([r['rerank_time'] for r in reranked_runs]):.4f}s)")
+    
+    # Batch API: one encoding pass + one matmul for all queries
+    print("\n📦 Batch Search (all queries, shared encoding):")
+    start = time.time()
+    semantic_engine.batch_search(TEST_QUERIES, tree_data, top_k=5)
+    batch_time = time.time() - start
+    sequential_time = sum(semantic_times) + sum(hybrid_times)
+    timings = semantic_engine.last_batch_timings
+    print(f"  Total: {batch_time:.4f}s for {len(TEST_QUERIES)} queries "
+          f"(encode={timings['encode']:.4f}s, semantic={timings['semantic']:.4f}s, "
+          f"keyword+hybrid={timings['keyword_hybrid']:.4f}s)")
+    print(f"  Sequential semantic + hybrid: {sequential_time:.4f}s "
+          f"(x{sequential_time / max(batch_time, 1e-9):.1f})")
     
     print("\n📈 Score Comparison:")
     for i, result in enumerate(results_comparison, 1):
@@ -385,17 +254,14 @@ def main():
         return
     
     tree_file = tree_files[-1]  # Use the most recent one
+    semantic_engine = load_search_engine(tree_file)
     
-    # Load tree data
-    with open(tree_file, 'r', encoding='utf-8') as f:
-        tree_data = json.load(f)
-    
-    # Initialize semantic search engine
-    semantic_engine = SemanticSearchEngine(EMBEDDING_MODEL)
-    
-    # Build or load embeddings
-    cache_file = EMBEDDINGS_CACHE_DIR / f"embeddings_{tree_file.stem}_{EMBEDDING_MODEL.replace('/', '_')}.npy"
-    semantic_engine.build_embeddings(tree_data, cache_file=cache_file)
+    # Optional second stage (skipped when the cross-encoder is not available locally)
+    try:
+        semantic_engine.reranker = CrossEncoderReranker()
+        print(f"🎯 Reranker: {semantic_engine.reranker.model_name}")
+    except (ImportError, OSError) as e:
+        print(f"⚠️ Cross-encoder reranker unavailable ({e}); skipping two-stage search")
     
     # Run comparison test
     run_comparison_test(tree_file, semantic_engine)
@@ -0,0 +1,75 @@
+"""Treg段階フィルタの文書ID対応テスト（文書の並びが doc_{i} の番号順と異なる場合）"""
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+from raptor_filters import FilterIndex, leaf_stages_for, treg_stage
+from raptor_node_store import RAPTORNodeStore
+
+# build_treg_raptor_16x.py の Level 0 サンプリング後と同じく、並びと番号が一致しない
+DOC_IDS = ['doc_3', 'doc_0', 'doc_4', 'doc_1', 'doc_2']
+DOC_LEVELS = [0, 4, 7, 5, 6]
+EXPECTED = dict(zip(DOC_IDS, DOC_LEVELS))
+
+
+def make_store() -> RAPTORNodeStore:
+    """リーフを構築時の文書順に追加し、その上に親ノードを1つ置く"""
+    store = RAPTORNodeStore(capacity=8)
+    for doc_id in DOC_IDS:
+        store.add(SimpleNamespace(node_id=doc_id, parent_id='root', level=0, cluster_id=None,
+                                  cluster_size=1, is_leaf=True, content=f'text of {doc_id}',
+                                  summary='', children=[], source_documents=[doc_id],
+                                  embedding=None))
+    store.add(SimpleNamespace(node_id='root', parent_id=None, level=1, cluster_id=0,
+                              cluster_size=len(DOC_IDS), is_leaf=False, content='summary',
+                              summary='summary', children=DOC_IDS, source_documents=DOC_IDS,
+                              embedding=None))
+    return store
+
+
+def stage_members(index: FilterIndex, stage: int) -> set:
+    return {index.store.node_id(int(o)) for o in index.ordinals(treg_stage(stage))}
+
+
+def main() -> int:
+    store = make_store()
+    cases = [
+        ("doc_ids + doc_levels", {'doc_ids': DOC_IDS, 'doc_levels': DOC_LEVELS}),
+        ("doc_levels のみ（旧メタデータ: リーフ順）", {'doc_levels': DOC_LEVELS}),
+    ]
+
+    print("=" * 70)
+    print("🧪 Treg段階フィルタ: 文書ID対応テスト")
+    print("=" * 70)
+
+    all_pass = True
+    for description, metadata in cases:
+        stages = leaf_stages_for(store, metadata)
+        index = FilterIndex(store, leaf_stages=stages)
+        ok = stages == EXPECTED and all(
+            stage_members(index, level) & set(DOC_IDS) == {d for d, lv in EXPECTED.items() if lv == level}
+            for level in set(DOC_LEVELS)
+        )
+        all_pass &= ok
+        print(f"\n{'✓' if ok else '✗'} {description}")
+        print(f"  期待: {EXPECTED}")
+        print(f"  実際: {stages}")
+
+    # 文書メタデータ（treg_documents_80x_*.json）と同じ結果になること
+    documents = [{'id': d, 'determined_level': lv} for d, lv in zip(DOC_IDS, DOC_LEVELS)]
+    from_documents = FilterIndex(store, leaf_stages=leaf_stages_for(store, {}, documents)).stages
+    from_metadata = FilterIndex(store, leaf_stages=leaf_stages_for(
+        store, {'doc_ids': DOC_IDS, 'doc_levels': DOC_LEVELS})).stages
+    ok = bool(np.array_equal(from_documents, from_metadata))
+    all_pass &= ok
+    print(f"\n{'✓' if ok else '✗'} 文書メタデータ経由と同じ段階")
+
+    print("\n" + "=" * 70)
+    print("✅ すべてのテストが合格しました！" if all_pass else "⚠️ 一部のテストが失敗しました")
+    print("=" * 70)
+    return 0 if all_pass else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
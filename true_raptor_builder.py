@@ -8,13 +8,11 @@ import os
 # Hugging Face高速ダウンロードを有効化
 os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
 
-import json
 import pickle
 import numpy as np
 import faiss
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Tuple
-from dataclasses import dataclass
 import torch
 from transformers import (
     AutoModel, AutoTokenizer, AutoModelForCausalLM, 
@@ -27,23 +25,20 @@ import time
 from datetime import datetime
 import os
 
+from raptor_node_store import RAPTORNode, RAPTORNodeStore
+from raptor_artifact import load_tree_artifact, write_artifact
+from raptor_stream_writer import StreamingJSONTreeWriter, node_record
+from raptor_tree_index import TreeIndex
+from raptor_vector_index import VectorIndex
+from raptor_retrieval import CollapsedTreeRetriever, TreeTraversalRetriever
+from raptor_filters import FilterIndex, NodeFilter, leaf_stages_for
+from raptor_embedding import (
+    METADATA_KEY as EMBEDDING_METADATA_KEY, EmbeddingContract, QueryEncoder, pool_hidden_states
+)
+
 # Hugging Face ダウンロード設定
 os.environ["TRANSFORMERS_VERBOSITY"] = "info"  # ダウンロード進捗表示
 
-@dataclass
-class RAPTORNode:
-    """RAPTOR Tree Node with clustering support"""
-    node_id: str
-    parent_id: Optional[str]
-    children: List[str]
-    level: int
-    content: str
-    summary: str
-    is_leaf: bool
-    cluster_id: Optional[int]
-    embedding: Optional[np.ndarray]
-    source_documents: List[str]
-    cluster_size: int = 0
 
 class TrueRAPTORTree:
     """True RAPTOR Tree with Transformers-based embeddings and local LLM"""
@@ -52,6 +47,9 @@ class TrueRAPTORTree:
         # Transformersベースのエンコーダー（既存の依存関係を使用）
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.embedding_model_name = "sentence-transformers/all-MiniLM-L6-v2"
+        self.embedding_pooling = 'cls'  # 埋め込み仕様（メタデータに記録し、検索時のクエリも同じ仕様でエンコード）
+        self.embedding_normalize = False
+        self.embedding_max_length = 512
         
         # 埋め込みモデル初期化
         try:
@@ -73,8 +71,20 @@ class TrueRAPTORTree:
         self.llm_model = None
         self._init_local_llm()
         
-        self.nodes: Dict[str, RAPTORNode] = {}
-        self.faiss_index = None
+        self._init_tree_state()
+    
+    def _init_tree_state(self):
+        """モデル以外のツリー状態・クラスタリング設定を初期化"""
+        self.nodes: RAPTORNodeStore = RAPTORNodeStore()  # 列指向ノードストア（Dict互換）
+        self.tree_metadata: Dict[str, Any] = {}
+        self.checkpoint = None  # BuildCheckpoint（設定時は埋め込み・サブツリー単位で保存/再開）
+        self.faiss_index: Optional[VectorIndex] = None  # ノード埋め込みの近傍探索インデックス
+        self.vector_index_kind = 'auto'  # 'auto' / 'flat' / 'hnsw' / 'ivf'、大規模コーパスは圧縮構成 'sq8' / 'ivfpq'
+        self.tree_index: Optional[TreeIndex] = None  # 構築・読み込み時に計算（以降ノードを変更したら再計算）
+        self.tree_retriever: Optional[TreeTraversalRetriever] = None  # 埋め込みノルムを保持（初回のツリー探索で構築）
+        self.collapsed_retriever: Optional[CollapsedTreeRetriever] = None  # 同上（初回の平坦化検索で構築）
+        self.query_encoder: Optional[QueryEncoder] = None  # 読み込み専用ツリーのクエリ用（初回検索時に読み込み）
+        self.filter_index: Optional[FilterIndex] = None  # 検索フィルタ用マスク（初回のフィルタ付き検索で構築）
         self.article_embeddings = {}
         self.max_cluster_size = 30  # 削減してメモリ使用量を抑制
         self.min_cluster_size = 3
@@ -168,20 +178,68 @@ class TrueRAPTORTree:
         
     def encode_text(self, text: str) -> np.ndarray:
         """単一テキストをエンコード"""
+        if self.embedding_model is None:
+            raise RuntimeError(
+                "Encoder is not loaded: this tree was opened read-only with load_tree(). "
+                "Create TrueRAPTORTree() to encode new text."
+            )
         inputs = self.tokenizer(
             text, 
             return_tensors="pt", 
             truncation=True, 
             padding=True, 
-            max_length=512
+            max_length=self.embedding_max_length
         ).to(self.device)
         
         with torch.no_grad():
             outputs = self.embedding_model(**inputs)
-            # [CLS]トークンの隠れ状態を使用
-            embedding = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+            # 既定は[CLS]トークンの隠れ状態（embedding_contract() としてメタデータに記録）
+            embedding = pool_hidden_states(outputs.last_hidden_state, inputs['attention_mask'],
+                                           self.embedding_pooling)
+            if self.embedding_normalize:
+                embedding = torch.nn.functional.normalize(embedding, dim=-1)
         
-        return embedding.flatten()
+        return embedding.cpu().numpy().flatten()
+    
+    def embedding_contract(self) -> EmbeddingContract:
+        """ノード埋め込みの仕様（モデル・プーリング・正規化・次元）"""
+        return EmbeddingContract(
+            model=self.embedding_model_name,
+            pooling=self.embedding_pooling,
+            normalize=self.embedding_normalize,
+            max_length=self.embedding_max_length,
+            dim=self.nodes.embedding_dim or 0
+        )
+    
+    def checkpoint_contract(self) -> Dict[str, Any]:
+        """チェックポイントの照合に使う埋め込み仕様（次元は構築前は未確定のため除く）"""
+        contract = self.embedding_contract().to_dict()
+        contract.pop('dim', None)
+        return contract
+    
+    def checkpoint_params(self) -> Dict[str, Any]:
+        """サブツリーのチェックポイントキーに含める構築設定（変更したら再計算）"""
+        return {
+            'embedding': self.checkpoint_contract(),
+            'summarizer': getattr(self.llm_tokenizer, 'name_or_path', None),
+            'clustering_strategy': self.clustering_strategy,
+            'initial_clusters': self.initial_clusters,
+            'max_cluster_size': self.max_cluster_size,
+            'min_cluster_size': self.min_cluster_size,
+            'max_levels': self.max_levels,
+            'selection_strategy': self.selection_strategy,
+            'metric_weights': self.metric_weights,
+            'min_clusters': self.min_clusters,
+            'max_clusters': self.max_clusters
+        }
+    
+    def encode_query(self, query: str) -> np.ndarray:
+        """検索クエリをツリーと同じ仕様でエンコード（読み込み専用ツリーは仕様のモデルを初回のみ読み込む）"""
+        if self.embedding_model is not None:
+            return self.encode_text(query)
+        if self.query_encoder is None:
+            self.query_encoder = QueryEncoder(self.embedding_contract())
+        return self.query_encoder.encode([query])[0]
     
     def verify_embeddings(self, documents: List[str], sample_size: int = 5) -> dict:
         """Embeddingの品質を確認（サンプルベース）"""
@@ -546,6 +604,21 @@ Scientific summary:"""
                 cluster_doc_ids = [document_ids[i] for i in cluster_indices]
                 cluster_embeddings = embeddings[cluster_indices]
                 
+                # チェックポイントに完了済みサブツリーがあれば復元してスキップ
+                subtree_key = None
+                if self.checkpoint is not None:
+                    subtree_key = self.checkpoint.subtree_key(current_level, cluster_doc_ids,
+                                                               self.checkpoint_params())
+                    restored = self.checkpoint.load_subtree(subtree_key)
+                    if restored is not None:
+                        restored_nodes, restored_stats = restored
+                        for key, values in restored_stats.items():
+                            self.clustering_stats[key].extend(values)
+                        nodes.update(restored_nodes)
+                        self.logger.info(f"  ♻️ Cluster {cluster_id}: restored {len(restored_nodes)} nodes from checkpoint")
+                        continue
+                    stats_start = {key: len(values) for key, values in self.clustering_stats.items()}
+                
                 # クラスタ要約を生成
                 cluster_summary = self.summarize_cluster(cluster_docs)
                 
@@ -583,6 +656,17 @@ Scientific summary:"""
                             child_node.parent_id = node_id
                             if child_node_id not in node.children:
                                 node.children.append(child_node_id)
+                else:
+                    child_nodes = {}
+                
+                # 完了したサブツリー（要約・埋め込み・統計）を非同期で保存
+                if subtree_key is not None:
+                    subtree_nodes = {node_id: node}
+                    subtree_nodes.update(child_nodes)
+                    subtree_stats = {
+                        key: values[stats_start[key]:] for key, values in self.clustering_stats.items()
+                    }
+                    self.checkpoint.save_subtree(subtree_key, subtree_nodes, subtree_stats)
         
         except Exception as e:
             self.logger.error(f"Top-down clustering failed at level {current_level}: {e}")
@@ -594,8 +678,16 @@ Scientific summary:"""
         self.logger.info(f"🌳 RAPTOR Tree construction started with {len(documents)} documents")
         self.logger.info(f"📊 Clustering strategy: {self.clustering_strategy}")
         
-        # 全体の埋め込みを計算
-        all_embeddings = self.encode_documents(documents)
+        # 全体の埋め込みを計算（チェックポイントがあれば再利用）
+        all_embeddings = None
+        if self.checkpoint is not None:
+            all_embeddings = self.checkpoint.load_embeddings(document_ids, self.checkpoint_contract())
+            if all_embeddings is not None:
+                self.logger.info(f"♻️ Restored {len(all_embeddings)} document embeddings from checkpoint")
+        if all_embeddings is None:
+            all_embeddings = self.encode_documents(documents)
+            if self.checkpoint is not None:
+                self.checkpoint.save_embeddings(all_embeddings, document_ids, self.checkpoint_contract())
         
         if self.clustering_strategy == "top_down":
             # Top-down戦略: 全体を大きなクラスタに分割してから細分化
@@ -647,21 +739,30 @@ Scientific summary:"""
                         cluster_size=len(documents)
                     )
                     
-                    # 親子関係を更新
+                    # 親子関係を更新（ストア上のビュー経由で書き込む）
                     for node in top_level_nodes:
-                        node.parent_id = root_id
+                        self.nodes[node.node_id].parent_id = root_id
                     
                     self.nodes[root_id] = root_node
                     self.logger.info(f"🌟 Root node created: {root_id}")
             
-            leaf_count = sum(1 for node in self.nodes.values() if node.is_leaf)
-            internal_count = sum(1 for node in self.nodes.values() if not node.is_leaf)
+            leaf_count = self.nodes.leaf_count()
+            internal_count = len(self.nodes) - leaf_count
             self.logger.info(f"✅ RAPTOR Tree (top-down) completed: {len(self.nodes)} total nodes ({leaf_count} leaves, {internal_count} internal)")
             
         else:
             # Bottom-up戦略（従来の実装）
             self.logger.info(f"⬆️ Using bottom-up clustering")
             self._build_tree_bottom_up(documents, document_ids, all_embeddings)
+        
+        # コンテキスト組み立て用のトークン数、祖先・子孫クエリ用インデックス、近傍探索インデックス
+        self.compute_token_counts()
+        self.tree_index = TreeIndex.from_store(self.nodes)
+        self.tree_retriever = None
+        self.collapsed_retriever = None
+        self.faiss_index = VectorIndex.from_store(self.nodes, kind=self.vector_index_kind)
+        self.filter_index = None
+        self.logger.info(f"🔎 Vector index built: {self.faiss_index.kind} ({len(self.faiss_index)} vectors)")
     
     def _build_tree_bottom_up(self, documents: List[str], document_ids: List[str], 
                               all_embeddings: np.ndarray) -> None:
@@ -772,42 +873,148 @@ Scientific summary:"""
             self.nodes[root_id] = root_node
             self.logger.info(f"🌟 Root node created: {root_id}")
         
-        leaf_count = sum(1 for node in self.nodes.values() if node.is_leaf)
-        internal_count = sum(1 for node in self.nodes.values() if not node.is_leaf)
+        leaf_count = self.nodes.leaf_count()
+        internal_count = len(self.nodes) - leaf_count
         self.logger.info(f"✅ RAPTOR Tree (bottom-up) completed: {len(self.nodes)} total nodes ({leaf_count} leaves, {internal_count} internal) across {level + 1} levels")
     
-    def save_tree(self, output_path: str) -> None:
-        """ツリーを保存（JSON serializable形式で）"""
-        tree_data = {
-            'nodes': {},
-            'metadata': {
-                'creation_time': datetime.now().isoformat(),
-                'total_nodes': len(self.nodes),
-                'levels': max(node.level for node in self.nodes.values()) if self.nodes else 0,
-                'algorithm': 'RAPTOR with Local LLM and Clustering'
-            }
+    def save_tree(self, output_path: str, embedding_encoding: str = 'list') -> None:
+        """ツリーを保存（ノードを逐次書き出すコンパクトJSON）
+        
+        埋め込みは従来どおり浮動小数点リスト。embedding_encoding='b64' で float32 の base64
+        （{'dtype', 'dim', 'b64'}、読み込みは raptor_stream_writer.decode_embedding）
+        """
+        metadata = {
+            'creation_time': datetime.now().isoformat(),
+            'total_nodes': len(self.nodes),
+            'levels': self.nodes.max_level(),
+            'algorithm': 'RAPTOR with Local LLM and Clustering',
+            'embedding_model': self.embedding_model_name,
+            EMBEDDING_METADATA_KEY: self.embedding_contract().to_dict(),
+            'embedding_encoding': embedding_encoding
         }
         
-        for node_id, node in self.nodes.items():
-            tree_data['nodes'][node_id] = {
-                'node_id': node.node_id,
-                'parent_id': node.parent_id,
-                'children': node.children,
-                'level': int(node.level),  # numpy型をPython intに変換
-                'content': node.content,
-                'summary': node.summary,
-                'is_leaf': bool(node.is_leaf),  # numpy boolをPython boolに変換
-                'cluster_id': int(node.cluster_id) if node.cluster_id is not None else None,
-                'source_documents': node.source_documents,
-                'cluster_size': int(node.cluster_size),
-                'embedding': node.embedding.tolist() if node.embedding is not None else None
-            }
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(tree_data, f, ensure_ascii=False, indent=2)
+        with StreamingJSONTreeWriter(output_path, header={'metadata': metadata}, nodes_key='nodes') as writer:
+            for node_id, node in self.nodes.items():
+                writer.write_node(node_id, node_record(node, embedding_encoding=embedding_encoding))
         
         self.logger.info(f"💾 RAPTOR Tree saved: {output_path}")
     
+    def save_artifact(self, output_path: str, metadata: Optional[Dict[str, Any]] = None,
+                      doc_store=None, doc_keys: Optional[Dict[str, str]] = None) -> Path:
+        """ツリーをバイナリアーティファクト（mmap可能な埋め込み + 列データ）として保存
+        
+        doc_store / doc_keys を指定するとリーフ本文はドキュメントストアへの参照として保存する。
+        """
+        artifact_metadata = {
+            'creation_time': datetime.now().isoformat(),
+            'total_nodes': len(self.nodes),
+            'levels': self.nodes.max_level(),
+            'algorithm': 'RAPTOR with Local LLM and Clustering',
+            'embedding_model': self.embedding_model_name,
+            EMBEDDING_METADATA_KEY: self.embedding_contract().to_dict(),
+        }
+        if 'token_count_tokenizer' in self.tree_metadata:
+            artifact_metadata['token_count_tokenizer'] = self.tree_metadata['token_count_tokenizer']
+        artifact_metadata.update(metadata or {})
+        path = write_artifact(self.nodes, output_path, artifact_metadata,
+                              doc_store=doc_store, doc_keys=doc_keys, vector_index=self.faiss_index)
+        self.logger.info(f"💾 RAPTOR Tree artifact saved: {path}")
+        return path
+    
+    @classmethod
+    def load_tree(cls, path: str, verify: bool = False) -> 'TrueRAPTORTree':
+        """保存済みツリーを読み込む（エンコーダー・LLMは初期化しない）
+        
+        アーティファクト（.raptor）またはJSON出力を受け付ける。JSONと同名の
+        アーティファクトがあればそちらを使用し、構造は即時、テキストと埋め込みは
+        アクセス時にmmapから読み込む。
+        """
+        tree = cls.__new__(cls)
+        tree.logger = logging.getLogger(__name__)
+        tree.device = torch.device("cpu")
+        tree.tokenizer = None
+        tree.embedding_model = None
+        tree.llm_tokenizer = None
+        tree.llm_model = None
+        tree._init_tree_state()
+        
+        artifact = load_tree_artifact(path, verify=verify)
+        tree.nodes = artifact.store
+        tree.tree_metadata = artifact.metadata
+        tree.tree_index = artifact.tree_index
+        tree.tree_retriever = None
+        tree.collapsed_retriever = None
+        tree.faiss_index = artifact.vector_index
+        contract = EmbeddingContract.from_metadata(artifact.metadata)
+        tree.embedding_model_name = contract.model
+        tree.embedding_pooling = contract.pooling
+        tree.embedding_normalize = contract.normalize
+        tree.embedding_max_length = contract.max_length
+        saved_stats = artifact.metadata.get('clustering_stats', {})
+        for key in tree.clustering_stats:
+            tree.clustering_stats[key] = list(saved_stats.get(key, []))
+        
+        tree.logger.info(f"📂 RAPTOR Tree loaded (read-only): {artifact.path} ({len(tree.nodes)} nodes)")
+        return tree
+    
+    def compute_token_counts(self, batch_size: int = 256) -> None:
+        """全ノードのcontentのトークン数を生成モデルのトークナイザーで計算（なければエンコーダーのもの）"""
+        tokenizer = self.llm_tokenizer or self.tokenizer
+        if tokenizer is None:
+            return
+        counts = np.zeros(len(self.nodes), dtype=np.int32)
+        for start in range(0, len(self.nodes), batch_size):
+            batch = [self.nodes.view(i).content for i in range(start, min(start + batch_size, len(self.nodes)))]
+            input_ids = tokenizer(batch, add_special_tokens=False, truncation=False)['input_ids']
+            counts[start:start + len(batch)] = [len(ids) for ids in input_ids]
+        self.nodes.set_token_counts(counts)
+        self.tree_metadata['token_count_tokenizer'] = getattr(tokenizer, 'name_or_path', '')
+        self.logger.info(f"🔢 Token counts computed: {int(counts.sum())} tokens across {len(counts)} nodes")
+    
+    def node_mask(self, node_filter: Optional[NodeFilter]) -> Optional[np.ndarray]:
+        """フィルタ式（raptor_filters）をノード序数上のマスクに評価
+        
+        Treg段階はメタデータの doc_ids + doc_levels、なければリーフ本文を determine_treg_level で判定する。
+        """
+        if node_filter is None:
+            return None
+        if self.tree_index is None:
+            self.tree_index = TreeIndex.from_store(self.nodes)
+        if self.filter_index is None:
+            stages = leaf_stages_for(self.nodes, self.tree_metadata, classify_missing=True)
+            self.filter_index = FilterIndex(self.nodes, self.tree_index, stages)
+        return self.filter_index.mask(node_filter)
+    
+    def search_nodes(self, query: str, top_k: int = 5,
+                     node_filter: Optional[NodeFilter] = None) -> List[Tuple[str, float]]:
+        """クエリに近いノード（リーフ・内部ノード）を近傍探索インデックスで検索"""
+        if self.faiss_index is None:
+            self.faiss_index = VectorIndex.from_store(self.nodes, kind=self.vector_index_kind)
+        scores, ordinals = self.faiss_index.search(self.encode_query(query), top_k,
+                                                   id_mask=self.node_mask(node_filter))
+        return [(self.nodes.node_id(int(o)), float(s)) for o, s in zip(ordinals[0], scores[0]) if o >= 0]
+    
+    def retrieve_tree(self, query: str, beam_width: int = 3, max_depth: Optional[int] = None,
+                      top_k: int = 5, node_filter: Optional[NodeFilter] = None) -> Dict[str, Any]:
+        """ツリー階層をビームサーチでたどって検索（結果と探索経路を返す）"""
+        if self.tree_retriever is None:
+            if self.tree_index is None:
+                self.tree_index = TreeIndex.from_store(self.nodes)
+            self.tree_retriever = TreeTraversalRetriever(self.nodes, self.tree_index)
+        return self.tree_retriever.retrieve(self.encode_query(query), beam_width=beam_width,
+                                            max_depth=max_depth, top_k=top_k,
+                                            node_mask=self.node_mask(node_filter))
+    
+    def retrieve_collapsed(self, query: str, token_budget: int = 2000,
+                           node_filter: Optional[NodeFilter] = None, **kwargs) -> Dict[str, Any]:
+        """全ノードを対象に検索し、トークン予算内のコンテキスト（本文と使用ノードID）を組み立てる"""
+        if self.collapsed_retriever is None:
+            if self.tree_index is None:
+                self.tree_index = TreeIndex.from_store(self.nodes)
+            self.collapsed_retriever = CollapsedTreeRetriever(self.nodes, self.tree_index)
+        return self.collapsed_retriever.retrieve(self.encode_query(query), token_budget=token_budget,
+                                                 node_mask=self.node_mask(node_filter), **kwargs)
+    
     def get_clustering_stats(self) -> Dict[str, Any]:
         """クラスタリング統計情報を取得"""
         stats = {
@@ -935,7 +1142,7 @@ class TrueRAPTORBuilder:
         self.logger.info(f"   Input documents: {len(documents)}")
         self.logger.info(f"   Generated nodes: {len(self.raptor_tree.nodes)}")
         if self.raptor_tree.nodes:
-            self.logger.info(f"   Tree levels: {max(node.level for node in self.raptor_tree.nodes.values())}")
+            self.logger.info(f"   Tree levels: {self.raptor_tree.nodes.max_level()}")
         self.logger.info(f"   Output file: {tree_file.name}")
         self.logger.info(f"   Model used: {self.raptor_tree.embedding_model_name}")
         if self.raptor_tree.llm_model:
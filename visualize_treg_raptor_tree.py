@@ -3,7 +3,6 @@ Enhanced Treg RAPTOR Tree Visualization
 制御性T細胞分化に特化したRAPTORツリーの可視化
 """
 
-import json
 import os
 from pathlib import Path
 import matplotlib.pyplot as plt
@@ -20,6 +19,7 @@ from enhanced_treg_vocab import (
     determine_treg_level,
     TREG_DIFFERENTIATION_VOCAB
 )
+from raptor_artifact import load_tree_data
 
 # 日本語フォント設定
 plt.rcParams['font.sans-serif'] = ['MS Gothic', 'Yu Gothic', 'Meiryo']
@@ -172,10 +172,8 @@ def extract_keywords_from_text(text: str, top_n: int = 3, depth: int = 0) -> lis
     return keywords[:top_n]
 
 def load_raptor_tree(json_path: str) -> dict:
-    """RAPTORツリーのJSONファイルを読み込む"""
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    return data
+    """RAPTORツリーを読み込む（同名の.raptorアーティファクトがあればノードは遅延参照）"""
+    return load_tree_data(json_path)
 
 def analyze_tree_structure(tree_data: dict) -> dict:
     """ツリー構造の統計情報を分析"""